@@ -0,0 +1,97 @@
+"""Admission control for CPU-heavy endpoints
+
+Under threaded workers every request gets a thread, so slow uploads and
+cheap endpoints are served concurrently, but OpenCV work must not run
+once per thread. A Limiter allows a fixed number of holders and a
+bounded number of waiters; a request arriving when the wait queue is
+full, or waiting longer than the timeout, is turned away with Overloaded
+rather than piling up. Each heavy endpoint has its own Limiter and all
+of them share one for the CPU, so a burst of stitches cannot starve the
+detectors. Endpoints without a limit never wait. The slots bound the
+cores in use only because app.py sizes each request's worker pool to
+the CPU count over CPU_SLOTS times the server processes; OpenCV's own
+threads inside those workers come on top.
+"""
+import threading
+import time
+
+
+class Overloaded(Exception):
+    """No slot became free in time"""
+
+
+class Limiter:
+    """At most limit concurrent holders, with up to queue more waiting"""
+
+    def __init__(self, limit, queue=0, timeout=None):
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Take a slot, waiting up to timeout (the limiter's by default); raises Overloaded"""
+        timeout = self.timeout if timeout is None else timeout
+        with self._condition:
+            if self.active >= self.limit:
+                if self.waiting >= self.queue:
+                    self.rejected += 1
+                    raise Overloaded("Too many requests waiting")
+                self.waiting += 1
+                try:
+                    free = self._condition.wait_for(lambda: self.active < self.limit, timeout)
+                finally:
+                    self.waiting -= 1
+                if not free:
+                    self.rejected += 1
+                    raise Overloaded("Timed out waiting for a free slot")
+            self.active += 1
+            self.admitted += 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {"limit": self.limit, "active": self.active, "waiting": self.waiting,
+                    "admitted": self.admitted, "rejected": self.rejected}
+
+
+class Admission:
+    """Per-endpoint limiters in front of one shared CPU limiter"""
+
+    def __init__(self, cpu_slots, endpoint_limits, queue=0, timeout=None):
+        self.timeout = timeout
+        self.cpu = Limiter(cpu_slots, queue, timeout)
+        self.endpoints = {name: Limiter(limit, queue, timeout) for name, limit in endpoint_limits.items()}
+
+    def limited(self, endpoint):
+        return endpoint in self.endpoints
+
+    def acquire(self, endpoint):
+        """Take the endpoint's slot and a CPU slot, within one timeout; raises Overloaded"""
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        limiter = self.endpoints[endpoint]
+        limiter.acquire()
+        try:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            self.cpu.acquire(remaining)
+        except Overloaded:
+            limiter.release()
+            raise
+
+    def release(self, endpoint):
+        self.cpu.release()
+        self.endpoints[endpoint].release()
+
+    def stats(self):
+        return {"cpu": self.cpu.stats(), "endpoints": {name: limiter.stats()
+                                                       for name, limiter in sorted(self.endpoints.items())}}
@@ -1,19 +1,46 @@
+import gc
+import importlib
 import os
 import cv2
 import numpy as np
-import imutils
-import glob
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import Flask, Response, g, request, jsonify, send_file, send_from_directory, render_template
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import base64
-from PIL import Image
-import io
 import json
+import tempfile
+import shutil
+import uuid
+import logging
+import time
+from urllib.parse import urlencode
+
+import buffers
+import detections
+from cache import ResultCache, cache_key
+from crop import crop_to_valid
+from detectors import DETECTORS, detect, detect_many, summarize
+from ingest import parse_reduce, spool_upload
+from encoding import encode_image, mimetype, parse_encoding
+from admission import Admission, Overloaded
+from jobs import JobQueue, JobRunner, QueueFull, new_job_id
+import metrics
+from parallel import default_workers
+from profiler import DEFAULT_INTERVAL, SamplingProfiler, write_folded
+from results import DEFAULT_MAX_PENDING_BYTES, DEFAULT_TTL, ResultStore
+from screening import DEFAULT_MARGIN, FACTORS as SCREEN_FACTORS, Screen
+
+# Analyses only some endpoints use, imported there on first use; preload() imports
+# them all in a gunicorn master so that its forked workers share them
+OPTIONAL_MODULES = ('batch', 'history', 'incremental', 'indices', 'pyramid', 'stitch', 'zonal')
 
 app = Flask(__name__)
 CORS(app)
 
+# Request details are logged at DEBUG; LOG_LEVEL=INFO or higher keeps them out of the hot path
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 PROCESSED_FOLDER = 'processed'
@@ -25,21 +52,445 @@ os.makedirs(PROCESSED_FOLDER, exist_ok=True)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['PROCESSED_FOLDER'] = PROCESSED_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Uploads are spooled to disk in chunks, so the limit can cover whole flights
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 4 * 1024 * 1024 * 1024))
+
+# Stitching: frames per group, per-frame working resolution and mosaic size cap
+app.config['STITCH_GROUP_SIZE'] = 8
+app.config['STITCH_WORK_MEGAPIX'] = 4.0
+app.config['STITCH_MAX_MOSAIC_MEGAPIX'] = 60.0
+app.config['STITCH_MODE'] = 'panorama'
+
+# Frame groups go to cv2.Stitcher. 'neighbours' matches each frame only with its nearest
+# neighbours by GPS (or upload order), with features cached by frame hash, but only
+# within a STITCH_GROUP_SIZE group of consecutive uploads, so it needs much larger groups
+app.config['STITCH_PAIRING'] = 'stitcher'
+app.config['STITCH_NEIGHBOURS'] = 4
+app.config['STITCH_DETECTOR'] = 'orb'
+app.config['FEATURE_CACHE_FOLDER'] = os.path.join(PROCESSED_FOLDER, 'features')
+
+# Detectors process images in tiles so memory depends on tile size, not image size
+app.config['TILE_SIZE'] = 1024
+app.config['TILE_OVERLAP'] = 64
+
+# Coarse-to-fine detection: trees, diseases and objects are first screened for on
+# the image downsampled by SCREEN_FACTOR (2, 4 or 8; 0 traces the whole image) and
+# traced only in candidate windows, widened by SCREEN_MARGIN downsampled pixels.
+# A request's screen value overrides the factor
+app.config['SCREEN_FACTOR'] = int(os.environ.get('SCREEN_FACTOR', 0))
+app.config['SCREEN_MARGIN'] = int(os.environ.get('SCREEN_MARGIN', DEFAULT_MARGIN))
+
+# Scratch buffers each tile worker keeps for the next tile (0 disables reuse)
+app.config['BUFFER_POOL_BYTES'] = int(os.environ.get('BUFFER_POOL_BYTES', buffers.DEFAULT_POOL_BYTES))
+# and all the pools kept in a server process hold at most BUFFER_TOTAL_BYTES between them
+app.config['BUFFER_TOTAL_BYTES'] = int(os.environ.get('BUFFER_TOTAL_BYTES', buffers.DEFAULT_TOTAL_BYTES))
+buffers.configure(app.config['BUFFER_POOL_BYTES'], app.config['BUFFER_TOTAL_BYTES'])
+
+# Annotated results are drawn on a preview with this longest side (0 keeps full
+# resolution); counts and bounding boxes are always in full-resolution pixels
+app.config['PREVIEW_MAX_SIDE'] = int(os.environ.get('PREVIEW_MAX_SIDE', 2048))
+
+# Admission control per worker process: CPU-heavy endpoints share CPU_SLOTS and each
+# runs at most its ENDPOINT_LIMITS requests at once. Up to ADMISSION_QUEUE requests
+# wait ADMISSION_TIMEOUT seconds for a slot, then get 503; unlisted endpoints never wait
+app.config['CPU_SLOTS'] = int(os.environ.get('CPU_SLOTS', 2))
+app.config['ADMISSION_QUEUE'] = int(os.environ.get('ADMISSION_QUEUE', 16))
+app.config['ADMISSION_TIMEOUT'] = float(os.environ.get('ADMISSION_TIMEOUT', 30))
+app.config['ENDPOINT_LIMITS'] = {
+    'stitch_images': 1,
+    'batch_analysis': 1,
+    'create_session': 1,
+    'add_frames_to_session': 1,
+    'add_flight': 1,
+    'session_mosaic': 2,
+    'count_trees': 2,
+    'detect_areas': 2,
+    'detect_diseases': 2,
+    'count_objects': 2,
+    'analyze': 2,
+    'vegetation_index': 2,
+    'zone_statistics': 2,
+}
+
+# Server processes sharing the host; gunicorn.conf.py exports its worker count
+app.config['SERVER_PROCESSES'] = int(os.environ.get('WEB_CONCURRENCY', 1))
+# Every admitted request gets an equal share of the CPUs for its tile, stitch or frame
+# pool, so CPU_SLOTS requests in each server process together use each core once
+REQUEST_WORKERS = max(1, default_workers() // (app.config['CPU_SLOTS'] * app.config['SERVER_PROCESSES']))
+
+# Batch analysis reads frames ahead on I/O threads and analyses them on worker
+# processes; server-side flight directories must lie under BATCH_ROOT
+app.config['BATCH_ROOT'] = os.environ.get('BATCH_ROOT', '.')
+app.config['BATCH_WORKERS'] = REQUEST_WORKERS
+app.config['BATCH_BACKEND'] = 'process'
+app.config['BATCH_IO_THREADS'] = 4
+
+# Vegetation index statistics are reported per square zone of this many pixels; a
+# request may pick its own zone size up to INDEX_MAX_ZONE_SIZE, giving at most INDEX_MAX_ZONES
+app.config['ZONE_SIZE'] = 256
+app.config['INDEX_MAX_ZONE_SIZE'] = 4096
+app.config['INDEX_MAX_ZONES'] = 100000
+
+# Tiles and stitch groups run on a pool of 'thread' or 'process' workers
+app.config['WORKERS'] = REQUEST_WORKERS
+app.config['WORKER_BACKEND'] = 'thread'
+
+# OpenCV's own threads in each server process, set by start_worker(); the CPUs are
+# split between the SERVER_PROCESSES so they do not oversubscribe them
+app.config['OPENCV_THREADS'] = int(os.environ.get(
+    'OPENCV_THREADS', max(1, default_workers() // app.config['SERVER_PROCESSES'])))
+
+# Background jobs: SQLite queue, pool processes and the bound that triggers 429
+app.config['JOB_DATABASE'] = os.path.join(PROCESSED_FOLDER, 'jobs.sqlite3')
+app.config['JOB_WORKERS'] = 1
+app.config['JOB_QUEUE_LIMIT'] = 16
+
+# Stitched mosaics are also written as an XYZ tile pyramid served from /tiles
+app.config['TILES_FOLDER'] = os.path.join(PROCESSED_FOLDER, 'tiles')
+app.config['PYRAMID_TILE_SIZE'] = 256
+app.config['PYRAMID_FORMAT'] = 'jpeg'
+app.config['PYRAMID_MAX_AGE'] = 7 * 24 * 3600
+
+# Incremental mosaic sessions, each a directory of frame features, cameras and canvas
+app.config['SESSIONS_FOLDER'] = os.path.join(PROCESSED_FOLDER, 'sessions')
+
+# Flight history: each field's mosaics registered to its first flight, with measures and
+# changes per square zone of HISTORY_ZONE_SIZE pixels indexed by field and date
+app.config['HISTORY_FOLDER'] = os.path.join(PROCESSED_FOLDER, 'history')
+app.config['HISTORY_ZONE_SIZE'] = 256
+
+# How result images reach the client: 'json' embeds base64, 'url' returns a
+# /results link, 'multipart' streams the JSON and the image as two parts
+DELIVERY_MODES = ('json', 'url', 'multipart')
+
+# Result images are named by content under RESULTS_FOLDER, written by a background
+# thread holding up to RESULT_PENDING_BYTES, and deleted RESULT_TTL seconds after
+# they were last saved (0 keeps them)
+app.config['RESULTS_FOLDER'] = os.path.join(PROCESSED_FOLDER, 'results')
+app.config['RESULT_TTL'] = int(os.environ.get('RESULT_TTL', DEFAULT_TTL))
+app.config['RESULT_PENDING_BYTES'] = DEFAULT_MAX_PENDING_BYTES
+
+# Result cache keyed by upload hashes: memory LRU and disk tier byte budgets
+app.config['CACHE_FOLDER'] = os.path.join(PROCESSED_FOLDER, 'cache')
+app.config['CACHE_MEMORY_BYTES'] = 256 * 1024 * 1024
+app.config['CACHE_DISK_BYTES'] = 2 * 1024 * 1024 * 1024
+
+result_cache = ResultCache(app.config['CACHE_FOLDER'], app.config['CACHE_MEMORY_BYTES'], app.config['CACHE_DISK_BYTES'])
+
+# Detections (boxes, areas, centroids, class and contours) are stored as arrays under
+# DETECTIONS_FOLDER for RESULT_TTL and read back from /detections/<id> a page of at
+# most DETECTIONS_PAGE_LIMIT rows at a time; /detect-areas also lists bounding boxes
+# inline when there are at most DETECTIONS_INLINE_LIMIT of them, as do /analyze and /batch
+app.config['DETECTIONS_FOLDER'] = os.path.join(PROCESSED_FOLDER, 'detections')
+app.config['DETECTIONS_INLINE_LIMIT'] = int(os.environ.get('DETECTIONS_INLINE_LIMIT', 10000))
+app.config['DETECTIONS_PAGE_LIMIT'] = 10000
+
+detection_store = detections.DetectionStore(app.config['DETECTIONS_FOLDER'], app.config['RESULT_TTL'])
+# Opened by history_store() on first use
+flight_history = None
+
+# Requests slower than this many seconds leave a folded-stack profile in PROFILE_FOLDER
+# (0 turns the sampling profiler off)
+app.config['PROFILE_SLOW_SECONDS'] = float(os.environ.get('PROFILE_SLOW_SECONDS', 0))
+app.config['PROFILE_INTERVAL'] = float(os.environ.get('PROFILE_INTERVAL', DEFAULT_INTERVAL))
+app.config['PROFILE_FOLDER'] = os.path.join(PROCESSED_FOLDER, 'profiles')
+
+# Swept with the results, RESULT_TTL seconds after they last changed: stitch job images
+# and tile pyramids, mosaic sessions and profiles as a whole, cached frame features
+# file by file. Flight history is kept
+app.config['JOBS_FOLDER'] = os.path.join(PROCESSED_FOLDER, 'jobs')
+EXPIRING_FOLDERS = [
+    (app.config['JOBS_FOLDER'], False),
+    (app.config['TILES_FOLDER'], False),
+    (app.config['SESSIONS_FOLDER'], False),
+    (app.config['PROFILE_FOLDER'], False),
+    (app.config['FEATURE_CACHE_FOLDER'], True),
+]
+
+result_store = ResultStore(app.config['RESULTS_FOLDER'], app.config['RESULT_TTL'], app.config['RESULT_PENDING_BYTES'],
+                           expiring=EXPIRING_FOLDERS)
+
+profiler = SamplingProfiler(app.config['PROFILE_INTERVAL'])
+admission = Admission(app.config['CPU_SLOTS'], app.config['ENDPOINT_LIMITS'], app.config['ADMISSION_QUEUE'],
+                      app.config['ADMISSION_TIMEOUT'])
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def image_to_base64(image_path):
-    """Convert image to base64 string"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+def tiling_options():
+    """Tile size, overlap and worker pool for the detectors"""
+    return {
+        "tile_size": app.config['TILE_SIZE'],
+        "overlap": app.config['TILE_OVERLAP'],
+        "workers": app.config['WORKERS'],
+        "backend": app.config['WORKER_BACKEND']
+    }
+
+# Contour colour per analysis in the combined /analyze image
+ANALYSIS_COLORS = {
+    'trees': (0, 255, 0),
+    'areas': (255, 0, 0),
+    'diseases': (0, 0, 255),
+    'objects': (0, 255, 255)
+}
+
+def stitch_settings():
+    """Stitching settings that change the mosaic"""
+    return {
+        "group_size": app.config['STITCH_GROUP_SIZE'],
+        "work_megapix": app.config['STITCH_WORK_MEGAPIX'],
+        "max_mosaic_megapix": app.config['STITCH_MAX_MOSAIC_MEGAPIX'],
+        "mode": app.config['STITCH_MODE'],
+        "pairing": app.config['STITCH_PAIRING'],
+        "neighbours": app.config['STITCH_NEIGHBOURS'],
+        "detector": app.config['STITCH_DETECTOR']
+    }
+
+def stitch_options():
+    """Stitching settings and worker pool shared by /stitch and stitch jobs"""
+    return dict(stitch_settings(), workers=app.config['WORKERS'], backend=app.config['WORKER_BACKEND'],
+                feature_cache=app.config['FEATURE_CACHE_FOLDER'])
+
+def requested_analyses():
+    """Analyses named in the form as repeated or comma-separated fields, all by default"""
+    names = [name.strip() for value in request.form.getlist('analyses') for name in value.split(',') if name.strip()]
+    return names or list(DETECTORS)
+
+@metrics.timed('annotate')
+def annotate(img, layers):
+    """Draw (contours, colour) layers and return the drawn image and its scale
+
+    Images within PREVIEW_MAX_SIDE are drawn on in place. Larger ones are
+    downscaled once and the contours scaled to match, so no full-size copy
+    is made for drawing.
+    """
+    max_side = app.config['PREVIEW_MAX_SIDE']
+    height, width = img.shape[:2]
+    scale = 1.0
+    if max_side and max(height, width) > max_side:
+        scale = max_side / max(height, width)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    for contours, color in layers:
+        if scale != 1.0:
+            contours = [np.round(cnt * scale).astype(np.int32) for cnt in contours]
+        cv2.drawContours(img, contours, -1, color, 2)
+    return img, scale
+
+def store_detections(name, found):
+    """Save {analysis: contours} as a detection table; returns it and the fields pointing to it"""
+    table, vertices, offsets = detections.to_table(found)
+    detections_id = detection_store.save(name, table, vertices, offsets)
+    return table, {"detections_id": detections_id, "detections_url": f"/detections/{detections_id}"}
+
+def analyze_image(img, names):
+    """Run the named analyses on img, drawing each in its own colour
+
+    Returns the results, the fields pointing to the stored detections,
+    the annotated image and its scale.
+    """
+    # Masks share the grayscale, blur and HSV stages tile by tile
+    found = detect_many(names, img, **tiling_options())
+    # Very many boxes are only served a page at a time from detections_url
+    limit = app.config['DETECTIONS_INLINE_LIMIT']
+    results = {name: summarize(name, contours, limit) for name, contours in found.items()}
+    _, stored = store_detections('analyzed', found)
+    annotated, scale = annotate(img, [(contours, ANALYSIS_COLORS[name]) for name, contours in found.items()])
+    return results, stored, annotated, scale
+
+def multipart_response(fields, data, image_mimetype):
+    """Stream metadata and image bytes as a multipart/mixed body"""
+    boundary = uuid.uuid4().hex
+    
+    def parts():
+        yield f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode()
+        yield json.dumps(fields).encode()
+        yield f"\r\n--{boundary}\r\nContent-Type: {image_mimetype}\r\nContent-Length: {len(data)}\r\n\r\n".encode()
+        yield data
+        yield f"\r\n--{boundary}--\r\n".encode()
+    
+    return Response(parts(), mimetype=f"multipart/mixed; boundary={boundary}")
+
+def spool_request_upload(file):
+    """Spool an upload to UPLOAD_FOLDER; the copy is removed when the request ends"""
+    upload = spool_upload(file, app.config['UPLOAD_FOLDER'])
+    g.setdefault('uploads', []).append(upload)
+    return upload
+
+def requested_reduce():
+    """Decode reduction factor (1, 2, 4 or 8) asked for, or None when invalid"""
+    try:
+        return parse_reduce(request.values.get('reduce'))
+    except ValueError:
+        return None
+
+def requested_screen():
+    """Screening factor asked for (0 for none, 2, 4 or 8), or None when invalid"""
+    value = request.values.get('screen')
+    if value is None or value == '':
+        return app.config['SCREEN_FACTOR']
+    try:
+        factor = int(value)
+    except ValueError:
+        return None
+    return factor if factor == 0 or factor in SCREEN_FACTORS else None
+
+def screening(factor):
+    """Screen detect() uses for a screening factor, or None to trace the whole image"""
+    return Screen(factor, app.config['SCREEN_MARGIN']) if factor else None
+
+@app.teardown_request
+def discard_uploads(exc):
+    for upload in g.pop('uploads', []):
+        upload.discard()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if app.config['PROFILE_SLOW_SECONDS'] > 0:
+        g.profile = profiler.start()
 
-def save_base64_image(base64_string, filename):
-    """Save base64 image to file"""
-    image_data = base64.b64decode(base64_string)
-    with open(filename, 'wb') as f:
-        f.write(image_data)
+@app.before_request
+def admit_request():
+    """Hold a CPU-heavy request until it gets a slot, or turn it away with 503"""
+    if not admission.limited(request.endpoint):
+        return None
+    # Read the whole upload first, so a slow client does not hold a slot
+    request.files
+    try:
+        admission.acquire(request.endpoint)
+    except Overloaded as e:
+        response = jsonify({"error": f"Server busy: {e}"})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    g.admitted = request.endpoint
+    return None
+
+@app.after_request
+def release_streamed_slot(response):
+    # A streamed body is produced after the request ends, so it keeps its slot until sent
+    endpoint = g.pop('admitted', None)
+    if endpoint is not None:
+        if response.is_streamed:
+            response.call_on_close(lambda: admission.release(endpoint))
+        else:
+            admission.release(endpoint)
+    return response
+
+@app.teardown_request
+def release_slot(exc):
+    # after_request is skipped when the response fails to build
+    endpoint = g.pop('admitted', None)
+    if endpoint is not None:
+        admission.release(endpoint)
+
+@app.after_request
+def record_request_metrics(response):
+    """Observe latency and body size, and keep the profile of a slow request"""
+    elapsed = time.perf_counter() - g.pop('request_start', time.perf_counter())
+    endpoint = request.endpoint or 'unmatched'
+    metrics.REQUEST_SECONDS.observe(elapsed, endpoint, str(response.status_code))
+    if request.content_length:
+        metrics.REQUEST_BYTES.observe(request.content_length, endpoint)
+    
+    token = g.pop('profile', None)
+    if token is not None:
+        samples = profiler.stop(token)
+        if elapsed > app.config['PROFILE_SLOW_SECONDS'] and samples:
+            path = os.path.join(app.config['PROFILE_FOLDER'], f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-"
+                                f"{uuid.uuid4().hex[:8]}.folded")
+            write_folded(path, samples)
+            logger.warning("Slow request %s %s took %.2fs; profile written to %s", request.method, request.path,
+                           elapsed, path)
+    return response
+
+def requested_delivery():
+    """Delivery mode, format and level asked for; raises ValueError
+
+    The request's delivery, format and quality (or compression) values
+    pick the delivery mode and encoding; PNG in JSON is the default.
+    """
+    delivery = request.values.get('delivery', 'json')
+    if delivery not in DELIVERY_MODES:
+        raise ValueError(f"Unknown delivery mode: {delivery}")
+    level = request.values.get('quality') or request.values.get('compression')
+    fmt, level = parse_encoding(request.values.get('format'), level)
+    return delivery, fmt, level
+
+def request_cache_key(endpoint, digests, **params):
+    """Cache key for this request's inputs, settings and encoding
+
+    None when the requested encoding is invalid; image_response reports it.
+    """
+    try:
+        _, fmt, level = requested_delivery()
+    except ValueError:
+        return None
+    return cache_key(endpoint, digests, format=fmt, level=level, **params)
+
+def cached_response(name, key):
+    """Deliver a cached result, skipping decode and analysis, or None"""
+    if key is None:
+        return None
+    entry = result_cache.get(key)
+    if entry is None:
+        return None
+    fields, data, fmt = entry
+    # Stored detections expire with the results; a response pointing to gone ones is recomputed
+    if 'detections_id' in fields and not detection_store.exists(fields['detections_id']):
+        return None
+    # So do tile pyramids: a hit keeps its tiles as long as the result, and a mosaic
+    # whose tiles were swept is stitched and tiled again
+    if 'tiles_url' in fields:
+        try:
+            os.utime(tiles_directory(fields['tiles_url']))
+        except FileNotFoundError:
+            return None
+    return deliver(name, fields, data, fmt)
+
+def image_response(name, image, fields, key=None):
+    """Encode a result image once, cache it under key and deliver it"""
+    try:
+        _, fmt, level = requested_delivery()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    data = encode_image(image, fmt, level)
+    if key is not None:
+        result_cache.put(key, fields, data, fmt)
+    return deliver(name, fields, data, fmt)
+
+def deliver(name, fields, data, fmt):
+    """Save encoded result bytes and send them the way the request asked"""
+    delivery = request.values.get('delivery', 'json')
+    
+    # Results are named by content, so concurrent requests never share a path
+    # and repeats share one file; the file is written after the response
+    result_id, output_path = result_store.save(name, data, fmt)
+    
+    fields = dict(fields, output_path=output_path, format=fmt)
+    if delivery == 'json':
+        fields['image'] = base64.b64encode(data).decode('utf-8')
+        return jsonify(fields)
+    if delivery == 'url':
+        fields['image_url'] = f"/results/{result_id}"
+        return jsonify(fields)
+    return multipart_response(fields, data, mimetype(fmt))
+
+def build_tiles(tiles_id, image):
+    """Write the tile pyramid of a mosaic and return the fields pointing to it"""
+    from pyramid import build_pyramid
+    directory = os.path.join(app.config['TILES_FOLDER'], tiles_id)
+    metadata = build_pyramid(image, directory, app.config['PYRAMID_TILE_SIZE'], app.config['PYRAMID_FORMAT'],
+                             workers=app.config['WORKERS'])
+    return {
+        "tiles_url": f"/tiles/{tiles_id}/{{z}}/{{x}}/{{y}}{metadata['extension']}",
+        "tiles": metadata
+    }
+
+def tiles_directory(tiles_url):
+    """Directory of the tile pyramid a tiles_url from build_tiles points to"""
+    return os.path.join(app.config['TILES_FOLDER'], secure_filename(tiles_url.split('/')[2]))
 
 @app.route('/')
 def home():
@@ -55,18 +506,50 @@ def api_info():
             "count_trees": "/count-trees",
             "detect_areas": "/detect-areas",
             "detect_diseases": "/detect-diseases",
-            "count_objects": "/count-objects"
+            "count_objects": "/count-objects",
+            "analyze": "/analyze",
+            "batch": "/batch/<analysis>",
+            "vegetation_index": "/vegetation-index",
+            "zonal_stats": "/zonal-stats",
+            "result": "/results/<id>",
+            "detections": "/detections/<id>",
+            "detection_rows": "/detections/<id>/rows",
+            "tiles": "/tiles/<id>/<z>/<x>/<y>",
+            "sessions": "/sessions",
+            "session_frames": "/sessions/<id>/frames",
+            "session_mosaic": "/sessions/<id>/mosaic",
+            "history": "/history",
+            "field_flights": "/history/<field>/flights",
+            "field_trend": "/history/<field>/trend",
+            "flight_zones": "/history/<field>/<date>/zones",
+            "stitch_job": "/jobs/stitch",
+            "analyze_job": "/jobs/analyze",
+            "job_status": "/jobs/<id>",
+            "cache_stats": "/cache/stats",
+            "admission_stats": "/admission/stats",
+            "metrics": "/metrics"
         }
     })
 
+@app.route('/cache/stats')
+def cache_stats():
+    """Hit, miss and eviction counters of this worker's result cache"""
+    return jsonify(result_cache.stats())
+
+@app.route('/admission/stats')
+def admission_stats():
+    """Active, waiting and rejected requests per limited endpoint in this worker"""
+    return jsonify(admission.stats())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Request and stage histograms of this worker, labelled with its pid, in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/test', methods=['POST'])
 def test_endpoint():
     """Test endpoint to verify backend is working"""
-    print("=== TEST ENDPOINT CALLED ===")
-    print(f"Request method: {request.method}")
-    print(f"Request headers: {dict(request.headers)}")
-    print(f"Request files: {request.files}")
-    print(f"Request form: {request.form}")
+    logger.debug("Test request: headers %s, files %s, form %s", request.headers, request.files, request.form)
     
     return jsonify({
         "success": True,
@@ -78,161 +561,119 @@ def test_endpoint():
 @app.route('/stitch', methods=['POST'])
 def stitch_images():
     """Stitch multiple images together"""
+    from stitch import StitchError, stitch_frames
     try:
-        print("=== STITCH ENDPOINT CALLED ===")
-        print(f"Request files: {request.files}")
-        print(f"Request form: {request.form}")
-        
         if 'images' not in request.files:
-            print("ERROR: No 'images' in request.files")
+            logger.info("Stitch request without 'images'")
             return jsonify({"error": "No images provided"}), 400
         
         files = request.files.getlist('images')
-        print(f"Files received: {len(files)} files")
+        logger.debug("Stitch request with %d files", len(files))
         
         if not files or files[0].filename == '':
-            print("ERROR: No files selected or empty filename")
+            logger.info("Stitch request with no files selected")
             return jsonify({"error": "No images selected"}), 400
         
-        images = []
-        for i, file in enumerate(files):
-            print(f"Processing file {i+1}: {file.filename}")
-            if file and allowed_file(file.filename):
-                # Read image directly from file
-                file_bytes = file.read()
-                print(f"File {i+1} size: {len(file_bytes)} bytes")
-                nparr = np.frombuffer(file_bytes, np.uint8)
-                img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                if img is not None:
-                    print(f"File {i+1} loaded successfully, shape: {img.shape}")
-                    images.append(img)
+        # Spool uploads to disk so only one stitch group is decoded at a time
+        with tempfile.TemporaryDirectory(dir=app.config['UPLOAD_FOLDER']) as frame_dir:
+            frame_paths, frame_digests = [], []
+            for i, file in enumerate(files):
+                if file and allowed_file(file.filename):
+                    # Frames go to disk chunk by chunk and are decoded group by group
+                    upload = spool_upload(file, frame_dir, f"{i:05d}_{secure_filename(file.filename)}")
+                    frame_digests.append(upload.digest)
+                    frame_paths.append(upload.path)
                 else:
-                    print(f"ERROR: Could not decode file {i+1}")
-            else:
-                print(f"ERROR: File {i+1} not allowed or invalid")
-        
-        if len(images) < 2:
-            return jsonify({"error": "At least 2 images required for stitching"}), 400
-        
-        # Create image stitcher
-        imageStitcher = cv2.Stitcher_create()
-        error, stitched_img = imageStitcher.stitch(images)
-        
-        if error:
-            return jsonify({"error": "Images could not be stitched. Not enough keypoints detected."}), 400
-        
-        # Process the stitched image
-        stitched_img = cv2.copyMakeBorder(stitched_img, 10, 10, 10, 10, cv2.BORDER_CONSTANT, (0,0,0))
-        gray = cv2.cvtColor(stitched_img, cv2.COLOR_BGR2GRAY)
-        thresh_img = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY)[1]
-        
-        contours = cv2.findContours(thresh_img.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        contours = imutils.grab_contours(contours)
-        
-        if contours:
-            areaOI = max(contours, key=cv2.contourArea)
-            mask = np.zeros(thresh_img.shape, dtype="uint8")
-            x, y, w, h = cv2.boundingRect(areaOI)
-            cv2.rectangle(mask, (x,y), (x + w, y + h), 255, -1)
+                    logger.info("Skipping stitch file %d, %r: not an allowed image", i + 1, file.filename)
             
-            minRectangle = mask.copy()
-            sub = mask.copy()
+            if len(frame_paths) < 2:
+                return jsonify({"error": "At least 2 images required for stitching"}), 400
             
-            while cv2.countNonZero(sub) > 0:
-                minRectangle = cv2.erode(minRectangle, None)
-                sub = cv2.subtract(minRectangle, thresh_img)
+            # The same frames in the same order give the same mosaic
+            key = request_cache_key('stitch', frame_digests, **stitch_settings())
+            cached = cached_response('stitched_output', key)
+            if cached is not None:
+                return cached
             
-            contours = cv2.findContours(minRectangle.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            contours = imutils.grab_contours(contours)
-            
-            if contours:
-                areaOI = max(contours, key=cv2.contourArea)
-                x, y, w, h = cv2.boundingRect(areaOI)
-                stitched_img = stitched_img[y:y + h, x:x + w]
+            try:
+                stitched_img = stitch_frames(frame_paths, workdir=frame_dir, digests=frame_digests, **stitch_options())
+            except StitchError as e:
+                return jsonify({"error": str(e)}), 400
         
-        # Save processed image
-        output_path = os.path.join(app.config['PROCESSED_FOLDER'], 'stitched_output.png')
-        cv2.imwrite(output_path, stitched_img)
+        # Crop the black border to the largest fully covered rectangle
+        stitched_img = crop_to_valid(stitched_img)
         
-        # Convert to base64 for response
-        _, buffer = cv2.imencode('.png', stitched_img)
-        img_base64 = base64.b64encode(buffer).decode('utf-8')
+        # Tiles let a viewer fetch only what is on screen; every encoding shares them
+        tiles = build_tiles(cache_key('stitch-tiles', frame_digests, **stitch_settings()), stitched_img)
         
-        return jsonify({
+        # Encode once for both the saved copy and the response
+        return image_response('stitched_output', stitched_img, dict({
             "success": True,
-            "message": "Images stitched successfully",
-            "image": img_base64,
-            "output_path": output_path
-        })
+            "message": "Images stitched successfully"
+        }, **tiles), key)
         
     except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
         return jsonify({"error": str(e)}), 500
 
 @app.route('/count-trees', methods=['POST'])
 def count_trees():
     """Count trees in an image"""
     try:
-        print("=== COUNT TREES ENDPOINT CALLED ===")
-        print(f"Request files: {request.files}")
-        
         if 'image' not in request.files:
-            print("ERROR: No 'image' in request.files")
+            logger.info("Count trees request without 'image'")
             return jsonify({"error": "No image provided"}), 400
         
         file = request.files['image']
-        print(f"File received: {file.filename}")
+        logger.debug("Count trees request for %r", file.filename)
         
         if file.filename == '':
-            print("ERROR: Empty filename")
+            logger.info("Count trees request with an empty filename")
             return jsonify({"error": "No image selected"}), 400
         
         if file and allowed_file(file.filename):
-            # Read image
-            file_bytes = file.read()
-            nparr = np.frombuffer(file_bytes, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            if img is None:
-                return jsonify({"error": "Invalid image file"}), 400
+            reduce = requested_reduce()
+            if reduce is None:
+                return jsonify({"error": "reduce must be 1, 2, 4 or 8"}), 400
+            factor = requested_screen()
+            if factor is None:
+                return jsonify({"error": "screen must be 0, 2, 4 or 8"}), 400
             
-            # Convert to grayscale
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            # Spool the upload to disk, hashing it on the way
+            upload = spool_request_upload(file)
+            # Repeated uploads with the same settings are answered from the cache
+            key = request_cache_key('count-trees', [upload.digest], reduce=reduce, screen=screening(factor),
+                                    preview=app.config['PREVIEW_MAX_SIDE'])
+            cached = cached_response('detected_trees', key)
+            if cached is not None:
+                return cached
             
-            # Apply Gaussian blur
-            blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+            # Read image, freeing the spooled copy
+            img = upload.decode(reduce)
             
-            # Apply adaptive thresholding
-            binary = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 11, 4)
-            
-            # Find contours
-            contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            if img is None:
+                return jsonify({"error": "Invalid image file"}), 400
             
-            # Filter contours based on area
-            min_area = 1000
-            valid_contours = [cnt for cnt in contours if cv2.contourArea(cnt) > min_area]
+            # Find tree contours tile by tile
+            valid_contours = detect('trees', img, screen=screening(factor), **tiling_options())
             
-            # Draw contours on the original image
-            img_contours = cv2.drawContours(img.copy(), valid_contours, -1, (0, 255, 0), 2)
+            # Draw contours on the decoded image, which is not needed afterwards,
+            # or on a preview of it when it is large
+            img_contours, scale = annotate(img, [(valid_contours, (0, 255, 0))])
             
             # Count trees
             num_trees = len(valid_contours)
+            _, stored = store_detections('trees', {'trees': valid_contours})
             
-            # Save result image
-            output_path = os.path.join(app.config['PROCESSED_FOLDER'], 'detected_trees.png')
-            cv2.imwrite(output_path, img_contours)
-            
-            # Convert to base64
-            _, buffer = cv2.imencode('.png', img_contours)
-            img_base64 = base64.b64encode(buffer).decode('utf-8')
-            
-            return jsonify({
+            # Encode once for both the saved copy and the response
+            return image_response('detected_trees', img_contours, dict({
                 "success": True,
                 "tree_count": num_trees,
-                "image": img_base64,
-                "output_path": output_path
-            })
+                "preview_scale": scale
+            }, **stored), key)
         
     except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
         return jsonify({"error": str(e)}), 500
 
 @app.route('/detect-areas', methods=['POST'])
@@ -247,50 +688,47 @@ def detect_areas():
             return jsonify({"error": "No image selected"}), 400
         
         if file and allowed_file(file.filename):
-            # Read image
-            file_bytes = file.read()
-            nparr = np.frombuffer(file_bytes, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            reduce = requested_reduce()
+            if reduce is None:
+                return jsonify({"error": "reduce must be 1, 2, 4 or 8"}), 400
             
-            if img is None:
-                return jsonify({"error": "Invalid image file"}), 400
-            
-            # Convert to grayscale
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            # Spool the upload to disk, hashing it on the way
+            upload = spool_request_upload(file)
+            # Repeated uploads with the same settings are answered from the cache
+            key = request_cache_key('detect-areas', [upload.digest], reduce=reduce,
+                                    preview=app.config['PREVIEW_MAX_SIDE'])
+            cached = cached_response('detected_areas', key)
+            if cached is not None:
+                return cached
             
-            # Apply Gaussian blur
-            blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+            # Read image, freeing the spooled copy
+            img = upload.decode(reduce)
             
-            # Apply thresholding
-            _, thresh = cv2.threshold(blurred, 150, 255, cv2.THRESH_BINARY_INV)
+            if img is None:
+                return jsonify({"error": "Invalid image file"}), 400
             
-            # Find contours
-            contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            # Find area contours tile by tile
+            contours = detect('areas', img, **tiling_options())
             
             # Draw contours
-            result = img.copy()
-            cv2.drawContours(result, contours, -1, (0, 255, 0), 2)
+            result, scale = annotate(img, [(contours, (0, 255, 0))])
             
-            # Calculate bounding boxes
-            boxes = [cv2.boundingRect(cnt) for cnt in contours]
-            
-            # Save result image
-            output_path = os.path.join(app.config['PROCESSED_FOLDER'], 'detected_areas.png')
-            cv2.imwrite(output_path, result)
-            
-            # Convert to base64
-            _, buffer = cv2.imencode('.png', result)
-            img_base64 = base64.b64encode(buffer).decode('utf-8')
-            
-            return jsonify({
+            # Bounding boxes are computed for all areas at once and stored as arrays
+            table, stored = store_detections('areas', {'areas': contours})
+            fields = dict({
                 "success": True,
-                "detected_areas": len(boxes),
-                "bounding_boxes": boxes,
-                "image": img_base64,
-                "output_path": output_path
-            })
+                "detected_areas": len(table),
+                "preview_scale": scale
+            }, **stored)
+            # Very many boxes are only served a page at a time from detections_url
+            if len(table) <= app.config['DETECTIONS_INLINE_LIMIT']:
+                fields["bounding_boxes"] = detections.boxes(table).tolist()
+            
+            # Encode once for both the saved copy and the response
+            return image_response('detected_areas', result, fields, key)
         
     except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
         return jsonify({"error": str(e)}), 500
 
 @app.route('/detect-diseases', methods=['POST'])
@@ -305,62 +743,233 @@ def detect_diseases():
             return jsonify({"error": "No image selected"}), 400
         
         if file and allowed_file(file.filename):
-            # Read image
-            file_bytes = file.read()
-            nparr = np.frombuffer(file_bytes, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            reduce = requested_reduce()
+            if reduce is None:
+                return jsonify({"error": "reduce must be 1, 2, 4 or 8"}), 400
+            factor = requested_screen()
+            if factor is None:
+                return jsonify({"error": "screen must be 0, 2, 4 or 8"}), 400
+            
+            # Spool the upload to disk, hashing it on the way
+            upload = spool_request_upload(file)
+            # Repeated uploads with the same settings are answered from the cache
+            key = request_cache_key('detect-diseases', [upload.digest], reduce=reduce, screen=screening(factor),
+                                    preview=app.config['PREVIEW_MAX_SIDE'])
+            cached = cached_response('detected_diseases', key)
+            if cached is not None:
+                return cached
+            
+            # Read image, freeing the spooled copy
+            img = upload.decode(reduce)
             
             if img is None:
                 return jsonify({"error": "Invalid image file"}), 400
             
-            # Convert to HSV
-            hsv_image = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+            # Find disease spot contours tile by tile
+            detected_diseases = detect('diseases', img, screen=screening(factor), **tiling_options())
             
-            # Define color range for disease detection
-            lower_color = np.array([0, 50, 50])
-            upper_color = np.array([10, 255, 255])
+            # Draw contours
+            result_image, scale = annotate(img, [(detected_diseases, (0, 255, 0))])
             
-            # Create mask
-            mask = cv2.inRange(hsv_image, lower_color, upper_color)
+            _, stored = store_detections('diseases', {'diseases': detected_diseases})
             
-            # Apply blurring and morphological operations
-            blurred = cv2.GaussianBlur(mask, (11, 11), 0)
-            kernel = np.ones((5, 5), np.uint8)
-            morphed = cv2.morphologyEx(blurred, cv2.MORPH_CLOSE, kernel)
+            # Encode once for both the saved copy and the response
+            return image_response('detected_diseases', result_image, dict({
+                "success": True,
+                "disease_count": len(detected_diseases),
+                "preview_scale": scale
+            }, **stored), key)
+        
+    except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/count-objects', methods=['POST'])
+def count_objects():
+    """Count green objects in an image"""
+    try:
+        if 'image' not in request.files:
+            return jsonify({"error": "No image provided"}), 400
+        
+        file = request.files['image']
+        if file.filename == '':
+            return jsonify({"error": "No image selected"}), 400
+        
+        if file and allowed_file(file.filename):
+            reduce = requested_reduce()
+            if reduce is None:
+                return jsonify({"error": "reduce must be 1, 2, 4 or 8"}), 400
+            factor = requested_screen()
+            if factor is None:
+                return jsonify({"error": "screen must be 0, 2, 4 or 8"}), 400
+            
+            # Spool the upload to disk, hashing it on the way
+            upload = spool_request_upload(file)
+            # Repeated uploads with the same settings are answered from the cache
+            key = request_cache_key('count-objects', [upload.digest], reduce=reduce, screen=screening(factor),
+                                    preview=app.config['PREVIEW_MAX_SIDE'])
+            cached = cached_response('counted_objects', key)
+            if cached is not None:
+                return cached
+            
+            # Read image, freeing the spooled copy
+            img = upload.decode(reduce)
             
-            # Find contours
-            contours, _ = cv2.findContours(morphed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            if img is None:
+                return jsonify({"error": "Invalid image file"}), 400
             
-            # Filter contours
-            min_area = 100
-            max_area = 1000
-            detected_diseases = [cnt for cnt in contours if min_area < cv2.contourArea(cnt) < max_area and cv2.isContourConvex(cnt)]
+            # Find large object contours tile by tile
+            large_contours = detect('objects', img, screen=screening(factor), **tiling_options())
+            
+            # Count objects
+            object_count = len(large_contours)
             
             # Draw contours
-            result_image = img.copy()
-            cv2.drawContours(result_image, detected_diseases, -1, (0, 255, 0), 2)
+            result_image, scale = annotate(img, [(large_contours, (0, 255, 0))])
+            _, stored = store_detections('objects', {'objects': large_contours})
+            
+            # Encode once for both the saved copy and the response
+            return image_response('counted_objects', result_image, dict({
+                "success": True,
+                "object_count": object_count,
+                "preview_scale": scale
+            }, **stored), key)
+        
+    except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/analyze', methods=['POST'])
+def analyze():
+    """Run several analyses on one upload, sharing decode and filtering"""
+    try:
+        if 'image' not in request.files:
+            return jsonify({"error": "No image provided"}), 400
+        
+        file = request.files['image']
+        if file.filename == '':
+            return jsonify({"error": "No image selected"}), 400
+        
+        names = requested_analyses()
+        unknown = [name for name in names if name not in DETECTORS]
+        if unknown:
+            return jsonify({"error": f"Unknown analyses: {', '.join(unknown)}"}), 400
+        
+        if file and allowed_file(file.filename):
+            reduce = requested_reduce()
+            if reduce is None:
+                return jsonify({"error": "reduce must be 1, 2, 4 or 8"}), 400
+            
+            # Spool the upload to disk, hashing it on the way
+            upload = spool_request_upload(file)
+            # Repeated uploads with the same settings are answered from the cache
+            key = request_cache_key('analyze', [upload.digest], analyses=names, reduce=reduce,
+                                    preview=app.config['PREVIEW_MAX_SIDE'])
+            cached = cached_response('analyzed', key)
+            if cached is not None:
+                return cached
+            
+            # Read image once for every analysis, freeing the spooled copy
+            img = upload.decode(reduce)
             
-            # Save result image
-            output_path = os.path.join(app.config['PROCESSED_FOLDER'], 'detected_diseases.png')
-            cv2.imwrite(output_path, result_image)
+            if img is None:
+                return jsonify({"error": "Invalid image file"}), 400
             
-            # Convert to base64
-            _, buffer = cv2.imencode('.png', result_image)
-            img_base64 = base64.b64encode(buffer).decode('utf-8')
+            # Draw every analysis on one image
+            results, stored, annotated, scale = analyze_image(img, names)
             
-            return jsonify({
+            # Encode once for both the saved copy and the response
+            return image_response('analyzed', annotated, dict({
                 "success": True,
-                "disease_count": len(detected_diseases),
-                "image": img_base64,
-                "output_path": output_path
-            })
+                "results": results,
+                "preview_scale": scale
+            }, **stored), key)
+        
+        return jsonify({"error": "File type not allowed"}), 400
         
     except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/count-objects', methods=['POST'])
-def count_objects():
-    """Count green objects in an image"""
+def batch_frames():
+    """Frame paths and row labels of a batch request, and the upload directory to remove
+
+    A directory value names a flight directory under BATCH_ROOT; otherwise
+    the uploaded images are spooled to a directory of their own, which
+    outlives the request so the streamed rows can still read them. Raises
+    ValueError for a directory outside BATCH_ROOT or missing.
+    """
+    from stitch import list_frames
+    directory = request.values.get('directory')
+    if directory:
+        root = os.path.realpath(app.config['BATCH_ROOT'])
+        path = os.path.realpath(os.path.join(root, directory))
+        if os.path.commonpath([root, path]) != root or not os.path.isdir(path):
+            raise ValueError(f"Directory not found: {directory}")
+        frames = list_frames(path)
+        return frames, [os.path.relpath(frame, root) for frame in frames], None
+    
+    files = [file for file in request.files.getlist('images') if file and allowed_file(file.filename)]
+    if not files:
+        return [], [], None
+    frame_dir = tempfile.mkdtemp(dir=app.config['UPLOAD_FOLDER'])
+    frames = [spool_upload(file, frame_dir, f"{i:05d}_{secure_filename(file.filename)}").path
+              for i, file in enumerate(files)]
+    return frames, [file.filename for file in files], frame_dir
+
+@app.route('/batch/<analysis>', methods=['POST'])
+def batch_analysis(analysis):
+    """Analyse many frames in one request, streaming a row per frame"""
+    import batch
+    try:
+        if analysis == 'analyze':
+            names = requested_analyses()
+        elif analysis in DETECTORS:
+            names = [analysis]
+        else:
+            return jsonify({"error": f"Unknown analysis: {analysis}"}), 404
+        unknown = [name for name in names if name not in DETECTORS]
+        if unknown:
+            return jsonify({"error": f"Unknown analyses: {', '.join(unknown)}"}), 400
+        names = list(dict.fromkeys(names))
+        
+        output = request.values.get('output', 'ndjson')
+        if output not in ('ndjson', 'csv'):
+            return jsonify({"error": "output must be ndjson or csv"}), 400
+        reduce = requested_reduce()
+        if reduce is None:
+            return jsonify({"error": "reduce must be 1, 2, 4 or 8"}), 400
+        
+        try:
+            frames, labels, frame_dir = batch_frames()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 404
+        if not frames:
+            return jsonify({"error": "No images provided"}), 400
+        logger.info("Batch %s over %d frames", ','.join(names), len(frames))
+        
+        # Rows are produced as the response is sent: frames are read on I/O
+        # threads and analysed on the batch workers, one frame per task
+        rows = batch.analyse_paths(frames, names, app.config['BATCH_WORKERS'], app.config['BATCH_BACKEND'],
+                                   app.config['BATCH_IO_THREADS'], reduce, app.config['TILE_SIZE'],
+                                   app.config['TILE_OVERLAP'], labels, app.config['DETECTIONS_FOLDER'],
+                                   app.config['DETECTIONS_INLINE_LIMIT'])
+        if output == 'csv':
+            response = Response(batch.csv_lines(rows, names), mimetype='text/csv')
+        else:
+            response = Response(batch.ndjson_lines(rows), mimetype='application/x-ndjson')
+        if frame_dir is not None:
+            response.call_on_close(lambda: shutil.rmtree(frame_dir, ignore_errors=True))
+        return response
+        
+    except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/vegetation-index', methods=['POST'])
+def vegetation_index():
+    """Vegetation index raster with per-zone statistics"""
+    from indices import INDICES, index_raster, required_bands
     try:
         if 'image' not in request.files:
             return jsonify({"error": "No image provided"}), 400
@@ -369,52 +978,630 @@ def count_objects():
         if file.filename == '':
             return jsonify({"error": "No image selected"}), 400
         
+        name = request.values.get('index', 'exg').lower()
+        if name not in INDICES:
+            return jsonify({"error": f"Unknown index: {name}. Choose from {', '.join(INDICES)}"}), 400
+        
+        # NIR and red-edge bands come as extra single-band uploads
+        missing = [band for band in required_bands(name) if band not in request.files]
+        if missing:
+            return jsonify({"error": f"Index {name} needs a '{missing[0]}' band upload"}), 400
+        
+        try:
+            zone_size = int(request.values.get('zone_size', app.config['ZONE_SIZE']))
+        except ValueError:
+            return jsonify({"error": "zone_size must be an integer"}), 400
+        if not 1 <= zone_size <= app.config['INDEX_MAX_ZONE_SIZE']:
+            return jsonify({"error": f"zone_size must be between 1 and {app.config['INDEX_MAX_ZONE_SIZE']}"}), 400
+        # output=npy returns the float index values instead of the colourized raster
+        output = request.values.get('output', 'image')
+        if output not in ('image', 'npy'):
+            return jsonify({"error": "output must be image or npy"}), 400
+        
         if file and allowed_file(file.filename):
-            # Read image
-            file_bytes = file.read()
-            nparr = np.frombuffer(file_bytes, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            # Spool the image and its bands to disk, hashing them on the way
+            upload = spool_request_upload(file)
+            band_uploads = {band: spool_request_upload(request.files[band]) for band in required_bands(name)}
+            
+            # Repeated uploads with the same settings are answered from the cache
+            digests = [upload.digest] + [band_uploads[band].digest for band in required_bands(name)]
+            key = request_cache_key('vegetation-index', digests, index=name, zone_size=zone_size)
+            cached = cached_response('vegetation_index', key) if output == 'image' else None
+            if cached is not None:
+                return cached
             
+            img = upload.decode()
             if img is None:
                 return jsonify({"error": "Invalid image file"}), 400
             
-            # Convert to grayscale
-            gray_image = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            # One JSON entry per zone: a small zone_size on a large image would be gigabytes
+            zones = -(-img.shape[0] // zone_size) * -(-img.shape[1] // zone_size)
+            if output == 'image' and zones > app.config['INDEX_MAX_ZONES']:
+                return jsonify({"error": f"zone_size {zone_size} gives {zones} zones, more than "
+                                         f"{app.config['INDEX_MAX_ZONES']}; use a larger zone_size"}), 400
             
-            # Apply binary threshold
-            _, binary_image = cv2.threshold(gray_image, 1, 255, cv2.THRESH_BINARY)
+            # Bands keep their bit depth; the index engine scales them to [0, 1]
+            extra = {}
+            for band, band_upload in band_uploads.items():
+                extra[band] = band_upload.decode(flags=cv2.IMREAD_ANYDEPTH)
+                if extra[band] is None:
+                    return jsonify({"error": f"Invalid {band} band file"}), 400
             
-            # Find contours
-            contours, _ = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            # Float values are written tile by tile into a .npy on disk rather than held in memory
+            values_path = values = None
+            if output == 'npy':
+                fd, values_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.npy')
+                os.close(fd)
+                values = np.lib.format.open_memmap(values_path, mode='w+', dtype=np.float32, shape=img.shape[:2])
+            try:
+                raster, stats = index_raster(name, img, extra, zone_size=zone_size,
+                                             tile_size=app.config['TILE_SIZE'],
+                                             workers=app.config['WORKERS'],
+                                             backend=app.config['WORKER_BACKEND'],
+                                             values_out=values, values_only=output == 'npy')
+            except Exception as e:
+                if values_path:
+                    del values
+                    os.remove(values_path)
+                if isinstance(e, ValueError):
+                    return jsonify({"error": str(e)}), 400
+                raise
             
-            # Filter by area
-            min_area_threshold = 2000
-            large_contours = [cnt for cnt in contours if cv2.contourArea(cnt) > min_area_threshold]
+            if values_path:
+                values.flush()
+                del values
+                # The open file outlives its name, so nothing is left behind once it is sent
+                values_file = open(values_path, 'rb')
+                os.remove(values_path)
+                return send_file(values_file, mimetype='application/octet-stream', as_attachment=True,
+                                 download_name=f"{name}.npy")
             
-            # Count objects
-            object_count = len(large_contours)
+            # Encode once for both the saved copy and the response
+            return image_response('vegetation_index', raster, {
+                "success": True,
+                "index": name,
+                "value_range": INDICES[name][2],
+                "zone_size": zone_size,
+                "summary": stats.summary(),
+                "zones": stats.zones()
+            }, key)
+        
+        return jsonify({"error": "File type not allowed"}), 400
+        
+    except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/zonal-stats', methods=['POST'])
+def zone_statistics():
+    """Disease fraction, green cover and index means per plot or detected area"""
+    from indices import INDICES
+    from zonal import DEFAULT_INDICES, polygons_from_json, zonal_stats
+    try:
+        if 'image' not in request.files:
+            return jsonify({"error": "No image provided"}), 400
+        
+        file = request.files['image']
+        if file.filename == '':
+            return jsonify({"error": "No image selected"}), 400
+        
+        index_names = [name.strip() for name in request.values.get('indices', ','.join(DEFAULT_INDICES)).split(',') if name.strip()]
+        unknown = [name for name in index_names if name not in INDICES]
+        if unknown:
+            return jsonify({"error": f"Unknown index: {', '.join(unknown)}"}), 400
+        
+        # Plot polygons are optional; the detected areas are used without them
+        zones_json = request.values.get('zones')
+        zones = None
+        if zones_json:
+            try:
+                zones = polygons_from_json(json.loads(zones_json))
+            except json.JSONDecodeError:
+                return jsonify({"error": "zones must be a JSON list of [[x, y], ...] polygons"}), 400
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        
+        if file and allowed_file(file.filename):
+            # Spool the upload to disk, hashing it on the way
+            upload = spool_request_upload(file)
             
-            # Draw contours
-            result_image = img.copy()
-            cv2.drawContours(result_image, large_contours, -1, (0, 255, 0), 2)
+            # Repeated uploads with the same settings are answered from the cache
+            key = request_cache_key('zonal-stats', [upload.digest], indices=index_names, zones=zones_json,
+                                    preview=app.config['PREVIEW_MAX_SIDE'])
+            cached = cached_response('zonal_stats', key)
+            if cached is not None:
+                return cached
             
-            # Save result image
-            output_path = os.path.join(app.config['PROCESSED_FOLDER'], 'counted_objects.png')
-            cv2.imwrite(output_path, result_image)
+            img = upload.decode()
+            if img is None:
+                return jsonify({"error": "Invalid image file"}), 400
             
-            # Convert to base64
-            _, buffer = cv2.imencode('.png', result_image)
-            img_base64 = base64.b64encode(buffer).decode('utf-8')
+            # One labelling pass over the image for every zone
+            if zones is None:
+                zones = detect('areas', img, **tiling_options())
+            results = zonal_stats(img, zones, index_names, **tiling_options())
             
-            return jsonify({
+            # Draw zone outlines
+            annotated, scale = annotate(img, [(zones, (0, 255, 0))])
+            
+            # Encode once for both the saved copy and the response
+            return image_response('zonal_stats', annotated, {
                 "success": True,
-                "object_count": object_count,
-                "image": img_base64,
-                "output_path": output_path
-            })
+                "zone_count": len(results),
+                "zones": results,
+                "preview_scale": scale
+            }, key)
+        
+        return jsonify({"error": "File type not allowed"}), 400
+        
+    except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/results/<result_id>')
+def get_result(result_id):
+    """Result image saved by a request, from memory until it is written"""
+    pending = result_store.get(result_id)
+    if pending is not None:
+        data, fmt = pending
+        return Response(data, mimetype=mimetype(fmt), headers={"Cache-Control": "public, max-age=3600"})
+    return send_from_directory(os.path.abspath(app.config['RESULTS_FOLDER']), result_id, max_age=3600)
+
+def requested_rows(detections_found, streamed):
+    """Row indices asked for by offset, limit, bbox and classes; raises ValueError"""
+    bbox = request.values.get('bbox')
+    if bbox:
+        bbox = [float(value) for value in bbox.split(',')]
+        if len(bbox) != 4:
+            raise ValueError("bbox must be x0,y0,x1,y1")
+    classes = request.values.get('classes')
+    if classes:
+        classes = [name.strip() for name in classes.split(',') if name.strip()]
+        unknown = [name for name in classes if name not in detections.CLASSES]
+        if unknown:
+            raise ValueError(f"Unknown classes: {', '.join(unknown)}")
+    offset = int(request.values.get('offset', 0))
+    # A JSON page is built in memory, so it is bounded; streamed output is not
+    page_limit = None if streamed else app.config['DETECTIONS_PAGE_LIMIT']
+    limit = request.values.get('limit')
+    limit = page_limit if limit is None else int(limit)
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError("offset and limit must not be negative")
+    if page_limit is not None and limit > page_limit:
+        raise ValueError(f"limit must be at most {page_limit}")
+    indices = detections_found.select(bbox or None, classes or None)
+    return indices, offset, limit
+
+@app.route('/detections/<detections_id>')
+def detections_summary(detections_id):
+    """Count and total area per class of stored detections, without the rows"""
+    found = detection_store.load(secure_filename(detections_id))
+    if found is None:
+        return jsonify({"error": "Detections not found"}), 404
+    return jsonify(dict(found.summary(), detections_id=detections_id,
+                        rows_url=f"/detections/{detections_id}/rows",
+                        arrays={name: f"/detections/{detections_id}/{name}.npy" for name in detections.ARRAYS}))
+
+@app.route('/detections/<detections_id>/rows')
+def detection_rows(detections_id):
+    """A page of stored detections as JSON, or a range of them streamed as NDJSON, CSV or GeoJSON"""
+    found = detection_store.load(secure_filename(detections_id))
+    if found is None:
+        return jsonify({"error": "Detections not found"}), 404
+    output = request.values.get('output', 'json')
+    if output not in ('json', 'ndjson', 'csv', 'geojson'):
+        return jsonify({"error": "output must be json, ndjson, csv or geojson"}), 400
+    try:
+        indices, offset, limit = requested_rows(found, output != 'json')
+        # polygons=<tolerance> adds contours simplified to within that many pixels
+        tolerance = request.values.get('polygons')
+        if tolerance is not None:
+            tolerance = float(tolerance or detections.DEFAULT_TOLERANCE)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    total = len(indices)
+    indices = indices[offset:] if limit is None else indices[offset:offset + limit]
+    if output == 'ndjson':
+        from batch import ndjson_lines
+        return Response(ndjson_lines(found.rows(indices, tolerance)), mimetype='application/x-ndjson')
+    if output == 'csv':
+        return Response(detections.csv_lines(found, indices), mimetype='text/csv')
+    if output == 'geojson':
+        return Response(detections.geojson_lines(found, indices, detections.DEFAULT_TOLERANCE
+                                                 if tolerance is None else tolerance),
+                        mimetype='application/geo+json')
+    
+    fields = {"total": total, "offset": offset, "limit": limit, "detections": list(found.rows(indices, tolerance))}
+    if indices.size and offset + len(indices) < total:
+        query = request.args.to_dict()
+        query.update(offset=offset + len(indices), limit=limit)
+        fields["next"] = f"/detections/{detections_id}/rows?{urlencode(query)}"
+    return jsonify(fields)
+
+@app.route('/detections/<detections_id>/<array>.npy')
+def detection_array(detections_id, array):
+    """A stored .npy array as is; fixed-size rows make byte ranges of it pages"""
+    if array not in detections.ARRAYS:
+        return jsonify({"error": "Array not found"}), 404
+    directory = os.path.abspath(detection_store.path(secure_filename(detections_id)))
+    return send_from_directory(directory, array + '.npy', mimetype='application/octet-stream', max_age=3600)
+
+@app.route('/tiles/<tiles_id>')
+def tiles_info(tiles_id):
+    """Size, zoom range and format of a tile pyramid"""
+    from pyramid import read_metadata
+    metadata = read_metadata(os.path.join(app.config['TILES_FOLDER'], secure_filename(tiles_id)))
+    if metadata is None:
+        return jsonify({"error": "Tiles not found"}), 404
+    return jsonify(metadata)
+
+@app.route('/tiles/<tiles_id>/<int:z>/<int:x>/<y>')
+def get_tile(tiles_id, z, x, y):
+    """One pyramid tile straight from disk; tiles never change once written"""
+    from pyramid import read_metadata
+    directory = os.path.abspath(os.path.join(app.config['TILES_FOLDER'], secure_filename(tiles_id)))
+    metadata = read_metadata(directory)
+    row = y.split('.', 1)[0]
+    if metadata is None or not row.isdigit():
+        return jsonify({"error": "Tile not found"}), 404
+    
+    # Tiles missing inside the pyramid are empty mosaic border
+    tile = os.path.join(str(z), str(x), row + metadata['extension'])
+    if not os.path.exists(os.path.join(directory, tile)):
+        return jsonify({"error": "Tile not found"}), 404
+    response = send_from_directory(directory, tile, max_age=app.config['PYRAMID_MAX_AGE'])
+    response.cache_control.immutable = True
+    return response
+
+def open_mosaic_session(session_id):
+    """The mosaic session with this id, or None"""
+    from incremental import MosaicSession
+    directory = os.path.join(app.config['SESSIONS_FOLDER'], secure_filename(session_id))
+    try:
+        return MosaicSession(directory)
+    except FileNotFoundError:
+        return None
+
+def add_session_frames(session, files):
+    """Spool uploaded frames and place them on a session's mosaic"""
+    with tempfile.TemporaryDirectory(dir=app.config['UPLOAD_FOLDER']) as frame_dir:
+        paths, digests, names = [], [], []
+        for i, file in enumerate(files):
+            if file and allowed_file(file.filename):
+                upload = spool_upload(file, frame_dir, f"{i:05d}_{secure_filename(file.filename)}")
+                paths.append(upload.path)
+                digests.append(upload.digest)
+                names.append(file.filename)
+        added, skipped = session.add_frames(paths, digests, names)
+    return dict(session.summary(), added=added, skipped=skipped)
+
+@app.route('/sessions', methods=['POST'])
+def create_session():
+    """Start an incremental mosaic, optionally with a first batch of frames"""
+    from incremental import MosaicSession
+    try:
+        session_id = uuid.uuid4().hex
+        session = MosaicSession.create(os.path.join(app.config['SESSIONS_FOLDER'], session_id),
+                                       work_megapix=app.config['STITCH_WORK_MEGAPIX'])
+        result = add_session_frames(session, request.files.getlist('images'))
+        return jsonify(dict(result, success=True, session_id=session_id)), 201
+        
+    except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/sessions/<session_id>')
+def session_info(session_id):
+    """Frame count and canvas size of a mosaic session"""
+    session = open_mosaic_session(session_id)
+    if session is None:
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify(dict(session.summary(), frame_names=[frame['name'] for frame in session.frames]))
+
+@app.route('/sessions/<session_id>/frames', methods=['POST'])
+def add_frames_to_session(session_id):
+    """Match new frames against their neighbours and composite them onto the mosaic"""
+    try:
+        session = open_mosaic_session(session_id)
+        if session is None:
+            return jsonify({"error": "Session not found"}), 404
+        
+        files = request.files.getlist('images')
+        if not files or files[0].filename == '':
+            return jsonify({"error": "No images provided"}), 400
+        
+        result = add_session_frames(session, files)
+        return jsonify(dict(result, success=True))
+        
+    except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/sessions/<session_id>/mosaic')
+def session_mosaic(session_id):
+    """Current mosaic of a session, delivered like any other result image"""
+    try:
+        session = open_mosaic_session(session_id)
+        if session is None:
+            return jsonify({"error": "Session not found"}), 404
+        
+        mosaic = session.mosaic()
+        if mosaic is None:
+            return jsonify({"error": "Session has no frames yet"}), 409
+        
+        return image_response('session_mosaic', mosaic, {
+            "success": True,
+            "frames": len(session.frames),
+            "width": mosaic.shape[1],
+            "height": mosaic.shape[0]
+        })
+        
+    except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
+        return jsonify({"error": str(e)}), 500
+
+def history_store():
+    """The flight history, opened on first use"""
+    global flight_history
+    if flight_history is None:
+        from history import FlightHistory
+        # Threads racing here open it twice, which is harmless: the schema is created IF NOT EXISTS
+        flight_history = FlightHistory(app.config['HISTORY_FOLDER'], app.config['HISTORY_ZONE_SIZE'])
+    return flight_history
+
+@app.route('/history/<field>/flights', methods=['POST'])
+def add_flight(field):
+    """Register a field's new mosaic to its earlier flights and store per-zone changes"""
+    from history import RegistrationError
+    try:
+        if 'image' not in request.files:
+            return jsonify({"error": "No image provided"}), 400
+        
+        file = request.files['image']
+        if file.filename == '' or not allowed_file(file.filename):
+            return jsonify({"error": "No image selected"}), 400
+        
+        # Spool the upload to disk, hashing it on the way; the hash keys the mosaic's features
+        upload = spool_request_upload(file)
+        img = upload.decode()
+        if img is None:
+            return jsonify({"error": "Invalid image file"}), 400
         
+        summary = history_store().add_flight(field, request.values.get('date'), img, upload.digest,
+                                            **tiling_options())
+        return jsonify(dict(summary, success=True)), 201
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RegistrationError as e:
+        return jsonify({"error": str(e)}), 422
     except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
         return jsonify({"error": str(e)}), 500
 
+@app.route('/history')
+def history_fields():
+    """Fields with flights, their flight counts and date range"""
+    return jsonify({"fields": history_store().fields()})
+
+@app.route('/history/<field>')
+def field_flights(field):
+    """Flights of a field in date order with their field-wide measures"""
+    flights = history_store().flights(field)
+    if not flights:
+        return jsonify({"error": "Field not found"}), 404
+    return jsonify({"field": field, "flights": flights})
+
+@app.route('/history/<field>/trend')
+def field_trend(field):
+    """Measures per flight date of a field, or of one zone, from the precomputed summaries"""
+    zone = request.values.get('zone')
+    if zone and not zone.isdigit():
+        return jsonify({"error": "zone must be a zone number"}), 400
+    zone = int(zone) if zone else None
+    try:
+        trend = history_store().trend(field, zone, request.values.get('start'), request.values.get('end'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"field": field, "zone": zone, "trend": trend})
+
+@app.route('/history/<field>/<date>')
+def flight_summary(field, date):
+    """One flight's measures, change from the flight before and disease hotspots"""
+    summary = history_store().flight_summary(field, date)
+    if summary is None:
+        return jsonify({"error": "Flight not found"}), 404
+    return jsonify(summary)
+
+@app.route('/history/<field>/<date>/zones')
+def flight_zones(field, date):
+    """Measures and changes of every measured zone of one flight"""
+    try:
+        zones = history_store().zones(field, date)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"field": field, "date": date, "zones": zones})
+
+def job_output_path(job_id):
+    """Where a job's result image is stored"""
+    return os.path.join(app.config['JOBS_FOLDER'], f'{job_id}.png')
+
+def run_stitch_job(job_id, params, progress):
+    """Stitch the frames spooled for a job; runs in a job pool process"""
+    from stitch import stitch_frames
+    try:
+        def report(level, done, total):
+            progress(stage="stitch", level=level, done=done, total=total)
+        
+        stitched_img = stitch_frames(params['frames'], workdir=params['input_dir'], progress=report,
+                                     digests=params.get('digests'), **stitch_options())
+        progress(stage="crop")
+        stitched_img = crop_to_valid(stitched_img)
+        
+        output_path = job_output_path(job_id)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        cv2.imwrite(output_path, stitched_img)
+        progress(stage="tiles")
+        tiles = build_tiles(job_id, stitched_img)
+        return dict({"message": "Images stitched successfully", "output_path": output_path}, **tiles)
+    finally:
+        # Inputs are kept only while the job may still be retried
+        shutil.rmtree(params['input_dir'], ignore_errors=True)
+
+def run_analyze_job(job_id, params, progress):
+    """Analyze the image spooled for a job; runs in a job pool process"""
+    try:
+        img = cv2.imread(params['image'], cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("Invalid image file")
+        progress(stage="analyze", analyses=params['analyses'])
+        results, stored, annotated, scale = analyze_image(img, params['analyses'])
+        
+        output_path = job_output_path(job_id)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        cv2.imwrite(output_path, annotated)
+        return dict({"results": results, "output_path": output_path, "preview_scale": scale}, **stored)
+    finally:
+        shutil.rmtree(params['input_dir'], ignore_errors=True)
+
+JOB_HANDLERS = {
+    'stitch': run_stitch_job,
+    'analyze': run_analyze_job
+}
+
+job_queue = JobQueue(app.config['JOB_DATABASE'], max_pending=app.config['JOB_QUEUE_LIMIT'])
+job_runner = JobRunner(job_queue, JOB_HANDLERS, workers=app.config['JOB_WORKERS'])
+
+def queue_full_response(e):
+    response = jsonify({"error": str(e)})
+    response.headers['Retry-After'] = '30'
+    return response, 429
+
+def submit_job(kind, job_id, params):
+    """Queue a job whose inputs are spooled, answering 202 or 429"""
+    try:
+        job_queue.submit(kind, params, job_id=job_id)
+    except QueueFull as e:
+        shutil.rmtree(params['input_dir'], ignore_errors=True)
+        return queue_full_response(e)
+    return jsonify({
+        "success": True,
+        "job_id": job_id,
+        "status_url": f"/jobs/{job_id}"
+    }), 202
+
+@app.route('/jobs/stitch', methods=['POST'])
+def submit_stitch_job():
+    """Queue a stitch job and return its id straight away"""
+    try:
+        if job_queue.is_full():
+            return queue_full_response(QueueFull("Job queue is full"))
+        
+        files = request.files.getlist('images')
+        if not files or files[0].filename == '':
+            return jsonify({"error": "No images provided"}), 400
+        
+        # Spool frames where they outlive this request and a worker restart
+        job_id = new_job_id()
+        input_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'jobs', job_id)
+        os.makedirs(input_dir)
+        frame_paths, frame_digests = [], []
+        for i, file in enumerate(files):
+            if file and allowed_file(file.filename):
+                upload = spool_upload(file, input_dir, f"{i:05d}_{secure_filename(file.filename)}")
+                frame_paths.append(upload.path)
+                frame_digests.append(upload.digest)
+        
+        if len(frame_paths) < 2:
+            shutil.rmtree(input_dir, ignore_errors=True)
+            return jsonify({"error": "At least 2 images required for stitching"}), 400
+        
+        return submit_job('stitch', job_id, {"frames": frame_paths, "digests": frame_digests, "input_dir": input_dir})
+        
+    except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/jobs/analyze', methods=['POST'])
+def submit_analyze_job():
+    """Queue an analysis job and return its id straight away"""
+    try:
+        if job_queue.is_full():
+            return queue_full_response(QueueFull("Job queue is full"))
+        
+        if 'image' not in request.files:
+            return jsonify({"error": "No image provided"}), 400
+        
+        file = request.files['image']
+        if file.filename == '' or not allowed_file(file.filename):
+            return jsonify({"error": "No image selected"}), 400
+        
+        names = requested_analyses()
+        unknown = [name for name in names if name not in DETECTORS]
+        if unknown:
+            return jsonify({"error": f"Unknown analyses: {', '.join(unknown)}"}), 400
+        
+        job_id = new_job_id()
+        input_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'jobs', job_id)
+        os.makedirs(input_dir)
+        image_path = os.path.join(input_dir, secure_filename(file.filename))
+        file.save(image_path)
+        
+        return submit_job('analyze', job_id, {"image": image_path, "analyses": names, "input_dir": input_dir})
+        
+    except Exception as e:
+        logger.exception("%s %s failed", request.method, request.path)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Status, progress and result of a job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job['status'] == 'done':
+        job['result_url'] = f"/jobs/{job_id}/result"
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Result image of a finished job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job['status'] != 'done':
+        return jsonify({"error": f"Job is {job['status']}"}), 409
+    output_path = os.path.abspath(job['result']['output_path'])
+    if not os.path.exists(output_path):
+        return jsonify({"error": "Job result expired"}), 410
+    return send_file(output_path, mimetype='image/png')
+
+def start_worker():
+    """Start what a server process cannot inherit across a fork: OpenCV's threads and the job runner"""
+    cv2.setNumThreads(app.config['OPENCV_THREADS'])
+    # Pick up jobs left queued or running by a previous server process
+    job_runner.start()
+
+def preload():
+    """Import the optional analyses and open shared state before gunicorn forks the workers
+
+    Workers share the master's pages copy-on-write until they write to
+    them; gc.freeze() moves everything loaded so far out of the
+    collector's reach, so collections in a worker do not touch (and so
+    copy) those pages.
+    """
+    for name in OPTIONAL_MODULES:
+        importlib.import_module(name)
+    history_store()
+    gc.freeze()
+
+# With preload_app, gunicorn.conf.py sets APP_PRELOAD: the master imports the app once
+# and every worker calls start_worker() after the fork; any other server starts here
+if os.environ.get('APP_PRELOAD'):
+    preload()
+else:
+    start_worker()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
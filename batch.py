@@ -0,0 +1,181 @@
+"""Run the detectors over every frame of a flight, streaming one row per frame
+
+Frames are read on a few I/O threads, a bounded number ahead of the
+analysis, and analysed on a pool of worker processes, one frame per
+task, so disk reads overlap decoding and detection. Workers are handed
+the encoded file bytes and decode them themselves: a JPEG frame is a
+fraction of the size of its pixels, so this is cheaper to pass between
+processes than a decoded image. Rows come back in frame order.
+
+Each row holds the frame name, its decoded size and the response fields
+of the single-analysis endpoints (tree_count, detected_areas and
+bounding_boxes, disease_count, object_count), or an error for a frame
+that could not be decoded. Given a detections directory, every frame's
+detections are also stored there and the row points to them, and
+bounding boxes are listed only up to an inline limit. Rows are written as NDJSON, and as a CSV
+summary of the count columns.
+
+Usage:
+    python batch.py images_nadir_RGB --analysis trees -o rows.ndjson --csv summary.csv
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import detections
+from detectors import DETECTORS, detect_many, summarize
+from ingest import REDUCED_FLAGS
+from parallel import BACKENDS, bounded_map, default_workers
+from stitch import list_frames
+from tiling import DEFAULT_OVERLAP, DEFAULT_TILE_SIZE
+
+DEFAULT_IO_THREADS = 4
+
+# Count columns of the CSV summary, per analysis
+COLUMNS = {
+    'trees': ['tree_count'],
+    'areas': ['detected_areas'],
+    'diseases': ['disease_count'],
+    'objects': ['object_count'],
+}
+
+
+def read_ahead(paths, io_threads=DEFAULT_IO_THREADS, ahead=None):
+    """Yield (path, bytes) in order, reading up to ahead files in advance"""
+    def read(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    ahead = ahead or 2 * io_threads
+    with ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix='batch-io') as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(read, path)))
+            if len(pending) >= ahead:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+def analyse_frame(name, data, names, reduce=1, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP,
+                  detections_dir=None, inline_limit=None):
+    """Row for one encoded frame; safe to run in a worker process"""
+    start = time.perf_counter()
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), REDUCED_FLAGS[reduce])
+    if image is None:
+        return {"frame": name, "error": "Invalid image file"}
+    row = {"frame": name, "width": image.shape[1], "height": image.shape[0]}
+    found = detect_many(names, image, tile_size, overlap)
+    for analysis, contours in found.items():
+        row.update(summarize(analysis, contours, inline_limit))
+    if detections_dir is not None:
+        # The server's own store sweeps the directory, so this one never does
+        store = detections.DetectionStore(detections_dir, ttl=0)
+        detections_id = store.save('batch', *detections.to_table(found))
+        row.update(detections_id=detections_id, detections_url=f"/detections/{detections_id}")
+    row["seconds"] = round(time.perf_counter() - start, 4)
+    return row
+
+
+def analyse_paths(paths, names, workers=1, backend='process', io_threads=DEFAULT_IO_THREADS, reduce=1,
+                  tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP, labels=None, detections_dir=None,
+                  inline_limit=None):
+    """Yield one row per frame path, in order
+
+    Frames are read by io_threads threads and analysed by workers
+    processes (or threads), each frame's tiles in the worker itself.
+    labels name the frames in the rows; the file names by default.
+    Detections are stored under detections_dir when it is given, and
+    rows list at most inline_limit bounding boxes.
+    """
+    names = list(dict.fromkeys(names))
+    for name in names:
+        if name not in DETECTORS:
+            raise ValueError(f"Unknown analysis: {name}")
+    labels = labels or [os.path.basename(path) for path in paths]
+    tasks = ((label, data, names, reduce, tile_size, overlap, detections_dir, inline_limit)
+             for label, (_, data) in zip(labels, read_ahead(paths, io_threads)))
+    yield from bounded_map(analyse_frame, tasks, workers, backend)
+
+
+def csv_columns(names):
+    return ['frame', 'width', 'height'] + [column for name in names for column in COLUMNS[name]] + ['seconds', 'error']
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def csv_lines(rows, names):
+    """CSV text of the count columns, header first, one line per row"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, csv_columns(names), extrasaction='ignore')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Only the header was written when there were no rows
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the detectors over every frame of a flight directory")
+    parser.add_argument('directory', help="directory of frames")
+    parser.add_argument('--analysis', action='append', choices=sorted(DETECTORS),
+                        help="analysis to run, repeatable; all of them by default")
+    parser.add_argument('-o', '--output', help="NDJSON rows, one per frame (default: stdout)")
+    parser.add_argument('--csv', help="CSV summary of the counts")
+    parser.add_argument('--workers', type=int, default=default_workers(), help="frames analysed concurrently")
+    parser.add_argument('--backend', choices=BACKENDS, default='process', help="worker pool type")
+    parser.add_argument('--io-threads', type=int, default=DEFAULT_IO_THREADS, help="threads reading frames")
+    parser.add_argument('--reduce', type=int, choices=sorted(REDUCED_FLAGS), default=1,
+                        help="decode JPEG frames at 1/reduce scale")
+    args = parser.parse_args(argv)
+
+    frames = list_frames(args.directory)
+    if not frames:
+        print(f"No frames found in {args.directory}", file=sys.stderr)
+        return 1
+    names = list(dict.fromkeys(args.analysis or DETECTORS))
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    summary = open(args.csv, 'w', newline='') if args.csv else None
+    writer = None
+    if summary is not None:
+        writer = csv.DictWriter(summary, csv_columns(names), extrasaction='ignore')
+        writer.writeheader()
+    start = time.perf_counter()
+    try:
+        for done, row in enumerate(analyse_paths(frames, names, args.workers, args.backend, args.io_threads,
+                                                 args.reduce), 1):
+            output.write(json.dumps(row) + '\n')
+            if writer is not None:
+                writer.writerow(row)
+            print(f"frame {done}/{len(frames)}: {row['frame']}", file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if summary is not None:
+            summary.close()
+    elapsed = time.perf_counter() - start
+    print(f"Analysed {len(frames)} frames in {elapsed:.1f}s ({len(frames) / elapsed:.2f} frames/s)", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
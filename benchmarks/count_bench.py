@@ -0,0 +1,82 @@
+"""Counting on noisy masks: findContours and contourArea against the components backend
+
+The reference is what count.py did: every outer contour of the whole
+mask is traced and contourArea is called on each one from Python. The
+backend runs are detect()'s path, find_contours_tiled() with the
+detector's min_area followed by its contour test, once with the mask as
+a single tile and once tiled as the endpoints run it. Counts, boxes and
+contours must match exactly; the run exits with status 1 when they do not.
+
+Run from the repository root:
+    python -m benchmarks.count_bench [--sizes 1024 2048 4096] [--densities 0.05 0.15 0.3]
+"""
+import argparse
+import time
+
+import cv2
+
+from benchmarks.synthetic import noisy_mask
+from detectors import DETECTORS
+from tiling import DEFAULT_OVERLAP, DEFAULT_TILE_SIZE, find_contours_tiled
+
+COUNTED = ('trees', 'diseases', 'objects')
+
+
+def _as_mask(window):
+    return window
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def reference(mask, keep):
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return [cnt for cnt in contours if keep(cnt)]
+
+
+def components(mask, detector, tile_size):
+    contours = find_contours_tiled(mask, _as_mask, 0, tile_size, DEFAULT_OVERLAP, min_area=detector.min_area)
+    return [cnt for cnt in contours if detector.keep(cnt)]
+
+
+def same(expected, found):
+    """Whether two contour lists agree in count, boxes and points"""
+    if len(expected) != len(found):
+        return False
+    if [cv2.boundingRect(cnt) for cnt in expected] != [cv2.boundingRect(cnt) for cnt in found]:
+        return False
+    return all((a == b).all() for a, b in zip(expected, found))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=(1024, 2048, 4096))
+    parser.add_argument('--densities', type=float, nargs='+', default=(0.05, 0.15, 0.3))
+    parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE)
+    args = parser.parse_args()
+
+    failures = 0
+    print(f"{'mask':>11}{'density':>9}{'contours':>10}{'detector':>10}{'kept':>6}"
+          f"{'reference':>11}{'whole':>9}{'speedup':>9}{'tiled':>9}  match")
+    for size in args.sizes:
+        for density in args.densities:
+            mask = noisy_mask(size, size, density)
+            total = len(cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0])
+            for name in COUNTED:
+                detector = DETECTORS[name]
+                expected, before = timed(lambda: reference(mask, detector.keep))
+                whole, after = timed(lambda: components(mask, detector, size))
+                tiled, tiled_time = timed(lambda: components(mask, detector, args.tile_size))
+                match = same(expected, whole) and same(expected, tiled)
+                failures += not match
+                print(f"{size:>5}x{size:<5}{density:>9.2f}{total:>10}{name:>10}{len(whole):>6}"
+                      f"{before:>10.3f}s{after:>8.3f}s{before / after:>8.1f}x{tiled_time:>8.3f}s  "
+                      f"{'yes' if match else 'NO'}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,73 @@
+"""Compare the erode-until-fit crop with the largest-rectangle solver
+
+Run from the repository root:
+    python -m benchmarks.crop_bench
+"""
+import time
+
+import cv2
+import imutils
+import numpy as np
+
+from crop import largest_valid_rect
+
+SIZES = [(600, 800), (1200, 1600), (2400, 3200), (4800, 6400)]
+
+
+def synthetic_mosaic_mask(height, width, seed=0):
+    """Mask of a skewed, wavy-edged mosaic surrounded by a black border"""
+    rng = np.random.default_rng(seed)
+    margin = np.array([width, height]) * 0.08
+    corners = np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float64)
+    inward = np.array([[1, 1], [-1, 1], [-1, -1], [1, -1]])
+    jitter = rng.uniform(0.2, 1.0, size=(4, 2)) * margin
+    polygon = (corners + inward * jitter).astype(np.int32)
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.fillPoly(mask, [polygon], 255)
+    # Ragged seams along the edges, like frames that did not fully overlap
+    for _ in range(12):
+        cx, cy = rng.integers(0, width), rng.integers(0, height)
+        radius = int(rng.uniform(0.02, 0.06) * min(height, width))
+        cv2.circle(mask, (int(cx), int(cy)), radius, 0, -1)
+    return mask
+
+
+def erosion_rect(thresh_img):
+    """The crop loop /stitch used before the rectangle solver"""
+    contours = imutils.grab_contours(cv2.findContours(thresh_img.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE))
+    areaOI = max(contours, key=cv2.contourArea)
+    mask = np.zeros(thresh_img.shape, dtype="uint8")
+    x, y, w, h = cv2.boundingRect(areaOI)
+    cv2.rectangle(mask, (x, y), (x + w, y + h), 255, -1)
+
+    minRectangle = mask.copy()
+    sub = mask.copy()
+    while cv2.countNonZero(sub) > 0:
+        minRectangle = cv2.erode(minRectangle, None)
+        sub = cv2.subtract(minRectangle, thresh_img)
+
+    contours = imutils.grab_contours(cv2.findContours(minRectangle.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE))
+    if not contours:
+        return (0, 0, 0, 0)
+    return cv2.boundingRect(max(contours, key=cv2.contourArea))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    print(f"{'size':>12} {'erode s':>10} {'erode area':>12} {'rect s':>10} {'rect area':>12} {'speedup':>8}")
+    for height, width in SIZES:
+        mask = synthetic_mosaic_mask(height, width)
+        (_, _, ew, eh), erode_time = timed(erosion_rect, mask)
+        (_, _, rw, rh), rect_time = timed(largest_valid_rect, mask)
+        print(f"{width}x{height:>6} {erode_time:>10.3f} {ew * eh:>12} {rect_time:>10.3f} {rw * rh:>12} "
+              f"{erode_time / rect_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Latency and bytes per result delivery mode and image encoding
+
+Posts a synthetic field to /count-objects, whose detector is cheap, so
+the time is dominated by encoding and delivery. The result cache is
+off, so every repeat encodes again. For delivery=url the follow-up
+download of the image is included in both columns.
+
+Run from the repository root:
+    python -m benchmarks.delivery_bench [--size HEIGHT WIDTH]
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+
+import cv2
+
+from benchmarks.synthetic import synthetic_field
+
+ENCODINGS = [
+    ('png', 1), ('png', 3), ('png', 9),
+    ('jpeg', 90), ('jpeg', 75),
+    ('webp', 90), ('webp', 75),
+]
+DELIVERIES = ('json', 'url', 'multipart')
+
+
+def timed_request(client, upload, delivery, fmt, level):
+    start = time.perf_counter()
+    # Closing a streamed response gives back its admission slots
+    with client.post('/count-objects', data={
+        'image': (io.BytesIO(upload), 'field.png'),
+        'delivery': delivery,
+        'format': fmt,
+        'quality': str(level),
+    }) as response:
+        assert response.status_code == 200, response.data[:200]
+        size = len(response.data)
+        if delivery == 'url':
+            with client.get(response.get_json()['image_url']) as image:
+                size += len(image.data)
+    return time.perf_counter() - start, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, nargs=2, default=(3000, 4000), metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    upload = cv2.imencode('.png', synthetic_field(*args.size))[1].tobytes()
+    with tempfile.TemporaryDirectory() as workdir:
+        # The app creates its upload and result folders in the working directory
+        os.chdir(workdir)
+        import app as app_module
+        from cache import ResultCache
+        app_module.result_cache = ResultCache(os.path.join(workdir, 'cache'), 0, 0)
+        client = app_module.app.test_client()
+
+        print(f"image={args.size[1]}x{args.size[0]} upload={len(upload) / 1e6:.1f} MB")
+        print(f"{'delivery':<10}{'format':<8}{'level':>6}{'latency':>10}{'bytes':>12}")
+        for delivery in DELIVERIES:
+            for fmt, level in ENCODINGS:
+                runs = [timed_request(client, upload, delivery, fmt, level) for _ in range(args.repeats)]
+                latency = min(run[0] for run in runs)
+                size = runs[0][1]
+                print(f"{delivery:<10}{fmt:<8}{level:>6}{latency:>9.3f}s{size:>12,}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Building and serialising detections: a JSON list of boxes against columnar arrays
+
+The list column is what /detect-areas did for every request: one
+cv2.boundingRect call per contour and the whole list of tuples
+serialised as JSON. The columnar run builds the structured table (boxes,
+areas, centroids and contours) with to_table(), saves it with a
+DetectionStore, and reads back the summary and one JSON page of rows,
+which is what a client fetching /detections/<id> and its first page
+costs the server. Contours come from noisy synthetic masks, so large
+sizes give hundreds of thousands of regions.
+
+Run from the repository root:
+    python -m benchmarks.detections_bench [--sizes 1024 2048 4096] [--page 1000]
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+import cv2
+
+import detections
+from benchmarks.synthetic import noisy_mask
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def box_list(contours):
+    return json.dumps({"bounding_boxes": [cv2.boundingRect(cnt) for cnt in contours]})
+
+
+def columnar(store, contours, page):
+    table, vertices, offsets = detections.to_table({'areas': contours})
+    found = store.load(store.save('areas', table, vertices, offsets))
+    return json.dumps([found.summary(), list(found.rows(range(min(page, len(found)))))])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=(1024, 2048, 4096))
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--page', type=int, default=1000, help="rows in the page read back")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        store = detections.DetectionStore(directory, ttl=0)
+        print(f"{'size':>11}{'regions':>10}{'list':>9}{'bytes':>11}{'columnar':>10}{'bytes':>11}{'speedup':>9}")
+        for size in args.sizes:
+            mask = noisy_mask(size, size, args.density)
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            listed, list_time = timed(lambda: box_list(contours))
+            paged, columnar_time = timed(lambda: columnar(store, contours, args.page))
+            print(f"{size:>5}x{size:<5}{len(contours):>10}{list_time:>8.3f}s{len(listed):>11}"
+                  f"{columnar_time:>9.3f}s{len(paged):>11}{list_time / columnar_time:>8.1f}x")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
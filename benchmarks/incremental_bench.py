@@ -0,0 +1,50 @@
+"""Cost of adding a batch of frames to incremental mosaics of growing size
+
+For each session size, a session is built from the first frames of a
+synthetic flight and a batch of further frames is then added to it; the
+batch time should stay flat as the session grows, while building the
+whole mosaic from scratch grows with the frame count.
+
+Run from the repository root:
+    python -m benchmarks.incremental_bench [--sizes 20 60 120] [--batch 10]
+"""
+import argparse
+import math
+import os
+import tempfile
+import time
+
+from benchmarks.synthetic import synthetic_flight
+from incremental import MosaicSession
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=(20, 60, 120))
+    parser.add_argument('--batch', type=int, default=10)
+    parser.add_argument('--cols', type=int, default=10, help="frames per flight line")
+    parser.add_argument('--frame-size', type=int, nargs=2, default=(300, 400), metavar=('HEIGHT', 'WIDTH'))
+    args = parser.parse_args()
+
+    total = max(args.sizes) + args.batch
+    with tempfile.TemporaryDirectory() as work_dir:
+        frames = synthetic_flight(os.path.join(work_dir, 'flight'), rows=math.ceil(total / args.cols),
+                                  cols=args.cols, frame_size=tuple(args.frame_size))
+        print(f"frames={args.frame_size[1]}x{args.frame_size[0]} batch={args.batch}")
+        print(f"{'session':>8}{'from scratch':>14}{'add batch':>12}{'per frame':>12}{'placed':>8}")
+        for size in args.sizes:
+            session = MosaicSession.create(os.path.join(work_dir, f'session{size}'), work_megapix=0)
+            start = time.perf_counter()
+            session.add_frames(frames[:size])
+            scratch = time.perf_counter() - start
+
+            batch = frames[size:size + args.batch]
+            start = time.perf_counter()
+            added, _ = session.add_frames(batch)
+            elapsed = time.perf_counter() - start
+            print(f"{size:>8}{scratch:>13.2f}s{elapsed:>11.2f}s{elapsed / len(batch) * 1000:>10.0f}ms"
+                  f"{len(added):>5}/{len(batch)}")
+
+
+if __name__ == '__main__':
+    main()
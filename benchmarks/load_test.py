@@ -0,0 +1,136 @@
+"""Latency percentiles and throughput of an endpoint at rising concurrency
+
+For each concurrency level, that many clients post a synthetic field to
+the endpoint back to back for a fixed time, while one more client polls
+a cheap endpoint (/api by default) to show whether it queues behind the
+heavy work. Each level reports requests per second, p50 and p99 latency
+of the heavy endpoint, how many requests were turned away with 503 by
+admission control, and the cheap endpoint's p50 and p99.
+
+Without --url the app is served in-process by a threaded server in a
+temporary directory, with the result cache off; with --url, any running
+server is tested (for example gunicorn -c gunicorn.conf.py app:app).
+
+Run from the repository root:
+    python -m benchmarks.load_test [--url http://localhost:5000] [--endpoint /count-trees] [--concurrency 1 2 4 8]
+"""
+import argparse
+import http.client
+import os
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import cv2
+import numpy as np
+
+from benchmarks.synthetic import synthetic_field
+
+
+def multipart_body(fields, files):
+    """Content type and body of a multipart/form-data request"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return f'multipart/form-data; boundary={boundary}', b''.join(parts)
+
+
+def client(url, method, path, body, content_type, deadline, latencies, statuses):
+    """Send requests over one connection until deadline, recording latency and status"""
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=600)
+    headers = {'Content-Type': content_type} if content_type else {}
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=600)
+            status = 0
+        latencies.append(time.perf_counter() - start)
+        statuses.append(status)
+    connection.close()
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float('nan')
+
+
+def run_level(url, endpoint, body, content_type, probe, concurrency, duration):
+    deadline = time.perf_counter() + duration
+    latencies, statuses, probe_latencies, probe_statuses = [], [], [], []
+    threads = [threading.Thread(target=client, args=(url, 'POST', endpoint, body, content_type, deadline,
+                                                     latencies, statuses))
+               for _ in range(concurrency)]
+    threads.append(threading.Thread(target=client, args=(url, 'GET', probe, None, None, deadline,
+                                                         probe_latencies, probe_statuses)))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    ok = [latency for latency, status in zip(latencies, statuses) if status == 200]
+    return {
+        "requests": len(ok),
+        "rps": len(ok) / elapsed,
+        "p50": percentile(ok, 50),
+        "p99": percentile(ok, 99),
+        "busy": statuses.count(503),
+        "errors": sum(status not in (200, 503) for status in statuses),
+        "probe_p50": percentile(probe_latencies, 50),
+        "probe_p99": percentile(probe_latencies, 99),
+    }
+
+
+def serve_in_process():
+    """Serve the app on a free local port from a threaded server; returns its URL"""
+    from werkzeug.serving import make_server
+
+    # The app creates its upload and result folders in the working directory
+    os.chdir(tempfile.mkdtemp())
+    import app as app_module
+    from cache import ResultCache
+    app_module.result_cache = ResultCache(os.path.join(os.getcwd(), 'cache'), 0, 0)
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help="server to test; the app is served in-process when omitted")
+    parser.add_argument('--endpoint', default='/count-trees')
+    parser.add_argument('--probe', default='/api', help="cheap endpoint polled alongside")
+    parser.add_argument('--size', type=int, nargs=2, default=(1500, 2000), metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=(1, 2, 4, 8, 16))
+    parser.add_argument('--duration', type=float, default=10, help="seconds per concurrency level")
+    args = parser.parse_args()
+
+    upload = cv2.imencode('.jpg', synthetic_field(*args.size))[1].tobytes()
+    content_type, body = multipart_body({'delivery': 'url'}, {'image': ('field.jpg', upload)})
+    url = args.url or serve_in_process()
+
+    print(f"url={url} endpoint={args.endpoint} image={args.size[1]}x{args.size[0]} duration={args.duration:g}s")
+    print(f"{'clients':>8}{'requests':>10}{'rps':>8}{'p50':>9}{'p99':>9}{'busy':>6}{'errors':>8}"
+          f"{args.probe + ' p50':>13}{args.probe + ' p99':>13}")
+    for concurrency in args.concurrency:
+        result = run_level(url, args.endpoint, body, content_type, args.probe, concurrency, args.duration)
+        print(f"{concurrency:>8}{result['requests']:>10}{result['rps']:>8.2f}{result['p50']:>8.3f}s"
+              f"{result['p99']:>8.3f}s{result['busy']:>6}{result['errors']:>8}"
+              f"{result['probe_p50'] * 1000:>11.1f}ms{result['probe_p99'] * 1000:>11.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
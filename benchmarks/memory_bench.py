@@ -0,0 +1,79 @@
+"""Buffer allocations, peak memory and latency per request for the detector endpoints
+
+Each endpoint gets a synthetic field several times in a row, with the
+buffer pools off (BUFFER_POOL_BYTES=0, every stage allocates) and on.
+'buffers' counts the stage, mask and label arrays the pipelines had to
+allocate for the request; 'peak' is the tracemalloc high-water mark of
+the request above what was allocated before it, which covers every NumPy
+and OpenCV array. The result cache is disabled so every request runs the
+pipelines. The first request with pools on is cold; the rest should
+allocate nothing but the decoded image, the preview and the results.
+
+Run from the repository root:
+    python -m benchmarks.memory_bench [--size 3000 4000] [--requests 3]
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+
+import buffers
+from benchmarks.synthetic import synthetic_field
+from cache import ResultCache
+
+ENDPOINTS = ('/count-trees', '/detect-areas', '/detect-diseases', '/count-objects', '/analyze')
+
+
+def measured_request(client, endpoint, upload):
+    """(seconds, buffers allocated, peak bytes) of one request"""
+    allocations = buffers.stats()['allocations']
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    response = client.post(endpoint, data={'image': (io.BytesIO(upload), 'field.jpg'), 'delivery': 'url'})
+    elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f"{endpoint} returned {response.status_code}: {response.get_data(as_text=True)}")
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    return elapsed, buffers.stats()['allocations'] - allocations, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, nargs=2, default=(3000, 4000), metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--requests', type=int, default=3, help="requests per endpoint and setting")
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    upload = cv2.imencode('.jpg', synthetic_field(*args.size))[1].tobytes()
+    with tempfile.TemporaryDirectory() as workdir:
+        # The app creates its upload and result folders in the working directory
+        os.chdir(workdir)
+        import app as app_module
+        app = app_module.app
+        app.config['WORKERS'] = args.workers
+        app_module.result_cache = ResultCache(os.path.join(workdir, 'cache'), 0, 0)
+        client = app.test_client()
+
+        print(f"image={args.size[1]}x{args.size[0]} workers={args.workers} tile={app.config['TILE_SIZE']} "
+              f"preview={app.config['PREVIEW_MAX_SIDE']}")
+        print(f"{'endpoint':<18}{'pools':>6}{'request':>8}{'buffers':>9}{'peak MB':>9}{'latency':>10}")
+        tracemalloc.start()
+        try:
+            for endpoint in ENDPOINTS:
+                for pool_bytes in (0, app.config['BUFFER_POOL_BYTES']):
+                    buffers.configure(pool_bytes)
+                    for request in range(1, args.requests + 1):
+                        elapsed, allocated, peak = measured_request(client, endpoint, upload)
+                        print(f"{endpoint:<18}{'on' if pool_bytes else 'off':>6}{request:>8}{allocated:>9}"
+                              f"{peak / 1e6:>9.1f}{elapsed:>9.2f}s")
+        finally:
+            tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    main()
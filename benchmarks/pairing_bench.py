@@ -0,0 +1,62 @@
+"""Stitching wall time against frame count, all pairs versus GPS neighbours
+
+Each flight is stitched as a single group through the detail pipeline,
+once matching every pair of frames and once matching each frame only
+with its nearest neighbours by EXIF GPS. The neighbour run is repeated
+with the feature cache warm, as when a flight is stitched again.
+
+Run from the repository root:
+    python -m benchmarks.pairing_bench [--counts 8 16 24 32] [--neighbours 4]
+"""
+import argparse
+import math
+import os
+import tempfile
+import time
+
+from benchmarks.synthetic import synthetic_flight
+from features import DETECTORS, gps_positions, neighbour_mask
+from stitch import STITCH_MODES, stitch_frames
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--counts', type=int, nargs='+', default=(8, 16, 24, 32))
+    parser.add_argument('--cols', type=int, default=8, help="frames per flight line")
+    parser.add_argument('--neighbours', type=int, default=4)
+    parser.add_argument('--detector', choices=DETECTORS, default='orb')
+    parser.add_argument('--mode', choices=sorted(STITCH_MODES), default='scans')
+    parser.add_argument('--frame-size', type=int, nargs=2, default=(300, 400), metavar=('HEIGHT', 'WIDTH'))
+    args = parser.parse_args()
+
+    print(f"frames={args.frame_size[1]}x{args.frame_size[0]} mode={args.mode} detector={args.detector} "
+          f"neighbours={args.neighbours}")
+    print(f"{'frames':>7}{'pairs':>8}{'nearest':>9}{'all pairs':>12}{'neighbours':>12}{'warm cache':>12}{'speedup':>9}")
+    for count in args.counts:
+        with tempfile.TemporaryDirectory() as work_dir:
+            cols = min(count, args.cols)
+            frames = synthetic_flight(os.path.join(work_dir, 'flight'), rows=math.ceil(count / cols), cols=cols,
+                                      frame_size=tuple(args.frame_size), gps=True)[:count]
+
+            def run(pairing, cache):
+                stitch_frames(frames, group_size=count, work_megapix=0, mode=args.mode, pairing=pairing,
+                              neighbours=args.neighbours, detector=args.detector,
+                              feature_cache=os.path.join(work_dir, cache))
+
+            everything = timed(lambda: run('all', 'all'))
+            nearest = timed(lambda: run('neighbours', 'neighbours'))
+            warm = timed(lambda: run('neighbours', 'neighbours'))
+            pairs = count * (count - 1) // 2
+            nearest_pairs = int(neighbour_mask(count, args.neighbours, gps_positions(frames)).sum()) // 2
+            print(f"{count:>7}{pairs:>8}{nearest_pairs:>9}{everything:>11.2f}s{nearest:>11.2f}s{warm:>11.2f}s"
+                  f"{everything / nearest:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
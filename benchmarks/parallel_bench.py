@@ -0,0 +1,67 @@
+"""Speedup of the detectors and the stitcher with more workers
+
+Run from the repository root:
+    python -m benchmarks.parallel_bench [--backend thread|process]
+"""
+import argparse
+import tempfile
+import time
+
+from benchmarks.synthetic import synthetic_field, synthetic_flight
+from detectors import detect
+from parallel import BACKENDS, default_workers
+from stitch import stitch_frames
+
+DETECTOR_ENDPOINTS = {
+    '/count-trees': 'trees',
+    '/detect-areas': 'areas',
+    '/detect-diseases': 'diseases',
+    '/count-objects': 'objects',
+}
+
+
+def worker_counts():
+    limit = default_workers()
+    return sorted({count for count in (1, 2, 4, limit) if count <= limit})
+
+
+def best_of(repeats, func):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=BACKENDS, default='thread')
+    parser.add_argument('--size', type=int, nargs=2, default=(4000, 6000), metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--tile-size', type=int, default=1024)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    field = synthetic_field(*args.size)
+    counts = worker_counts()
+    print(f"backend={args.backend} image={args.size[1]}x{args.size[0]} tile={args.tile_size}")
+    print(f"{'endpoint':<18}" + ''.join(f"{f'{n} workers':>16}" for n in counts))
+
+    for endpoint, name in DETECTOR_ENDPOINTS.items():
+        row = []
+        for workers in counts:
+            row.append(best_of(args.repeats, lambda: detect(name, field, tile_size=args.tile_size,
+                                                            workers=workers, backend=args.backend)))
+        print(f"{endpoint:<18}" + ''.join(f"{t:>8.3f}s {row[0] / t:>5.1f}x" for t in row))
+
+    with tempfile.TemporaryDirectory() as flight_dir:
+        frames = synthetic_flight(flight_dir, rows=4, cols=8)
+        row = []
+        for workers in counts:
+            row.append(best_of(1, lambda: stitch_frames(frames, group_size=4, mode='scans',
+                                                        workers=workers, backend=args.backend)))
+        print(f"{'/stitch':<18}" + ''.join(f"{t:>8.3f}s {row[0] / t:>5.1f}x" for t in row))
+
+
+if __name__ == '__main__':
+    main()
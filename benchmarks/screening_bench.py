@@ -0,0 +1,93 @@
+"""Coarse-to-fine screening against full-frame detection: latency and recall
+
+For each screened detector, factor and margin, detect() runs once on
+the whole image and once screened, and the run reports both times, the
+share of the image the candidate windows cover, and recall: the share
+of full-frame components over the detector's min_area (before its
+contour test) and of final detections that the screened run also finds,
+matched by their first contour point, plus any it finds that the full
+run does not. Trees and diseases are measured on a synthetic field,
+objects on a mosaic of field patches on a black canvas, like the
+borders of a stitched flight.
+
+Run from the repository root:
+    python -m benchmarks.screening_bench [--size 3000 4000] [--factors 2 4 8] [--margins 0 2 4]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_field
+from detectors import DETECTORS, _StageMask, _StageScreen, detect
+from screening import FACTORS, Screen, candidate_windows, find_contours_screened
+from tiling import find_contours_tiled
+
+SCREENED = ('trees', 'diseases', 'objects')
+
+
+def patch_mosaic(height, width, patches=6, seed=0):
+    """Field patches on a black canvas"""
+    rng = np.random.default_rng(seed)
+    field = synthetic_field(height, width, seed)
+    mosaic = np.zeros_like(field)
+    for _ in range(patches):
+        h, w = int(rng.integers(height // 10, height // 4)), int(rng.integers(width // 10, width // 4))
+        y, x = int(rng.integers(0, height - h)), int(rng.integers(0, width - w))
+        mosaic[y:y + h, x:x + w] = field[y:y + h, x:x + w]
+    return mosaic
+
+
+def timed(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def firsts(contours):
+    return {(int(cnt[0, 0, 0]), int(cnt[0, 0, 1])) for cnt in contours}
+
+
+def recall(expected, found):
+    return len(expected & found) / len(expected) if expected else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, nargs=2, default=(3000, 4000), metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--factors', type=int, nargs='+', default=FACTORS, choices=FACTORS)
+    parser.add_argument('--margins', type=int, nargs='+', default=(0, 2, 4))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    images = {'field': synthetic_field(*args.size), 'mosaic': patch_mosaic(*args.size)}
+    print(f"image={args.size[1]}x{args.size[0]} repeat={args.repeat}")
+    print(f"{'detector':>10}{'factor':>8}{'margin':>8}{'full':>9}{'screened':>10}{'speedup':>9}{'windows':>9}"
+          f"{'cover':>7}{'raw':>7}{'recall':>8}{'found':>7}{'recall':>8}{'extra':>7}")
+    for name in SCREENED:
+        detector = DETECTORS[name]
+        image = images['mosaic' if name == 'objects' else 'field']
+        mask_fn, screen_fn = _StageMask(name), _StageScreen(name)
+        raw = firsts(find_contours_tiled(image, mask_fn, detector.radius, min_area=detector.min_area))
+        full, full_time = timed(lambda: detect(name, image), args.repeat)
+        for factor in args.factors:
+            for margin in args.margins:
+                # max_fraction 1 measures the windows even where detect() would trace the whole image
+                screen = Screen(factor, margin, 1.0)
+                windows = candidate_windows(image, screen_fn, detector.radius, screen)
+                cover = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in windows) / image[..., 0].size
+                screened_raw = firsts(find_contours_screened(image, mask_fn, screen_fn, detector.radius, screen,
+                                                             min_area=detector.min_area))
+                screened, screened_time = timed(lambda: detect(name, image, screen=screen), args.repeat)
+                found = firsts(screened)
+                print(f"{name:>10}{factor:>8}{margin:>8}{full_time:>8.3f}s{screened_time:>9.3f}s"
+                      f"{full_time / screened_time:>8.2f}x{len(windows):>9}{cover:>7.1%}{len(raw):>7}"
+                      f"{recall(raw, screened_raw):>8.1%}{len(full):>7}{recall(firsts(full), found):>8.1%}"
+                      f"{len(found - firsts(full)):>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""Cold start and per-worker memory of the API, imported per worker or preloaded
+
+Cold start is the wall time and peak RSS of importing app in a fresh
+interpreter: what every worker pays when it imports the app itself, and
+what the gunicorn master pays once with APP_PRELOAD set (the optional
+analyses imported too). Worker memory follows gunicorn's fork model
+without gunicorn: a master process forks the workers, either before
+importing anything (each worker imports app, as without preload_app) or
+after importing and preloading app (as gunicorn.conf.py does). Every
+worker then answers /api and one /count-trees on its own synthetic field
+and, with all of them still running, reports RSS, PSS (shared pages
+split between the processes mapping them) and USS (pages only it maps);
+total PSS adds the master's.
+
+--root measures another checkout of the app, such as a worktree of an
+earlier commit ("worker" mode only, if it predates preload()).
+
+Run from the repository root:
+    python -m benchmarks.startup_bench [--workers 4] [--repeat 5] [--root DIR]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+MODES = ('worker', 'preload')
+
+IMPORT_SNIPPET = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                  "modules": len(sys.modules)}))
+"""
+
+
+def smaps(pid):
+    """Rss, Pss and Uss of a process in bytes, from /proc/<pid>/smaps_rollup"""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    return {"rss": values['Rss'], "pss": values['Pss'],
+            "uss": values['Private_Clean'] + values['Private_Dirty']}
+
+
+def environment(root, mode):
+    env = dict(os.environ, PYTHONPATH=root)
+    env.pop('APP_PRELOAD', None)
+    if mode == 'preload':
+        env['APP_PRELOAD'] = '1'
+    return env
+
+
+def cold_start(root, mode, scratch, repeat):
+    runs = [json.loads(subprocess.run([sys.executable, '-c', IMPORT_SNIPPET], cwd=scratch, env=environment(root, mode),
+                                      check=True, capture_output=True, text=True).stdout)
+            for _ in range(repeat)]
+    return {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+
+def serve(image):
+    """A worker: answer one cheap and one detector request, then report and wait"""
+    import app
+    if os.environ.get('APP_PRELOAD'):
+        app.start_worker()
+    client = app.app.test_client()
+    client.get('/api')
+    with open(image, 'rb') as f:
+        response = client.post('/count-trees', data={'image': (f, 'field.png')})
+    assert response.status_code == 200, response.get_data(as_text=True)
+
+
+def master(mode, images):
+    """Fork a worker per image like gunicorn would and print their memory"""
+    if mode == 'preload':
+        import app  # noqa: F401  preloads, as APP_PRELOAD is set
+    ready_r, ready_w = os.pipe()
+    done_r, done_w = os.pipe()
+    pids = []
+    for image in images:
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            os.close(done_w)
+            serve(image)
+            os.write(ready_w, b'.')
+            os.read(done_r, 1)
+            os._exit(0)
+        pids.append(pid)
+    for _ in pids:
+        os.read(ready_r, 1)
+    workers = [smaps(pid) for pid in pids]
+    own = smaps(os.getpid())
+    os.close(done_w)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    print(json.dumps({"workers": workers, "master": own}))
+
+
+def worker_memory(root, mode, scratch, images):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--master', mode] + images, cwd=scratch,
+                            env=environment(root, mode), check=True, capture_output=True, text=True).stdout
+    found = json.loads(output.splitlines()[-1])
+    workers = found['workers']
+    return {
+        "rss": statistics.mean(worker['rss'] for worker in workers),
+        "pss": statistics.mean(worker['pss'] for worker in workers),
+        "uss": statistics.mean(worker['uss'] for worker in workers),
+        "total": sum(worker['pss'] for worker in workers) + found['master']['pss'],
+    }
+
+
+def write_fields(directory, count, size):
+    import cv2
+
+    from benchmarks.synthetic import synthetic_field
+    paths = []
+    for seed in range(count):
+        path = os.path.join(directory, f'field-{seed}.png')
+        cv2.imwrite(path, synthetic_field(size, size, seed))
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5, help="cold starts per mode; the median is reported")
+    parser.add_argument('--size', type=int, default=1024, help="side of each worker's synthetic field")
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--root', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="checkout whose app.py is measured")
+    parser.add_argument('--master', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('images', nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.master:
+        master(args.master, args.images)
+        return
+
+    scratch = tempfile.mkdtemp()
+    try:
+        images = write_fields(scratch, args.workers, args.size)
+        mib = 1024 * 1024
+        print(f"root={args.root} workers={args.workers} repeat={args.repeat}")
+        print(f"{'mode':>8}{'import':>9}{'modules':>9}{'peak rss':>10}{'worker rss':>12}{'pss':>8}{'uss':>8}"
+              f"{'total pss':>11}")
+        for mode in args.modes:
+            started = cold_start(args.root, mode, scratch, args.repeat)
+            memory = worker_memory(args.root, mode, scratch, images)
+            print(f"{mode:>8}{started['seconds']:>8.3f}s{started['modules']:>9}{started['rss'] / mib:>9.1f}M"
+                  f"{memory['rss'] / mib:>11.1f}M{memory['pss'] / mib:>7.1f}M{memory['uss'] / mib:>7.1f}M"
+                  f"{memory['total'] / mib:>10.1f}M")
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
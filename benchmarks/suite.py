@@ -0,0 +1,210 @@
+"""Time every endpoint and pipeline on synthetic imagery, with a baseline check
+
+Cases cover the detectors (detect() per analysis and detect_many() for
+all of them) and each analysis endpoint, across field sizes, and the
+stitcher (stitch_frames() and /stitch) across frame counts. Every case
+reports the best of its repeats, each started from the same OpenCV RNG
+seed. Endpoints run with the result cache off, and each /stitch run gets
+empty feature and tile folders, so nothing is answered from earlier runs.
+
+Results are written as JSON with the environment and settings they came
+from. Given a baseline (an earlier results file), a case slower than its
+baseline by more than the tolerance, and by more than min-delta seconds,
+is a regression: each is listed and the run exits with status 1.
+
+Run from the repository root:
+    python -m benchmarks.suite [-o results.json] [--baseline benchmarks/baseline.json] [--quick]
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks.synthetic import synthetic_field, synthetic_flight
+from cache import ResultCache
+from detectors import DETECTORS, detect, detect_many
+from stitch import stitch_frames
+
+ENDPOINTS = {
+    '/count-trees': 'trees',
+    '/detect-areas': 'areas',
+    '/detect-diseases': 'diseases',
+    '/count-objects': 'objects',
+    '/analyze': None,
+}
+
+SIZES = [(1500, 2000), (3000, 4000)]
+FRAME_COUNTS = [8, 16]
+QUICK_SIZES = [(750, 1000)]
+QUICK_FRAME_COUNTS = [4]
+
+# Frames are cut from a field in flight lines of this many frames, as in pairing_bench
+FLIGHT_COLS = 8
+FRAME_SIZE = (300, 400)
+STITCH_MODE = 'scans'
+# OpenCV's RANSAC draws from its RNG; reseeding before every run makes runs repeatable
+RNG_SEED = 0
+
+
+def best_of(repeats, func):
+    times = []
+    for _ in range(repeats):
+        cv2.setRNGSeed(RNG_SEED)
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times), times
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def post(client, endpoint, files):
+    response = client.post(endpoint, data=dict(files(), delivery='url'))
+    if response.status_code != 200:
+        raise RuntimeError(f"{endpoint} returned {response.status_code}: {response.get_data(as_text=True)}")
+
+
+def detector_cases(sizes):
+    """(name, func) for the detector functions and endpoints on each field size"""
+    from app import app
+    client = app.test_client()
+    for height, width in sizes:
+        size = f"{width}x{height}"
+        field = synthetic_field(height, width)
+        upload = cv2.imencode('.jpg', field)[1].tobytes()
+        for name in DETECTORS:
+            yield f"detect/{name}/{size}", lambda name=name, field=field: detect(name, field)
+        yield f"detect_many/{size}", lambda field=field: detect_many(list(DETECTORS), field)
+        for endpoint in ENDPOINTS:
+            yield f"POST {endpoint}/{size}", lambda endpoint=endpoint, upload=upload: post(
+                client, endpoint, lambda: {'image': (io.BytesIO(upload), 'field.jpg')})
+
+
+def stitch_cases(frame_counts, work_dir):
+    """(name, func) for stitch_frames() and /stitch on each frame count"""
+    from app import app
+    client = app.test_client()
+    for count in frame_counts:
+        cols = min(count, FLIGHT_COLS)
+        frames = synthetic_flight(os.path.join(work_dir, f'flight{count}'), rows=-(-count // cols), cols=cols,
+                                  frame_size=FRAME_SIZE, gps=True)[:count]
+        uploads = [open(path, 'rb').read() for path in frames]
+
+        def fresh_folders():
+            run_dir = tempfile.mkdtemp(dir=work_dir)
+            app.config['FEATURE_CACHE_FOLDER'] = os.path.join(run_dir, 'features')
+            app.config['TILES_FOLDER'] = os.path.join(run_dir, 'tiles')
+            # Nadir flights stitch as scans; panorama mode needs camera rotation
+            app.config['STITCH_MODE'] = STITCH_MODE
+
+        def stitch_endpoint(uploads=uploads):
+            fresh_folders()
+            post(client, '/stitch', lambda: {'images': [(io.BytesIO(data), f'frame_{i:04d}.jpg')
+                                                        for i, data in enumerate(uploads)]})
+
+        yield f"stitch_frames/{count} frames", lambda frames=frames: stitch_frames(frames, mode=STITCH_MODE)
+        yield f"POST /stitch/{count} frames", stitch_endpoint
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """Print each case against the baseline; return the regressed case names"""
+    regressions = []
+    print(f"{'case':<40}{'seconds':>10}{'baseline':>10}{'change':>9}")
+    for name, result in results.items():
+        before = baseline.get(name, {}).get('seconds')
+        seconds = result['seconds']
+        if before is None:
+            print(f"{name:<40}{seconds:>9.3f}s{'-':>10}{'new':>9}")
+            continue
+        change = seconds / before - 1
+        regressed = change > tolerance and seconds - before > min_delta
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<40}{seconds:>9.3f}s{before:>9.3f}s{change:>+8.0%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', help="write results as JSON to this path")
+    parser.add_argument('--baseline', help="earlier results to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown, as a fraction")
+    parser.add_argument('--min-delta', type=float, default=0.05, help="ignore slowdowns under this many seconds")
+    parser.add_argument('--sizes', type=int, nargs='+', metavar='HEIGHTxWIDTH',
+                        help="field heights and widths, as pairs")
+    parser.add_argument('--frames', type=int, nargs='+', help="frame counts for the stitcher")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help="one small field and one short flight")
+    parser.add_argument('--filter', default='', help="only run cases whose name contains this")
+    args = parser.parse_args()
+
+    sizes = QUICK_SIZES if args.quick else SIZES
+    if args.sizes:
+        if len(args.sizes) % 2:
+            parser.error("--sizes takes height and width pairs")
+        sizes = list(zip(args.sizes[::2], args.sizes[1::2]))
+    frame_counts = args.frames or (QUICK_FRAME_COUNTS if args.quick else FRAME_COUNTS)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['cases']
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # The app creates its upload and result folders in the working directory
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            import app as app_module
+            app_module.result_cache = ResultCache(os.path.join(work_dir, 'cache'), 0, 0)
+
+            results = {}
+            for cases in (detector_cases(sizes), stitch_cases(frame_counts, work_dir)):
+                for name, func in cases:
+                    if args.filter not in name:
+                        continue
+                    seconds, runs = best_of(args.repeats, func)
+                    results[name] = {"seconds": round(seconds, 4), "runs": [round(run, 4) for run in runs]}
+                    print(f"{name:<40}{seconds:>9.3f}s", file=sys.stderr)
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        "environment": environment(),
+        "settings": {"sizes": sizes, "frames": frame_counts, "repeats": args.repeats,
+                     "tile_size": app_module.app.config['TILE_SIZE'], "workers": app_module.app.config['WORKERS'],
+                     "stitch_mode": STITCH_MODE},
+        "cases": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+
+    if not args.baseline:
+        return 0
+    regressions = compare(results, baseline, args.tolerance, args.min_delta)
+    if regressions:
+        print(f"{len(regressions)} of {len(results)} cases regressed by more than {args.tolerance:.0%}")
+        return 1
+    print(f"No regressions beyond {args.tolerance:.0%} in {len(results)} cases")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,161 @@
+"""Reproducible synthetic UAV imagery for benchmarks
+
+A field has soil, crop rows, tree canopies and red disease spots; flights
+are overlapping frames cut from it, optionally geotagged. write_dataset()
+lays out the files the standalone scripts read, so they run without real
+imagery:
+    python -m benchmarks.synthetic data/ [--rows 3] [--cols 6]
+"""
+import argparse
+import math
+import os
+
+import cv2
+import numpy as np
+
+
+def synthetic_field(height, width, seed=0):
+    """Nadir view of a field: soil, crop rows, tree canopies and red disease spots"""
+    rng = np.random.default_rng(seed)
+    field = np.empty((height, width, 3), dtype=np.uint8)
+    field[:] = (60, 90, 120)
+    noise = rng.integers(0, 40, size=(height, width, 1), dtype=np.uint8)
+    cv2.add(field, np.repeat(noise, 3, axis=2), dst=field)
+
+    # Crop rows
+    spacing = max(12, height // 60)
+    for y in range(spacing // 2, height, spacing):
+        cv2.line(field, (0, y), (width, y), (40, 140, 50), max(2, spacing // 3))
+
+    # Tree canopies
+    for _ in range(height * width // 40000):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        radius = int(rng.integers(18, 45))
+        cv2.circle(field, center, radius, (20, 80, 25), -1)
+        cv2.circle(field, center, radius // 2, (30, 110, 40), -1)
+
+    # Disease spots
+    for _ in range(height * width // 60000):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.circle(field, center, int(rng.integers(6, 16)), (30, 30, 190), -1)
+    return field
+
+
+def noisy_mask(height, width, density=0.1, seed=0):
+    """Binary canopy mask: speckle at density, blobs, rings around nested blobs and long strands"""
+    rng = np.random.default_rng(seed)
+    mask = np.where(rng.random((height, width)) < density, 255, 0).astype(np.uint8)
+    for _ in range(height * width // 40000):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        radius = int(rng.integers(6, 45))
+        if rng.random() < 0.3:
+            # A ring with a hole, and a blob inside the hole that findContours skips
+            cv2.circle(mask, center, radius, 255, -1)
+            cv2.circle(mask, center, radius * 2 // 3, 0, -1)
+            cv2.circle(mask, center, radius // 3, 255, -1)
+        else:
+            cv2.circle(mask, center, radius, 255 if rng.random() < 0.8 else 0, -1)
+    # Strands long enough to cross several tiles
+    for _ in range(max(1, height * width // 500000)):
+        points = rng.integers(0, (width, height), size=(6, 2)).astype(np.int32)
+        cv2.polylines(mask, [points], False, 255, 3)
+    return mask
+
+
+# Where synthetic flights are geotagged: origin, flying height and metres per pixel
+ORIGIN_LATITUDE = 52.0
+ORIGIN_LONGITUDE = 5.0
+ALTITUDE = 60.0
+GROUND_SAMPLE_DISTANCE = 0.02
+
+
+def _dms(degrees):
+    """EXIF degrees, minutes and seconds of a positive angle"""
+    minutes, seconds = divmod(degrees * 3600, 60)
+    whole, minutes = divmod(minutes, 60)
+    return (float(whole), float(minutes), round(seconds, 4))
+
+
+def write_geotagged(path, image, x, y):
+    """Save a frame as JPEG with EXIF GPS for field pixel (x, y) at its centre"""
+    from PIL import Image
+    latitude = ORIGIN_LATITUDE - y * GROUND_SAMPLE_DISTANCE / 6371000.0 * 180 / math.pi
+    longitude = ORIGIN_LONGITUDE + (x * GROUND_SAMPLE_DISTANCE / (6371000.0 * math.cos(math.radians(ORIGIN_LATITUDE)))
+                                    * 180 / math.pi)
+    exif = Image.Exif()
+    exif.get_ifd(0x8825).update({1: 'N', 2: _dms(latitude), 3: 'E', 4: _dms(longitude), 5: 0, 6: ALTITUDE})
+    Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).save(path, quality=95, exif=exif)
+
+
+def flight_field(rows, cols, frame_size=(600, 800), overlap=0.6, seed=0):
+    """Synthetic orthomosaic just large enough for a rows x cols flight"""
+    frame_height, frame_width = frame_size
+    step_x = int(frame_width * (1 - overlap))
+    step_y = int(frame_height * (1 - overlap))
+    return synthetic_field(frame_height + step_y * (rows - 1), frame_width + step_x * (cols - 1), seed)
+
+
+def flight_frames(field, rows, cols, frame_size=(600, 800), overlap=0.6):
+    """Yield (x, y, frame) for overlapping frames cut from field in serpentine order"""
+    frame_height, frame_width = frame_size
+    step_x = int(frame_width * (1 - overlap))
+    step_y = int(frame_height * (1 - overlap))
+    for row in range(rows):
+        columns = range(cols) if row % 2 == 0 else reversed(range(cols))
+        for col in columns:
+            x, y = col * step_x, row * step_y
+            yield x, y, field[y:y + frame_height, x:x + frame_width]
+
+
+def synthetic_flight(directory, rows=3, cols=6, frame_size=(600, 800), overlap=0.6, seed=0, gps=False, field=None):
+    """Write overlapping frames cut from a synthetic field in serpentine order
+
+    field defaults to flight_field(rows, cols, frame_size, overlap, seed).
+    With gps, every frame carries EXIF GPS tags for its position over the
+    field. Returns the frame paths in flight order.
+    """
+    if field is None:
+        field = flight_field(rows, cols, frame_size, overlap, seed)
+    frame_height, frame_width = frame_size
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for x, y, frame in flight_frames(field, rows, cols, frame_size, overlap):
+        path = os.path.join(directory, f'frame_{len(paths):04d}.jpg')
+        if gps:
+            write_geotagged(path, frame, x + frame_width / 2, y + frame_height / 2)
+        else:
+            cv2.imwrite(path, frame)
+        paths.append(path)
+    return paths
+
+
+def write_dataset(directory, rows=3, cols=6, frame_size=(600, 800), overlap=0.6, seed=0):
+    """Write the inputs the scripts and endpoints expect, all from one synthetic field
+
+    images_nadir_RGB/ holds a geotagged flight for stitch.py and /stitch,
+    and stitchedOutput1.png is the orthomosaic it was cut from, for
+    filter.py, trial.py and the analysis endpoints. Returns the frame paths.
+    """
+    field = flight_field(rows, cols, frame_size, overlap, seed)
+    os.makedirs(directory, exist_ok=True)
+    cv2.imwrite(os.path.join(directory, 'stitchedOutput1.png'), field)
+    return synthetic_flight(os.path.join(directory, 'images_nadir_RGB'), rows, cols, frame_size, overlap,
+                            seed, gps=True, field=field)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic flight and orthomosaic for the scripts")
+    parser.add_argument('directory', help="where images_nadir_RGB/ and stitchedOutput1.png are written")
+    parser.add_argument('--rows', type=int, default=3, help="flight lines")
+    parser.add_argument('--cols', type=int, default=6, help="frames per flight line")
+    parser.add_argument('--frame-size', type=int, nargs=2, default=(600, 800), metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--overlap', type=float, default=0.6, help="overlap between neighbouring frames")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    frames = write_dataset(args.directory, args.rows, args.cols, tuple(args.frame_size), args.overlap, args.seed)
+    print(f"Wrote {len(frames)} frames and stitchedOutput1.png to {args.directory}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Reusable scratch arrays for the mask pipelines
+
+Every mask stage used to return a freshly allocated window-sized array:
+grayscale, blur, HSV, the thresholds and the labels, once per tile and
+per request. A BufferPool hands out arrays by name, shape and dtype: each
+name and dtype is backed by one flat buffer, grown when a larger shape is
+asked for, and every request gets a contiguous view of its front. Edge
+tiles and the odd-sized windows the seam pass re-extracts then reuse the
+memory of a full tile, and OpenCV writes into the views through its dst=
+arguments.
+
+Pools are held per worker: borrowed() checks an idle pool out for the
+current thread and returns it when the task ends, so a buffer is never
+shared by two tasks running at once, and thread pools that are created
+per request still find warm buffers. Process workers keep their own
+pools. A pool is only kept for reuse while the pools kept in the process
+fit a total byte budget; pools borrowed beyond that by a burst of
+concurrent tasks are dropped when their task ends. A buffer stays valid
+until the end of the borrowed() block (or the pooled task) or until the
+same name and dtype is asked for again; results that outlive it must be
+copied out. Outside a borrowed() block every request allocates, as
+before.
+"""
+import functools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+# Bytes each pool keeps between tasks; buffers beyond it are dropped, least recently used first
+DEFAULT_POOL_BYTES = 64 * 1024 * 1024
+# Bytes all the pools kept in a process may hold between them
+DEFAULT_TOTAL_BYTES = 256 * 1024 * 1024
+
+
+class BufferPool:
+    """Flat buffers keyed by (name, dtype), kept up to max_bytes"""
+
+    def __init__(self, max_bytes=DEFAULT_POOL_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.allocations = 0
+        self.reuses = 0
+        self._buffers = OrderedDict()
+
+    def get(self, name, shape, dtype=np.uint8):
+        """An uninitialised array of shape, sharing memory with earlier ones for name"""
+        dtype = np.dtype(dtype)
+        key = (name, dtype.str)
+        size = int(np.prod(shape))
+        buffer = self._buffers.pop(key, None)
+        if buffer is not None:
+            self.nbytes -= buffer.nbytes
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size, dtype)
+            self.allocations += 1
+        else:
+            self.reuses += 1
+        if buffer.nbytes <= self.max_bytes:
+            self._buffers[key] = buffer
+            self.nbytes += buffer.nbytes
+            self._trim()
+        return buffer[:size].reshape(shape)
+
+    def _trim(self):
+        while self.nbytes > self.max_bytes:
+            _, buffer = self._buffers.popitem(last=False)
+            self.nbytes -= buffer.nbytes
+
+    def clear(self):
+        self._buffers.clear()
+        self.nbytes = 0
+
+
+_lock = threading.Lock()
+_pools = []
+_idle = []
+_max_bytes = DEFAULT_POOL_BYTES
+_max_pools = DEFAULT_TOTAL_BYTES // DEFAULT_POOL_BYTES
+# Allocations and reuses of pools already dropped, so stats() keeps counting them
+_retired = {"allocations": 0, "reuses": 0}
+_local = threading.local()
+# Stands in outside borrowed(): keeps nothing, so every request allocates
+_unpooled = BufferPool(0)
+
+
+def configure(max_bytes, total_bytes=DEFAULT_TOTAL_BYTES):
+    """Set the byte budget of every pool and of all the pools kept; 0 turns reuse off"""
+    global _max_bytes, _max_pools
+    with _lock:
+        _max_bytes = max_bytes
+        # At least one pool is kept, so a lone worker always reuses
+        _max_pools = max(1, total_bytes // max_bytes) if max_bytes else 1
+        for pool in _pools:
+            pool.max_bytes = max_bytes
+            pool._trim()
+        while len(_pools) > _max_pools and _idle:
+            _retire(_idle.pop())
+
+
+def _retire(pool):
+    # Called with _lock held
+    _pools.remove(pool)
+    _retired["allocations"] += pool.allocations
+    _retired["reuses"] += pool.reuses
+
+
+def current():
+    """The pool borrowed by this thread, or one that never reuses"""
+    return getattr(_local, 'pool', None) or _unpooled
+
+
+@contextmanager
+def borrowed():
+    """Make an idle pool this thread's current pool for the block"""
+    with _lock:
+        if _idle:
+            pool = _idle.pop()
+        else:
+            pool = BufferPool(_max_bytes)
+            _pools.append(pool)
+    previous = getattr(_local, 'pool', None)
+    _local.pool = pool
+    try:
+        yield pool
+    finally:
+        _local.pool = previous
+        with _lock:
+            if len(_pools) > _max_pools:
+                # One of a burst of concurrent tasks: let its buffers go
+                _retire(pool)
+            else:
+                _idle.append(pool)
+
+
+def pooled(fn):
+    """Decorate a task so it runs with a borrowed pool; the task stays picklable"""
+    @functools.wraps(fn)
+    def task(*args, **kwargs):
+        with borrowed():
+            return fn(*args, **kwargs)
+    return task
+
+
+def stats():
+    """Pool count, buffers allocated and reused, and bytes held, in this process"""
+    with _lock:
+        pools = list(_pools)
+        retired = dict(_retired)
+    return {
+        "pools": len(pools),
+        "allocations": sum(pool.allocations for pool in pools) + _unpooled.allocations + retired["allocations"],
+        "reuses": sum(pool.reuses for pool in pools) + retired["reuses"],
+        "bytes": sum(pool.nbytes for pool in pools),
+    }
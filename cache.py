@@ -0,0 +1,194 @@
+"""Content-addressed cache of endpoint results
+
+A key is the SHA-256 of the endpoint, the digests of its input images in
+order and every setting that changes the result, so the same upload with
+the same settings always maps to the same entry. An entry is the JSON
+metadata of the response plus the encoded result image.
+
+Entries live in two tiers: an in-memory LRU bounded by a byte budget,
+and a directory on disk bounded by total size, where the least recently
+used files are evicted first. Disk hits are promoted to memory.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import metrics
+
+DEFAULT_MEMORY_BYTES = 256 * 1024 * 1024
+DEFAULT_DISK_BYTES = 2 * 1024 * 1024 * 1024
+
+# Bump when an algorithm change or new response fields make old entries wrong
+KEY_VERSION = 2
+
+# Disk eviction frees down to this fraction of the budget, so it runs rarely
+_DISK_LOW_WATER = 0.9
+
+
+def digest(data):
+    """Hex SHA-256 of bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(endpoint, digests, **params):
+    """Key for an endpoint run over inputs with the given digests, in order"""
+    payload = json.dumps([KEY_VERSION, endpoint, list(digests), params], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class _MemoryTier:
+    """LRU of entries whose total size stays within budget bytes"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry, nbytes):
+        """Store an entry, returning how many entries were evicted"""
+        if nbytes > self.budget:
+            return 0
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[-1]
+        self.entries[key] = entry + (nbytes,)
+        self.size += nbytes
+        evicted = 0
+        while self.size > self.budget:
+            _, old = self.entries.popitem(last=False)
+            self.size -= old[-1]
+            evicted += 1
+        return evicted
+
+
+class _DiskTier:
+    """Entry files under directory, one per key, evicted by last use
+
+    Each file is a line of JSON metadata followed by the image bytes.
+    Files are written to a temporary name and renamed, so processes
+    sharing the directory never read half an entry.
+    """
+
+    def __init__(self, directory, budget):
+        self.directory = directory
+        self.budget = budget
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, size, _ in self._scan())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.entry')
+
+    def _scan(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.entry'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline())
+                data = f.read()
+            # The modification time records last use for eviction
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return meta['fields'], data, meta['format']
+
+    def put(self, key, fields, data, fmt):
+        """Store an entry, returning how many entries were evicted"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = json.dumps({"fields": fields, "format": fmt}).encode() + b'\n'
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with metrics.timed('write'), os.fdopen(fd, 'wb') as f:
+            f.write(meta)
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.size += len(meta) + len(data)
+            if self.size > self.budget:
+                return self._evict()
+        return 0
+
+    def _evict(self):
+        # Other processes write here too, so measure the directory afresh
+        files = sorted(self._scan(), key=lambda item: item[2])
+        total = sum(size for _, size, _ in files)
+        evicted = 0
+        for path, size, _ in files:
+            if total <= self.budget * _DISK_LOW_WATER:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        self.size = total
+        return evicted
+
+
+class ResultCache:
+    """Two-tier result cache with hit and miss counters"""
+
+    def __init__(self, directory, memory_bytes=DEFAULT_MEMORY_BYTES, disk_bytes=DEFAULT_DISK_BYTES):
+        self.memory = _MemoryTier(memory_bytes)
+        self.disk = _DiskTier(directory, disk_bytes) if disk_bytes else None
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(
+            ['memory_hits', 'disk_hits', 'misses', 'stores', 'memory_evictions', 'disk_evictions'], 0)
+
+    def get(self, key):
+        """(fields, image bytes, format) stored under key, or None"""
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.counters['memory_hits'] += 1
+                return entry[:3]
+        entry = self.disk.get(key) if self.disk else None
+        with self.lock:
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['disk_hits'] += 1
+            self.counters['memory_evictions'] += self.memory.put(key, entry, len(entry[1]))
+        return entry
+
+    def put(self, key, fields, data, fmt):
+        with self.lock:
+            self.counters['stores'] += 1
+            self.counters['memory_evictions'] += self.memory.put(key, (fields, data, fmt), len(data))
+        if self.disk:
+            evicted = self.disk.put(key, fields, data, fmt)
+            with self.lock:
+                self.counters['disk_evictions'] += evicted
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters['memory_hits'] + self.counters['disk_hits'] + self.counters['misses']
+            hits = lookups - self.counters['misses']
+            return dict(
+                self.counters,
+                hit_rate=hits / lookups if lookups else None,
+                memory_entries=len(self.memory.entries),
+                memory_bytes=self.memory.size,
+                memory_budget=self.memory.budget,
+                disk_bytes=self.disk.size if self.disk else 0,
+                disk_budget=self.disk.budget if self.disk else 0,
+            )
@@ -0,0 +1,155 @@
+import cv2
+import numpy as np
+
+# Longest side of the block grid the exact solver runs on; larger masks are
+# solved on all-valid blocks first and then grown back to pixel precision
+MAX_GRID_SIDE = 512
+
+
+def valid_mask(image):
+    """Threshold a stitched image into a mask of non-black pixels"""
+    if image.ndim == 3:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = image
+    return cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY)[1]
+
+
+class _InvalidCounter:
+    """Constant-time count of invalid pixels inside any rectangle"""
+
+    def __init__(self, mask):
+        invalid = (mask == 0).view(np.uint8)
+        self.integral = cv2.integral(invalid, sdepth=cv2.CV_32S)
+        self.height, self.width = mask.shape[:2]
+
+    def count(self, x, y, w, h):
+        ii = self.integral
+        total = int(ii[y + h, x + w]) - int(ii[y, x + w]) - int(ii[y + h, x]) + int(ii[y, x])
+        # int32 sums may wrap on gigapixel masks; the true count always fits in 32 bits
+        return total & 0xFFFFFFFF
+
+    def is_valid(self, x, y, w, h):
+        if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > self.width or y + h > self.height:
+            return False
+        return self.count(x, y, w, h) == 0
+
+    def block_grid(self, block):
+        """Boolean grid that is True where a whole block x block cell is valid"""
+        rows, cols = self.height // block, self.width // block
+        ys = np.arange(rows + 1) * block
+        xs = np.arange(cols + 1) * block
+        ii = self.integral[np.ix_(ys, xs)].astype(np.int64)
+        sums = ii[1:, 1:] - ii[:-1, 1:] - ii[1:, :-1] + ii[:-1, :-1]
+        return sums == 0
+
+
+def _largest_histogram_rect(grid):
+    """Largest all-True rectangle of a boolean grid as (x, y, w, h)
+
+    Classic row-by-row histogram/stack solver, linear in the grid size.
+    """
+    rows, cols = grid.shape
+    heights = np.zeros(cols, dtype=np.int64)
+    best_area, best = 0, (0, 0, 0, 0)
+    for r in range(rows):
+        heights = np.where(grid[r], heights + 1, 0)
+        stack = []
+        for c, height in enumerate(heights.tolist() + [0]):
+            start = c
+            while stack and stack[-1][1] >= height:
+                start, top = stack.pop()
+                area = top * (c - start)
+                if area > best_area:
+                    best_area, best = area, (start, r - top + 1, c - start, top)
+            stack.append((start, height))
+    return best
+
+
+def _grow_side(counter, rect, side):
+    """Push one side of a valid rectangle outwards as far as it stays valid"""
+    x, y, w, h = rect
+    if side == 'left':
+        limit = x
+        candidate = lambda k: (x - k, y, w + k, h)
+    elif side == 'right':
+        limit = counter.width - (x + w)
+        candidate = lambda k: (x, y, w + k, h)
+    elif side == 'top':
+        limit = y
+        candidate = lambda k: (x, y - k, w, h + k)
+    else:
+        limit = counter.height - (y + h)
+        candidate = lambda k: (x, y, w, h + k)
+
+    # Validity is monotone in k, so binary search the furthest valid offset
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if counter.is_valid(*candidate(mid)):
+            lo = mid
+        else:
+            hi = mid - 1
+    return candidate(lo)
+
+
+def _refine(counter, rect):
+    """Grow a valid rectangle side by side until no side can move"""
+    while True:
+        grown = rect
+        for side in ('left', 'right', 'top', 'bottom'):
+            grown = _grow_side(counter, grown, side)
+        if grown == rect:
+            return rect
+        rect = grown
+
+
+def _shrunk_bounding_rect(counter, mask):
+    """Bounding box of the valid pixels shrunk evenly until it fits
+
+    This is the rectangle the old erode-until-fit loop converged to.
+    """
+    x, y, w, h = cv2.boundingRect(mask)
+    if w == 0 or h == 0:
+        return (0, 0, 0, 0)
+    lo, hi = 0, (min(w, h) - 1) // 2
+    if not counter.is_valid(x + hi, y + hi, w - 2 * hi, h - 2 * hi):
+        return (0, 0, 0, 0)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if counter.is_valid(x + mid, y + mid, w - 2 * mid, h - 2 * mid):
+            hi = mid
+        else:
+            lo = mid + 1
+    return (x + lo, y + lo, w - 2 * lo, h - 2 * lo)
+
+
+def largest_valid_rect(mask, max_grid_side=MAX_GRID_SIDE):
+    """Find the largest axis-aligned rectangle of non-zero mask pixels
+
+    Returns (x, y, w, h); w and h are 0 when the mask has no valid pixel.
+    Masks up to max_grid_side are solved exactly. Larger masks are solved
+    exactly on a grid of fully valid blocks and then grown back to pixel
+    precision, which is never smaller than the old erosion crop.
+    """
+    counter = _InvalidCounter(mask)
+    longest = max(counter.height, counter.width)
+    block = max(1, -(-longest // max_grid_side))
+
+    bx, by, bw, bh = _largest_histogram_rect(counter.block_grid(block))
+    rect = (bx * block, by * block, bw * block, bh * block)
+    if block > 1 and bw and bh:
+        rect = _refine(counter, rect)
+
+    fallback = _shrunk_bounding_rect(counter, mask)
+    if fallback[2] * fallback[3] > rect[2] * rect[3]:
+        rect = _refine(counter, fallback)
+    return rect
+
+
+def crop_to_valid(image, max_grid_side=MAX_GRID_SIDE):
+    """Crop the black border a stitcher leaves around a mosaic"""
+    x, y, w, h = largest_valid_rect(valid_mask(image), max_grid_side)
+    if w == 0 or h == 0:
+        return image
+    return image[y:y + h, x:x + w]
@@ -0,0 +1,252 @@
+"""Detections as columnar arrays on disk, read back a page at a time
+
+A request's contours are reduced to one NumPy structured array with a
+row per detection: bounding box, area, centroid and class (an index into
+CLASSES). The contours themselves are kept as one vertex array plus the
+offset of every contour's first vertex, so a polygon is a slice rather
+than a Python list; polygons are simplified with approxPolyDP only when
+a client asks for them, at the tolerance it asks for.
+
+The arrays are saved as .npy files in a directory named by detection
+class and a hash of their bytes, like result images, and are opened
+memory-mapped: a page of rows or a bounding-box query reads only what
+it needs, and the raw .npy files can be fetched with HTTP range requests
+since every row has the same size.
+"""
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from cache import digest
+
+CLASSES = ('trees', 'areas', 'diseases', 'objects')
+
+DTYPE = np.dtype([
+    ('x', '<i4'), ('y', '<i4'), ('w', '<i4'), ('h', '<i4'),
+    ('area', '<f8'),
+    ('cx', '<f4'), ('cy', '<f4'),
+    ('class', 'u1'),
+])
+
+# Files of a stored set of detections, by array name
+ARRAYS = ('detections', 'vertices', 'offsets')
+
+# Pixels a simplified polygon may stray from its contour by default
+DEFAULT_TOLERANCE = 1.0
+DEFAULT_TTL = 24 * 3600
+# Seconds between retention sweeps of the directory
+CLEANUP_INTERVAL = 300
+
+COLUMNS = ['class', 'x', 'y', 'w', 'h', 'area', 'cx', 'cy']
+
+
+def to_table(found):
+    """(table, vertices, offsets) of {name: contours}, classes in CLASSES order
+
+    Boxes, areas and centroids are computed for every contour at once from
+    the concatenated vertices; area is contourArea's shoelace sum.
+    """
+    contours = [contour for name in CLASSES for contour in found.get(name, ())]
+    count = len(contours)
+    table = np.zeros(count, dtype=DTYPE)
+    table['class'] = np.repeat(np.arange(len(CLASSES), dtype=np.uint8),
+                               [len(found.get(name, ())) for name in CLASSES])
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    if not count:
+        return table, np.empty((0, 2), dtype=np.int32), offsets
+    vertices = np.concatenate(contours).reshape(-1, 2).astype(np.int32, copy=False)
+    np.cumsum([len(contour) for contour in contours], out=offsets[1:])
+    starts = offsets[:-1]
+
+    x, y = vertices[:, 0], vertices[:, 1]
+    table['x'] = np.minimum.reduceat(x, starts)
+    table['y'] = np.minimum.reduceat(y, starts)
+    table['w'] = np.maximum.reduceat(x, starts) - table['x'] + 1
+    table['h'] = np.maximum.reduceat(y, starts) - table['y'] + 1
+
+    # Each vertex with the next one round its own contour
+    following = np.arange(1, len(vertices) + 1)
+    following[offsets[1:] - 1] = starts
+    x, y = x.astype(np.float64), y.astype(np.float64)
+    next_x, next_y = x[following], y[following]
+    cross = x * next_y - next_x * y
+    doubled = np.add.reduceat(cross, starts)
+    table['area'] = np.abs(doubled) / 2
+    # Degenerate contours (lines and points) are centred on their box
+    empty = doubled == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cx = np.add.reduceat((x + next_x) * cross, starts) / (3 * doubled)
+        cy = np.add.reduceat((y + next_y) * cross, starts) / (3 * doubled)
+    table['cx'] = np.where(empty, table['x'] + table['w'] / 2, cx)
+    table['cy'] = np.where(empty, table['y'] + table['h'] / 2, cy)
+    return table, vertices, offsets
+
+
+def boxes(table):
+    """Bounding boxes as an (n, 4) array of x, y, w, h"""
+    return np.stack([table['x'], table['y'], table['w'], table['h']], axis=1)
+
+
+class Detections:
+    """A stored set of detections, memory-mapped"""
+
+    def __init__(self, directory):
+        arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in ARRAYS}
+        self.table = arrays['detections']
+        self.vertices = arrays['vertices']
+        self.offsets = arrays['offsets']
+
+    def __len__(self):
+        return len(self.table)
+
+    def select(self, bbox=None, classes=None):
+        """Row indices of detections overlapping bbox (x0, y0, x1, y1) and of the given classes"""
+        keep = np.ones(len(self.table), dtype=bool)
+        if bbox is not None:
+            x0, y0, x1, y1 = bbox
+            keep &= (self.table['x'] < x1) & (self.table['x'] + self.table['w'] > x0)
+            keep &= (self.table['y'] < y1) & (self.table['y'] + self.table['h'] > y0)
+        if classes is not None:
+            keep &= np.isin(self.table['class'], [CLASSES.index(name) for name in classes])
+        return np.flatnonzero(keep)
+
+    def polygon(self, index, tolerance=DEFAULT_TOLERANCE):
+        """Contour of a detection as an (n, 2) array, simplified unless tolerance is 0"""
+        contour = np.ascontiguousarray(self.vertices[self.offsets[index]:self.offsets[index + 1]])
+        if tolerance:
+            contour = cv2.approxPolyDP(contour.reshape(-1, 1, 2), tolerance, True)
+        return contour.reshape(-1, 2)
+
+    def rows(self, indices, tolerance=None):
+        """Detections at indices as dicts, with polygons unless tolerance is None"""
+        for index in indices:
+            record = self.table[index]
+            row = {
+                "id": int(index),
+                "class": CLASSES[record['class']],
+                "box": [int(record['x']), int(record['y']), int(record['w']), int(record['h'])],
+                "area": float(record['area']),
+                "centroid": [round(float(record['cx']), 2), round(float(record['cy']), 2)],
+            }
+            if tolerance is not None:
+                row["polygon"] = self.polygon(index, tolerance).tolist()
+            yield row
+
+    def summary(self):
+        """Count and total area per class, and the extent of every box"""
+        table = self.table
+        classes = {}
+        for label in np.unique(table['class']):
+            rows = table['class'] == label
+            classes[CLASSES[label]] = {"count": int(rows.sum()), "area": float(table['area'][rows].sum())}
+        extent = None
+        if len(table):
+            extent = [int(table['x'].min()), int(table['y'].min()),
+                      int((table['x'] + table['w']).max()), int((table['y'] + table['h']).max())]
+        return {"count": len(table), "classes": classes, "extent": extent}
+
+
+def csv_lines(detections, indices):
+    """CSV text of the table columns, header first"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['id'] + COLUMNS)
+    for index in indices:
+        record = detections.table[index]
+        writer.writerow([int(index), CLASSES[record['class']], int(record['x']), int(record['y']), int(record['w']),
+                         int(record['h']), float(record['area']), round(float(record['cx']), 2),
+                         round(float(record['cy']), 2)])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+
+def geojson_lines(detections, indices, tolerance=DEFAULT_TOLERANCE):
+    """GeoJSON FeatureCollection of the simplified polygons, in pixel coordinates"""
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ''
+    for row in detections.rows(indices, tolerance):
+        ring = row.pop("polygon")
+        if ring:
+            ring.append(ring[0])
+        feature = {"type": "Feature", "id": row.pop("id"), "properties": row,
+                   "geometry": {"type": "Polygon", "coordinates": [ring]}}
+        yield separator + json.dumps(feature)
+        separator = ','
+    yield ']}\n'
+
+
+class DetectionStore:
+    """Content-addressed detection arrays under directory"""
+
+    def __init__(self, directory, ttl=DEFAULT_TTL, cleanup_interval=CLEANUP_INTERVAL):
+        self.directory = directory
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self._last_cleanup = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, detections_id):
+        return os.path.join(self.directory, detections_id)
+
+    def save(self, name, table, vertices, offsets):
+        """Write the arrays once and return their detections_id"""
+        arrays = {'detections': table, 'vertices': vertices, 'offsets': offsets}
+        detections_id = f"{name}-{digest(b''.join(arrays[key].tobytes() for key in ARRAYS))}"
+        path = self.path(detections_id)
+        if os.path.isdir(path):
+            # Saving the same detections again only refreshes their age
+            os.utime(path)
+        else:
+            # Written aside and renamed, so readers in other workers never see a partial set
+            tmp_path = tempfile.mkdtemp(dir=self.directory, suffix='.tmp')
+            for key in ARRAYS:
+                np.save(os.path.join(tmp_path, key + '.npy'), arrays[key])
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # Another worker stored the same detections first
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        if time.monotonic() - self._last_cleanup >= self.cleanup_interval:
+            self._last_cleanup = time.monotonic()
+            self.cleanup()
+        return detections_id
+
+    def exists(self, detections_id):
+        return os.path.isdir(self.path(detections_id))
+
+    def load(self, detections_id):
+        """Detections stored under detections_id, or None"""
+        try:
+            return Detections(self.path(detections_id))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def cleanup(self, now=None):
+        """Delete detection sets older than the TTL; returns how many were deleted"""
+        if not self.ttl:
+            return 0
+        cutoff = (now or time.time()) - self.ttl
+        removed = 0
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            try:
+                if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                # Another worker's sweep got there first
+                pass
+        return removed
@@ -0,0 +1,266 @@
+"""Mask pipelines and contour filters behind the analysis endpoints
+
+Each detector is a mask function, the radius of the neighbourhood that
+mask function reads around a pixel, an optional per-contour filter and
+the contour area that filter needs to exceed. detect() runs a detector
+through the tiling engine so large mosaics are processed tile by tile
+with the same result as a whole-image run; components too small to pass
+the filter are dropped there from their boxes and never traced.
+
+A detector may also have a screen: a cheap, looser mask run on a
+downsampled copy of the image to find where its mask can be set, so
+detect() can trace only those windows at full resolution (see
+screening.py).
+
+Mask functions read shared intermediates (grayscale, blur, HSV) from a
+Stages graph, so detect_many() computes each intermediate once per tile
+however many detectors ask for it. Intermediates and masks are written
+into buffers from the current buffer pool (see buffers.py), so a worker
+reuses the same arrays from tile to tile.
+"""
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+import buffers
+import metrics
+from screening import find_contours_screened
+from tiling import DEFAULT_OVERLAP, DEFAULT_TILE_SIZE, find_contours_many, find_contours_tiled
+
+TREE_MIN_AREA = 1000
+DISEASE_MIN_AREA = 100
+DISEASE_MAX_AREA = 1000
+OBJECT_MIN_AREA = 2000
+
+# Red hue range used for disease spots
+DISEASE_LOWER = np.array([0, 50, 50])
+DISEASE_UPPER = np.array([10, 255, 255])
+DISEASE_KERNEL = np.ones((5, 5), np.uint8)
+
+# Green hue range used for canopy cover
+GREEN_LOWER = np.array([35, 40, 40])
+GREEN_UPPER = np.array([85, 255, 255])
+
+# Screens run on downsampled images, where averaging with the surroundings
+# dulls small spots: a less saturated red, stopping short of soil hues, and
+# the dark green of tree canopy rather than the brighter crop rows
+DISEASE_SCREEN_LOWER = np.array([0, 40, 40])
+DISEASE_SCREEN_UPPER = np.array([12, 255, 255])
+CANOPY_SCREEN_LOWER = np.array([35, 40, 40])
+CANOPY_SCREEN_UPPER = np.array([85, 255, 120])
+
+Detector = namedtuple('Detector', ['mask', 'radius', 'keep', 'min_area', 'screen'])
+
+
+def _gray(stages):
+    return cv2.cvtColor(stages.image, cv2.COLOR_BGR2GRAY, dst=stages.buffer('gray'))
+
+
+def _blurred(stages):
+    return cv2.GaussianBlur(stages.get('gray'), (5, 5), 0, dst=stages.buffer('blurred'))
+
+
+def _hsv(stages):
+    return cv2.cvtColor(stages.image, cv2.COLOR_BGR2HSV, dst=stages.buffer('hsv', 3))
+
+
+STAGES = {
+    'gray': _gray,
+    'blurred': _blurred,
+    'hsv': _hsv,
+}
+
+# Stage each intermediate is timed under in metrics.STAGE_SECONDS
+STAGE_METRICS = {
+    'gray': 'color',
+    'blurred': 'blur',
+    'hsv': 'color',
+}
+
+
+class Stages:
+    """Intermediates of one image, each computed on first use and kept
+
+    Arrays come from pool, the current buffer pool by default, so they
+    are only valid while that pool is borrowed.
+    """
+
+    def __init__(self, image, pool=None):
+        self.image = image
+        self.pool = pool or buffers.current()
+        self._done = {}
+
+    def buffer(self, name, channels=1):
+        """Image-sized uint8 output array for the stage or mask called name"""
+        height, width = self.image.shape[:2]
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        return self.pool.get(name, shape)
+
+    def get(self, name):
+        if name not in self._done:
+            with metrics.timed(STAGE_METRICS[name]):
+                self._done[name] = STAGES[name](self)
+        return self._done[name]
+
+
+def tree_mask(stages):
+    """Adaptive threshold of the blurred grayscale image"""
+    return cv2.adaptiveThreshold(stages.get('blurred'), 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 11, 4,
+                                 dst=stages.buffer('trees'))
+
+
+def area_mask(stages):
+    """Dark regions of the blurred grayscale image"""
+    return cv2.threshold(stages.get('blurred'), 150, 255, cv2.THRESH_BINARY_INV, dst=stages.buffer('areas'))[1]
+
+
+def disease_mask(stages):
+    """Red hue mask, blurred and closed to join nearby spots, all in one buffer"""
+    mask = cv2.inRange(stages.get('hsv'), DISEASE_LOWER, DISEASE_UPPER, dst=stages.buffer('diseases'))
+    cv2.GaussianBlur(mask, (11, 11), 0, dst=mask)
+    return cv2.morphologyEx(mask, cv2.MORPH_CLOSE, DISEASE_KERNEL, dst=mask)
+
+
+def green_mask(stages):
+    """Green hue mask; reads no neighbours"""
+    return cv2.inRange(stages.get('hsv'), GREEN_LOWER, GREEN_UPPER, dst=stages.buffer('green'))
+
+
+def object_mask(stages):
+    """Every pixel that is not pure black"""
+    return cv2.threshold(stages.get('gray'), 1, 255, cv2.THRESH_BINARY, dst=stages.buffer('objects'))[1]
+
+
+def disease_screen(stages):
+    """Loose red hue mask of a downsampled image"""
+    return cv2.inRange(stages.get('hsv'), DISEASE_SCREEN_LOWER, DISEASE_SCREEN_UPPER, dst=stages.buffer('screen'))
+
+
+def canopy_screen(stages):
+    """Dark green canopy of a downsampled image; trees are traced where there is canopy"""
+    return cv2.inRange(stages.get('hsv'), CANOPY_SCREEN_LOWER, CANOPY_SCREEN_UPPER, dst=stages.buffer('screen'))
+
+
+def object_screen(stages):
+    """Pixels of a downsampled image that are not pure black
+
+    Area averaging keeps any bright pixel above zero, so this finds every object.
+    """
+    return cv2.threshold(stages.get('gray'), 0, 255, cv2.THRESH_BINARY, dst=stages.buffer('screen'))[1]
+
+
+def is_tree(contour):
+    return cv2.contourArea(contour) > TREE_MIN_AREA
+
+
+def is_disease(contour):
+    return DISEASE_MIN_AREA < cv2.contourArea(contour) < DISEASE_MAX_AREA and cv2.isContourConvex(contour)
+
+
+def is_object(contour):
+    return cv2.contourArea(contour) > OBJECT_MIN_AREA
+
+
+DETECTORS = {
+    # blur radius 2 + adaptive block radius 5
+    'trees': Detector(tree_mask, 7, is_tree, TREE_MIN_AREA, canopy_screen),
+    # blur radius 2; dark regions are most of a field, so there is nothing to screen
+    'areas': Detector(area_mask, 2, None, None, None),
+    # blur radius 5 + closing radius 2 + 2
+    'diseases': Detector(disease_mask, 9, is_disease, DISEASE_MIN_AREA, disease_screen),
+    'objects': Detector(object_mask, 0, is_object, OBJECT_MIN_AREA, object_screen),
+}
+
+
+class _StageMask:
+    """mask_fn for one detector; a class so it pickles for process workers"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, window):
+        with metrics.timed('threshold'):
+            return DETECTORS[self.name].mask(Stages(window))
+
+
+class _StageMasks:
+    """Masks of several detectors over one shared Stages graph"""
+
+    def __init__(self, names):
+        self.names = names
+
+    def __call__(self, window):
+        stages = Stages(window)
+        with metrics.timed('threshold'):
+            return [DETECTORS[name].mask(stages) for name in self.names]
+
+
+class _StageScreen:
+    """screen_fn for one detector"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, small):
+        return DETECTORS[self.name].screen(Stages(small))
+
+
+def _keep(name, contours):
+    keep = DETECTORS[name].keep
+    if keep is None:
+        return contours
+    with metrics.timed('filter'):
+        return [cnt for cnt in contours if keep(cnt)]
+
+
+def detect(name, image, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP, workers=1, backend='thread',
+           screen=None):
+    """Contours found by the named detector, filtered by its contour test
+
+    With a screening.Screen, and a detector that has a screen, only the
+    candidate windows found on the downsampled image are traced.
+    """
+    detector = DETECTORS[name]
+    if screen is not None and detector.screen is not None:
+        contours = find_contours_screened(image, _StageMask(name), _StageScreen(name), detector.radius, screen,
+                                          tile_size, overlap, workers, backend, detector.min_area)
+    else:
+        contours = find_contours_tiled(image, _StageMask(name), detector.radius, tile_size, overlap, workers,
+                                       backend, detector.min_area)
+    return _keep(name, contours)
+
+
+def summarize(name, contours, inline_limit=None):
+    """Response fields of the single-analysis endpoint for name
+
+    Bounding boxes of areas are listed only when there are at most
+    inline_limit of them (always when it is None).
+    """
+    if name == 'trees':
+        return {"tree_count": len(contours)}
+    if name == 'areas':
+        fields = {"detected_areas": len(contours)}
+        if inline_limit is None or len(contours) <= inline_limit:
+            fields["bounding_boxes"] = [cv2.boundingRect(cnt) for cnt in contours]
+        return fields
+    if name == 'diseases':
+        return {"disease_count": len(contours)}
+    return {"object_count": len(contours)}
+
+
+def detect_many(names, image, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP, workers=1, backend='thread'):
+    """Contours of several detectors from one pass over the image
+
+    Masks are computed tile by tile with the intermediates shared between
+    detectors, and each is traced in the same tile pass as detect() would,
+    so no mask is ever image-sized. Returns {name: contours}, equal to
+    calling detect() once per name.
+    """
+    names = list(dict.fromkeys(names))
+    if not names:
+        return {}
+    radius = max(DETECTORS[name].radius for name in names)
+    found = find_contours_many(image, _StageMasks(names), [DETECTORS[name].min_area for name in names], radius,
+                               tile_size, overlap, workers, backend)
+    return {name: _keep(name, contours) for name, contours in zip(names, found)}
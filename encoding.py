@@ -0,0 +1,58 @@
+"""Client-selectable encodings for result images
+
+Each format has the OpenCV parameter controlling its size/quality trade
+off: the compression level for PNG, the quality for JPEG and WebP.
+"""
+import cv2
+
+import metrics
+
+# format: (extension, mimetype, imwrite flag, lowest, highest, default)
+FORMATS = {
+    'png': ('.png', 'image/png', cv2.IMWRITE_PNG_COMPRESSION, 0, 9, 1),
+    'jpeg': ('.jpg', 'image/jpeg', cv2.IMWRITE_JPEG_QUALITY, 1, 100, 90),
+    'webp': ('.webp', 'image/webp', cv2.IMWRITE_WEBP_QUALITY, 1, 100, 90),
+}
+
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+
+
+def parse_encoding(fmt=None, level=None):
+    """Validated (format, level) from request values, with defaults
+
+    level is the PNG compression level or the JPEG/WebP quality. Raises
+    ValueError for an unknown format or an out-of-range level.
+    """
+    fmt = (fmt or 'png').lower()
+    fmt = FORMAT_ALIASES.get(fmt, fmt)
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown image format: {fmt}")
+    _, _, _, lowest, highest, default = FORMATS[fmt]
+    if level in (None, ''):
+        return fmt, default
+    try:
+        level = int(level)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {fmt} level: {level}")
+    if not lowest <= level <= highest:
+        raise ValueError(f"{fmt} level must be between {lowest} and {highest}")
+    return fmt, level
+
+
+def extension(fmt):
+    return FORMATS[fmt][0]
+
+
+def mimetype(fmt):
+    return FORMATS[fmt][1]
+
+
+@metrics.timed('encode')
+def encode_image(image, fmt='png', level=None):
+    """Encode an image once, returning the encoded bytes"""
+    fmt, level = parse_encoding(fmt, level)
+    ext, _, flag, _, _, _ = FORMATS[fmt]
+    ok, buffer = cv2.imencode(ext, image, [flag, level])
+    if not ok:
+        raise ValueError(f"Could not encode image as {fmt}")
+    return buffer.tobytes()
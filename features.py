@@ -0,0 +1,184 @@
+"""Feature cache and neighbour pair selection for the stitcher
+
+Keypoints and descriptors are computed once per frame and stored under
+the frame's SHA-256, so restitching a flight, or stitching it again with
+other settings, skips feature detection. Entries are compact: keypoints
+are float32 columns and SIFT descriptors, whose values are integers in
+0-255, are stored as uint8 like ORB's.
+
+Matching every pair of frames is quadratic in the frame count, so each
+frame is paired only with its k nearest neighbours: by EXIF GPS position
+and altitude when every frame carries them, otherwise by flight order.
+"""
+import math
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+DETECTORS = ('orb', 'sift')
+DEFAULT_DETECTOR = 'orb'
+DEFAULT_FEATURES = 500
+DEFAULT_NEIGHBOURS = 4
+
+GPS_IFD = 0x8825
+EARTH_RADIUS = 6371000.0
+
+_COLUMNS = ('points', 'sizes', 'angles', 'responses', 'octaves', 'descriptors')
+
+
+def create_finder(detector=DEFAULT_DETECTOR, count=DEFAULT_FEATURES):
+    if detector == 'orb':
+        return cv2.ORB_create(count)
+    if detector == 'sift':
+        return cv2.SIFT_create(count)
+    raise ValueError(f"Unknown feature detector: {detector}")
+
+
+def detect_features(image, detector=DEFAULT_DETECTOR, count=DEFAULT_FEATURES, mask=None):
+    """Keypoint columns and descriptors of an image, as a dict of arrays"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    keypoints, descriptors = create_finder(detector, count).detectAndCompute(gray, mask)
+    width = 128 if detector == 'sift' else 32
+    if descriptors is None:
+        descriptors = np.empty((0, width), np.uint8)
+    return {
+        "points": np.float32([keypoint.pt for keypoint in keypoints]).reshape(-1, 2),
+        "sizes": np.float32([keypoint.size for keypoint in keypoints]),
+        "angles": np.float32([keypoint.angle for keypoint in keypoints]),
+        "responses": np.float32([keypoint.response for keypoint in keypoints]),
+        "octaves": np.int32([keypoint.octave for keypoint in keypoints]),
+        "descriptors": np.clip(descriptors, 0, 255).astype(np.uint8)
+    }
+
+
+def descriptors_for_matching(features, detector=DEFAULT_DETECTOR):
+    """Descriptors in the dtype the detector's matcher expects"""
+    if detector == 'sift':
+        return features['descriptors'].astype(np.float32)
+    return features['descriptors']
+
+
+def image_features(index, size, features, detector=DEFAULT_DETECTOR):
+    """cv2.detail.ImageFeatures of one frame, for the detail stitching pipeline"""
+    # Assigning descriptors to a default-constructed ImageFeatures crashes the
+    # Python bindings, so start from an empty one built by OpenCV itself
+    result = cv2.detail.computeImageFeatures2(cv2.ORB_create(), np.zeros((8, 8), np.uint8))
+    result.img_idx = index
+    result.img_size = size
+    result.keypoints = tuple(
+        cv2.KeyPoint(float(x), float(y), float(s), float(a), float(r), int(o)) for (x, y), s, a, r, o
+        in zip(features['points'], features['sizes'], features['angles'], features['responses'], features['octaves']))
+    result.descriptors = cv2.UMat(descriptors_for_matching(features, detector))
+    return result
+
+
+class FeatureStore:
+    """Features on disk under directory, keyed by image digest and settings
+
+    One .npz file per image, detector, feature count and working size;
+    files are written to a temporary name and renamed, so processes
+    sharing the directory never read half an entry.
+    """
+
+    def __init__(self, directory, detector=DEFAULT_DETECTOR, count=DEFAULT_FEATURES):
+        if detector not in DETECTORS:
+            raise ValueError(f"Unknown feature detector: {detector}")
+        self.directory = os.path.join(directory, f'{detector}-{count}')
+        self.detector = detector
+        self.count = count
+
+    def _path(self, digest, size):
+        width, height = size
+        return os.path.join(self.directory, digest[:2], f'{digest}-{width}x{height}.npz')
+
+    def get(self, digest, size):
+        path = self._path(digest, size)
+        try:
+            with np.load(path) as data:
+                features = {name: data[name] for name in _COLUMNS}
+            # A hit refreshes the entry's age, so features in use are not swept
+            os.utime(path)
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+        return features
+
+    def put(self, digest, size, features):
+        path = self._path(digest, size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **features)
+        os.replace(tmp_path, path)
+
+    def features(self, digest, image, mask=None):
+        """Features of an image, detected only on a cache miss"""
+        size = (image.shape[1], image.shape[0])
+        features = self.get(digest, size)
+        if features is None:
+            features = detect_features(image, self.detector, self.count, mask)
+            self.put(digest, size, features)
+        return features
+
+
+def _degrees(value, ref):
+    """Decimal degrees from EXIF degrees, minutes and seconds"""
+    degrees = float(value[0]) + float(value[1]) / 60 + float(value[2]) / 3600
+    return -degrees if ref in ('S', 'W') else degrees
+
+
+def read_gps(path):
+    """(latitude, longitude, altitude) from a frame's EXIF, or None"""
+    # Pillow reads EXIF from the header without decoding any pixels
+    from PIL import Image
+    try:
+        with Image.open(path) as image:
+            gps = image.getexif().get_ifd(GPS_IFD)
+    except (OSError, ValueError):
+        return None
+    if 2 not in gps or 4 not in gps:
+        return None
+    try:
+        latitude = _degrees(gps[2], gps.get(1, 'N'))
+        longitude = _degrees(gps[4], gps.get(3, 'E'))
+        altitude = float(gps.get(6, 0))
+    except (TypeError, ValueError, IndexError, ZeroDivisionError):
+        return None
+    if gps.get(5) in (1, b'\x01'):
+        altitude = -altitude
+    return latitude, longitude, altitude
+
+
+def gps_positions(paths):
+    """Local east, north and up positions in metres, or None if a frame has no GPS"""
+    fixes = []
+    for path in paths:
+        fix = read_gps(path) if isinstance(path, str) else None
+        if fix is None:
+            return None
+        fixes.append(fix)
+    fixes = np.array(fixes, np.float64)
+    latitude, longitude = np.radians(fixes[:, 0]), np.radians(fixes[:, 1])
+    east = (longitude - longitude[0]) * math.cos(latitude.mean()) * EARTH_RADIUS
+    north = (latitude - latitude[0]) * EARTH_RADIUS
+    return np.column_stack([east, north, fixes[:, 2]])
+
+
+def neighbour_mask(count, k=DEFAULT_NEIGHBOURS, positions=None):
+    """Symmetric uint8 matrix marking each frame's k nearest neighbours
+
+    positions are per-frame coordinates, such as gps_positions; without
+    them, frames are taken to be in flight order and the neighbours are
+    the k frames nearest in that order.
+    """
+    if positions is None:
+        positions = np.arange(count, dtype=np.float64)
+    positions = np.asarray(positions, np.float64).reshape(count, -1)
+    distances = np.linalg.norm(positions[:, None] - positions[None], axis=2)
+    np.fill_diagonal(distances, np.inf)
+    mask = np.zeros((count, count), np.uint8)
+    nearest = np.argsort(distances, axis=1, kind='stable')[:, :min(k, count - 1)]
+    rows = np.repeat(np.arange(count), nearest.shape[1])
+    mask[rows, nearest.ravel()] = 1
+    return mask | mask.T
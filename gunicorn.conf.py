@@ -0,0 +1,40 @@
+"""Gunicorn settings for serving the API
+
+Threaded workers (gthread) give every connection its own thread, so a
+slow upload or a long /stitch no longer blocks a whole worker: /api,
+/test, /results and the other cheap endpoints are answered while the
+CPU-heavy endpoints wait for admission (see admission.py and CPU_SLOTS
+in app.py). Each worker process has its own slots and caches.
+
+The master imports the app before forking (preload_app), together with
+the analyses app.py otherwise imports on first use, so every worker
+shares one copy of OpenCV, NumPy and the detector tables copy-on-write
+and a restarted worker is up at once. Each worker then sets its OpenCV
+thread count and starts its job runner in post_fork. PRELOAD_APP=0 has
+every worker import the app for itself instead.
+
+Run from the repository root:
+    gunicorn -c gunicorn.conf.py app:app
+"""
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# app.py splits the CPUs between this many processes, for its worker pools and OpenCV
+raw_env = [f'WEB_CONCURRENCY={workers}']
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+# Stitching a flight takes minutes; only a worker stuck for longer is restarted
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 600))
+graceful_timeout = 30
+
+preload_app = os.environ.get('PRELOAD_APP', '1') != '0'
+# Tells app.py to preload() rather than start the job runner in the master
+if preload_app:
+    raw_env.append('APP_PRELOAD=1')
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import app
+        app.start_worker()
@@ -0,0 +1,411 @@
+"""Flight history: per-zone change between repeated flights of a field
+
+Every flight of a field is registered to the field's first flight, its
+reference, so all flights share one grid of square zones in reference
+pixels. A new mosaic is matched against the previous flight (then the
+reference, if that fails) with ORB features of a downscaled copy, kept
+in a FeatureStore as the stitcher keeps frame features, so an old
+flight's features are never computed again. The similarity found by
+RANSAC is chained onto that flight's own, and the mosaic is warped into
+the reference frame once.
+
+Green cover and disease fraction per zone are block sums of the green
+and disease masks over the warped mosaic; tree count per zone is a
+bincount of tree centroids. Zones the mosaic covers less than
+MIN_COVERAGE of are not measured. Changes are the difference of these
+grids and the previous flight's, saved next to them, so no old imagery
+is read again.
+
+Flights and per-zone summaries are rows in a SQLite database indexed by
+field and date, so a season's trend for a field or a single zone is a
+query over precomputed numbers.
+
+Usage:
+    python history.py history/ field7 2024-06-07 mosaic.png
+    python history.py history/ field7 --trend [--zone 12]
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+
+import cv2
+import numpy as np
+
+import detections
+from cache import digest as content_digest
+from detectors import DETECTORS, Stages, detect, disease_mask, green_mask
+from features import FeatureStore
+from incremental import SessionLock, match_points
+from ingest import file_digest
+from stitch import resize_to_megapix
+from tiling import DEFAULT_OVERLAP, DEFAULT_TILE_SIZE, masks_tiled
+
+DATABASE_NAME = 'history.sqlite3'
+FEATURES_DIR = 'features'
+ZONES_NAME = 'zones.npz'
+
+DEFAULT_ZONE_SIZE = 256
+REGISTER_MEGAPIX = 4.0
+REGISTER_FEATURES = 4000
+MIN_INLIERS = 30
+# Reprojection error allowed by RANSAC, in registration pixels
+RANSAC_THRESHOLD = 3.0
+# Zones with less of their area inside a flight's mosaic are not measured
+MIN_COVERAGE = 0.5
+
+MEASURES = ('green_cover', 'disease_fraction', 'tree_count')
+CHANGES = ('green_change', 'disease_change', 'tree_change')
+
+FIELD_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]*$')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS flights (
+    field TEXT NOT NULL,
+    date TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    work_width INTEGER NOT NULL,
+    work_height INTEGER NOT NULL,
+    transform TEXT NOT NULL,
+    registered_to TEXT,
+    inliers INTEGER,
+    zone_size INTEGER NOT NULL,
+    zones INTEGER NOT NULL,
+    green_cover REAL,
+    disease_fraction REAL,
+    tree_count INTEGER,
+    created REAL NOT NULL,
+    PRIMARY KEY (field, date)
+);
+CREATE TABLE IF NOT EXISTS zones (
+    field TEXT NOT NULL,
+    zone INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    green_cover REAL,
+    disease_fraction REAL,
+    tree_count INTEGER,
+    green_change REAL,
+    disease_change REAL,
+    tree_change INTEGER,
+    PRIMARY KEY (field, zone, date)
+);
+CREATE INDEX IF NOT EXISTS zones_flight ON zones (field, date);
+"""
+
+
+class RegistrationError(Exception):
+    """A mosaic could not be aligned with the field's earlier flights"""
+
+
+def parse_date(value):
+    """ISO date string of a YYYY-MM-DD value; raises ValueError"""
+    try:
+        return datetime.date.fromisoformat(value).isoformat()
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid date: {value!r}; expected YYYY-MM-DD")
+
+
+def check_field(field):
+    if not field or not FIELD_NAME.match(field):
+        raise ValueError(f"Invalid field name: {field!r}")
+    return field
+
+
+def zone_sums(mask, zone_size):
+    """Count of nonzero pixels of mask in every zone, as a rows x cols grid"""
+    height, width = mask.shape[:2]
+    hit = mask != 0
+    rows = np.add.reduceat(hit, np.arange(0, height, zone_size), axis=0, dtype=np.int64)
+    return np.add.reduceat(rows, np.arange(0, width, zone_size), axis=1)
+
+
+def zone_areas(height, width, zone_size):
+    """Pixels in every zone, smaller along the bottom and right edges"""
+    heights = np.minimum(zone_size, height - np.arange(0, height, zone_size))
+    widths = np.minimum(zone_size, width - np.arange(0, width, zone_size))
+    return np.outer(heights, widths)
+
+
+class _FlightMasks:
+    """Green and disease masks of a window; a class so it pickles for process workers"""
+
+    def __call__(self, window):
+        stages = Stages(window)
+        return [green_mask(stages), disease_mask(stages)]
+
+
+def _finite(value):
+    return None if value is None or not math.isfinite(value) else value
+
+
+class FlightHistory:
+    """Flights of many fields under directory: features, zone grids and a SQLite index"""
+
+    def __init__(self, directory, zone_size=DEFAULT_ZONE_SIZE):
+        self.directory = directory
+        self.zone_size = zone_size
+        os.makedirs(directory, exist_ok=True)
+        self.store = FeatureStore(os.path.join(directory, FEATURES_DIR), 'orb', REGISTER_FEATURES)
+        with closing(self._connect()) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(_SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(os.path.join(self.directory, DATABASE_NAME), timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _field_dir(self, field):
+        return os.path.join(self.directory, check_field(field))
+
+    def fields(self):
+        """Every field with its flight count and first and last dates"""
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT field, COUNT(*) AS flights, MIN(date) AS first, MAX(date) AS last '
+                              'FROM flights GROUP BY field ORDER BY field').fetchall()
+        return [dict(row) for row in rows]
+
+    def flights(self, field):
+        """Flights of a field in date order, with their field-wide measures"""
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT * FROM flights WHERE field = ? ORDER BY date', (field,)).fetchall()
+        flights = []
+        for row in rows:
+            flight = dict(row)
+            flight['transform'] = json.loads(flight['transform'])
+            flights.append(flight)
+        return flights
+
+    def add_flight(self, field, date, image, digest=None, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP,
+                   workers=1, backend='thread'):
+        """Register a mosaic flown on date, measure its zones and store them
+
+        Flights must be added in date order. Returns the flight's summary
+        with field-wide changes and the zones that changed most. Raises
+        ValueError for a bad field, date or order and RegistrationError
+        when the mosaic cannot be aligned.
+        """
+        date = parse_date(date)
+        directory = self._field_dir(field)
+        os.makedirs(directory, exist_ok=True)
+        if digest is None:
+            digest = content_digest(np.ascontiguousarray(image).tobytes())
+        with SessionLock(directory):
+            flights = self.flights(field)
+            if flights and date <= flights[-1]['date']:
+                raise ValueError(f"Flights of {field} must be added in date order; the last is {flights[-1]['date']}")
+
+            height, width = image.shape[:2]
+            work = resize_to_megapix(image, REGISTER_MEGAPIX)
+            features = self.store.features(digest, work)
+            scale = work.shape[1] / width
+            if flights:
+                reference = flights[0]
+                transform, registered_to, inliers = self._register(features, scale, flights)
+                size = (reference['width'], reference['height'])
+                zone_size = reference['zone_size']
+            else:
+                transform, registered_to, inliers = np.eye(3)[:2], None, None
+                size = (width, height)
+                zone_size = self.zone_size
+
+            grids = self._measure(image, transform, size, zone_size, tile_size, overlap, workers, backend)
+            previous = self._grids(field, flights[-1]['date']) if flights else None
+            for measure, change in zip(MEASURES, CHANGES):
+                grids[change] = (grids[measure] - previous[measure] if previous is not None
+                                 else np.full_like(grids[measure], np.nan))
+            self._save_grids(field, date, grids)
+
+            measured = np.isfinite(grids['green_cover'])
+            pixels = grids['pixels'][measured].sum()
+            totals = {
+                "green_cover": float(grids['green'][measured].sum() / pixels) if pixels else None,
+                "disease_fraction": float(grids['diseased'][measured].sum() / pixels) if pixels else None,
+                "tree_count": int(np.nansum(grids['tree_count'])),
+            }
+            self._insert(field, date, digest, (width, height), work.shape[1::-1], transform, registered_to,
+                         inliers, zone_size, grids, totals)
+        return self.flight_summary(field, date)
+
+    def _register(self, features, scale, flights):
+        """Transform of new mosaic pixels to reference pixels, the date matched and its inliers"""
+        previous = flights[-1]
+        candidates = [previous] if previous is flights[0] else [previous, flights[0]]
+        for flight in candidates:
+            known = self.store.get(flight['digest'], (flight['work_width'], flight['work_height']))
+            if known is None:
+                continue
+            pairs = match_points(features['descriptors'], known['descriptors'])
+            if len(pairs) < MIN_INLIERS:
+                continue
+            known_scale = flight['work_width'] / flight['width']
+            matrix, inliers = cv2.estimateAffinePartial2D(
+                features['points'][pairs[:, 0]] / scale, known['points'][pairs[:, 1]] / known_scale,
+                method=cv2.RANSAC, ransacReprojThreshold=RANSAC_THRESHOLD / scale)
+            if matrix is None or int(inliers.sum()) < MIN_INLIERS:
+                continue
+            # Chain onto the matched flight's own transform to the reference
+            to_flight = np.vstack([matrix, [0, 0, 1]])
+            to_reference = np.vstack([np.asarray(flight['transform'], np.float64), [0, 0, 1]])
+            return (to_reference @ to_flight)[:2], flight['date'], int(inliers.sum())
+        raise RegistrationError("Could not align the mosaic with the field's earlier flights")
+
+    def _measure(self, image, transform, size, zone_size, tile_size, overlap, workers, backend):
+        """Per-zone grids of a mosaic warped into the reference frame"""
+        width, height = size
+        warped = cv2.warpAffine(image, transform, size, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+        valid = cv2.warpAffine(np.full(image.shape[:2], 255, np.uint8), transform, size, flags=cv2.INTER_NEAREST)
+        green, diseased = masks_tiled(warped, _FlightMasks(), DETECTORS['diseases'].radius, tile_size, workers,
+                                      backend)
+        cv2.bitwise_and(green, valid, dst=green)
+        cv2.bitwise_and(diseased, valid, dst=diseased)
+
+        pixels = zone_sums(valid, zone_size)
+        rows, cols = pixels.shape
+        trees = detect('trees', warped, tile_size, overlap, workers, backend)
+        table = detections.to_table({'trees': trees})[0]
+        x = np.clip(table['cx'].astype(np.int64), 0, width - 1)
+        y = np.clip(table['cy'].astype(np.int64), 0, height - 1)
+        inside = valid[y, x] != 0
+        tree_counts = np.bincount((y[inside] // zone_size) * cols + x[inside] // zone_size,
+                                  minlength=rows * cols).reshape(rows, cols)
+
+        measured = pixels >= MIN_COVERAGE * zone_areas(height, width, zone_size)
+        covered = np.maximum(pixels, 1)
+        green_sums, diseased_sums = zone_sums(green, zone_size), zone_sums(diseased, zone_size)
+        return {
+            "pixels": pixels,
+            "green": green_sums,
+            "diseased": diseased_sums,
+            "green_cover": np.where(measured, green_sums / covered, np.nan),
+            "disease_fraction": np.where(measured, diseased_sums / covered, np.nan),
+            "tree_count": np.where(measured, tree_counts, np.nan),
+        }
+
+    def _grids_path(self, field, date):
+        return os.path.join(self._field_dir(field), date, ZONES_NAME)
+
+    def _grids(self, field, date):
+        with np.load(self._grids_path(field, date)) as data:
+            return {name: data[name] for name in data.files}
+
+    def _save_grids(self, field, date, grids):
+        path = self._grids_path(field, date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **grids)
+        os.replace(tmp_path, path)
+
+    def _insert(self, field, date, digest, size, work_size, transform, registered_to, inliers, zone_size, grids,
+                totals):
+        rows, cols = grids['pixels'].shape
+        measured = np.flatnonzero(np.isfinite(grids['green_cover']).ravel())
+        columns = [grids[name].ravel()[measured] for name in MEASURES + CHANGES]
+        zone_rows = [
+            (field, int(zone), date, int(zone % cols) * zone_size, int(zone // cols) * zone_size,
+             *(_finite(float(values[i])) for values in columns))
+            for i, zone in enumerate(measured)
+        ]
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('INSERT INTO flights (field, date, digest, width, height, work_width, work_height, transform, '
+                       'registered_to, inliers, zone_size, zones, green_cover, disease_fraction, tree_count, created) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (field, date, digest, size[0], size[1], work_size[0], work_size[1],
+                        json.dumps(np.round(transform, 6).tolist()), registered_to, inliers, zone_size,
+                        len(zone_rows), totals['green_cover'], totals['disease_fraction'], totals['tree_count'],
+                        time.time()))
+            db.executemany('INSERT INTO zones (field, zone, date, x, y, green_cover, disease_fraction, tree_count, '
+                           'green_change, disease_change, tree_change) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           zone_rows)
+            db.execute('COMMIT')
+
+    def flight_summary(self, field, date, hotspots=5):
+        """A flight's measures, its change from the flight before and the zones whose disease grew most"""
+        flights = self.flights(field)
+        dates = [flight['date'] for flight in flights]
+        if date not in dates:
+            return None
+        index = dates.index(date)
+        flight = flights[index]
+        summary = {name: flight[name] for name in ('field', 'date', 'width', 'height', 'registered_to', 'inliers',
+                                                   'zone_size', 'zones', 'transform') + MEASURES}
+        if index:
+            before = flights[index - 1]
+            summary['previous'] = before['date']
+            summary['changes'] = {name: (flight[name] - before[name]
+                                         if flight[name] is not None and before[name] is not None else None)
+                                  for name in MEASURES}
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT * FROM zones WHERE field = ? AND date = ? AND disease_change IS NOT NULL '
+                              'ORDER BY disease_change DESC LIMIT ?', (field, date, hotspots)).fetchall()
+        summary['disease_hotspots'] = [dict(row) for row in rows]
+        return summary
+
+    def zones(self, field, date):
+        """Measures and changes of every measured zone of one flight"""
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT * FROM zones WHERE field = ? AND date = ? ORDER BY zone',
+                              (field, parse_date(date))).fetchall()
+        return [dict(row) for row in rows]
+
+    def trend(self, field, zone=None, start=None, end=None):
+        """Measures per flight date of a field, or of one zone, between start and end inclusive"""
+        start = parse_date(start) if start else '0000-01-01'
+        end = parse_date(end) if end else '9999-12-31'
+        with closing(self._connect()) as db:
+            if zone is None:
+                rows = db.execute('SELECT date, zones, green_cover, disease_fraction, tree_count FROM flights '
+                                  'WHERE field = ? AND date BETWEEN ? AND ? ORDER BY date',
+                                  (field, start, end)).fetchall()
+            else:
+                rows = db.execute('SELECT date, x, y, green_cover, disease_fraction, tree_count, green_change, '
+                                  'disease_change, tree_change FROM zones '
+                                  'WHERE field = ? AND zone = ? AND date BETWEEN ? AND ? ORDER BY date',
+                                  (field, zone, start, end)).fetchall()
+        return [dict(row) for row in rows]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Register a field's flights and track per-zone change")
+    parser.add_argument('directory', help="history directory")
+    parser.add_argument('field', help="field name")
+    parser.add_argument('date', nargs='?', help="flight date, YYYY-MM-DD, when adding a mosaic")
+    parser.add_argument('mosaic', nargs='?', help="mosaic image of the flight")
+    parser.add_argument('--trend', action='store_true', help="print the field's measures per flight")
+    parser.add_argument('--zone', type=int, help="with --trend, one zone's measures instead")
+    parser.add_argument('--zone-size', type=int, default=DEFAULT_ZONE_SIZE, help="zone side for a new field")
+    args = parser.parse_args(argv)
+
+    history = FlightHistory(args.directory, args.zone_size)
+    try:
+        if args.trend:
+            print(json.dumps(history.trend(args.field, args.zone), indent=2))
+            return 0
+        if not args.date or not args.mosaic:
+            parser.error("date and mosaic are required to add a flight")
+        image = cv2.imread(args.mosaic, cv2.IMREAD_COLOR)
+        if image is None:
+            print(f"Could not read {args.mosaic}")
+            return 1
+        summary = history.add_flight(args.field, args.date, image, file_digest(args.mosaic))
+    except (ValueError, RegistrationError) as e:
+        print(e)
+        return 1
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,362 @@
+"""Incremental mosaics: add frames to an existing mosaic without restitching
+
+A session directory keeps everything needed to place more frames later:
+the ORB keypoints and descriptors of every frame, each frame's camera as
+a similarity transform from its pixels to mosaic coordinates, and the
+mosaic canvas itself as a memory-mapped .npy file. A new frame is matched
+only against the frames nearest to where the previous frame landed, its
+transform is estimated from those matches, and it is warped into its own
+footprint on the canvas. Nothing already placed is matched or warped
+again, so adding frames costs time in proportion to the new frames.
+
+Frames are assumed to be nadir views of flat ground, so a similarity
+(rotation, uniform scale and translation) is the camera model; frames in
+flight order chain best.
+
+Usage:
+    python incremental.py sessions/field7 new_frames/*.jpg -o mosaic.png
+"""
+import argparse
+import fcntl
+import json
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+from crop import valid_mask
+from features import FeatureStore
+from ingest import file_digest
+from stitch import DEFAULT_WORK_MEGAPIX, list_frames, load_frame
+
+STATE_NAME = 'session.json'
+CANVAS_NAME = 'canvas.npy'
+FEATURES_DIR = 'features'
+
+DEFAULT_FEATURES = 2000
+DEFAULT_NEIGHBOURS = 6
+MIN_INLIERS = 20
+RATIO = 0.75
+RANSAC_THRESHOLD = 3.0
+# A side of the canvas that must grow grows by at least this fraction of its length
+CANVAS_GROWTH = 0.5
+
+
+def match_points(descriptors, other_descriptors):
+    """Index pairs (i, j) of descriptor matches passing the ratio test"""
+    if len(descriptors) < 2 or len(other_descriptors) < 2:
+        return np.empty((0, 2), np.int64)
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    pairs = [(m.queryIdx, m.trainIdx) for m, n in
+             (match for match in matcher.knnMatch(descriptors, other_descriptors, k=2) if len(match) == 2)
+             if m.distance < RATIO * n.distance]
+    return np.array(pairs, np.int64).reshape(-1, 2)
+
+
+def _affine(matrix):
+    """2 x 3 transform as a 3 x 3 matrix"""
+    return np.vstack([np.asarray(matrix, np.float64).reshape(2, 3), [0, 0, 1]])
+
+
+def _corners(size, transform):
+    """Mosaic coordinates of the corners of a width x height frame"""
+    width, height = size
+    corners = np.float64([[0, 0], [width, 0], [width, height], [0, height]])
+    return corners @ transform[:2, :2].T + transform[:2, 2]
+
+
+def _write_state(directory, state):
+    """Replace the state file atomically, so a crash never leaves half of it"""
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, os.path.join(directory, STATE_NAME))
+
+
+class SessionLock:
+    """Exclusive lock on a session directory, held across processes"""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, '.lock')
+
+    def __enter__(self):
+        self.file = open(self.path, 'w')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+class MosaicSession:
+    """A mosaic on disk that frames can be added to batch after batch
+
+    The state file lists the frames in the order they were placed, with
+    the digest, working size and transform of each. Transforms map frame
+    pixels at the working resolution to mosaic coordinates; origin is the
+    mosaic coordinate of the canvas's top-left pixel, so growing the
+    canvas never changes a transform.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._load_state()
+        self.store = FeatureStore(os.path.join(directory, FEATURES_DIR), 'orb', self.state['features'])
+
+    @classmethod
+    def create(cls, directory, work_megapix=DEFAULT_WORK_MEGAPIX, features=DEFAULT_FEATURES,
+               neighbours=DEFAULT_NEIGHBOURS):
+        """Start an empty session in directory"""
+        os.makedirs(os.path.join(directory, FEATURES_DIR), exist_ok=True)
+        state = {
+            "version": 1,
+            "work_megapix": work_megapix,
+            "features": features,
+            "neighbours": neighbours,
+            "origin": [0, 0],
+            "frames": []
+        }
+        _write_state(directory, state)
+        return cls(directory)
+
+    @property
+    def frames(self):
+        return self.state['frames']
+
+    def summary(self):
+        """Frame count and canvas size"""
+        height, width = self._canvas_shape()
+        return {"frames": len(self.frames), "width": width, "height": height}
+
+    def add_frames(self, sources, digests=None, names=None, progress=None):
+        """Place new frames on the mosaic, returning the names added and skipped
+
+        sources are image paths in flight order; digests, if given, are
+        their SHA-256 so uploads need not be hashed twice. Frames whose
+        digest is already in the session are skipped, and so are frames
+        that match no neighbour, after one retry once the rest of the
+        batch is placed. progress, if given, is called as
+        progress(done, total) after every frame.
+        """
+        digests = digests or [file_digest(source) for source in sources]
+        names = names or [os.path.basename(source) for source in sources]
+        with SessionLock(self.directory):
+            # Another process may have added frames since this session was read
+            self._load_state()
+            known = {frame['digest'] for frame in self.frames}
+            added, skipped, pending = [], [], []
+            for source, digest, name in zip(sources, digests, names):
+                if digest in known:
+                    skipped.append(name)
+                    continue
+                known.add(digest)
+                pending.append((source, digest, name))
+
+            total, done = len(pending), 0
+            retry = True
+            while pending:
+                unplaced = []
+                for source, digest, name in pending:
+                    placed = self._add_frame(source, digest, name)
+                    # Unmatched frames get another go once the rest of the batch is down
+                    if placed is False and retry:
+                        unplaced.append((source, digest, name))
+                        continue
+                    (added if placed else skipped).append(name)
+                    done += 1
+                    if progress:
+                        progress(done, total)
+                pending, retry = unplaced, False
+            self._save_state()
+        return added, skipped
+
+    def mosaic(self):
+        """The mosaic trimmed to the bounding box of placed frames"""
+        canvas = self._canvas()
+        if canvas is None:
+            return None
+        x, y, w, h = cv2.boundingRect(valid_mask(canvas))
+        return np.array(canvas[y:y + h, x:x + w])
+
+    def _add_frame(self, source, digest, name):
+        """Place one frame: True if placed, False if unmatched, None if undecodable"""
+        image = load_frame(source, self.state['work_megapix'])
+        if image is None:
+            return None
+        features = self.store.features(digest, image, valid_mask(image))
+        points, descriptors = features['points'], features['descriptors']
+
+        if not self.frames:
+            transform = np.eye(3)
+        else:
+            transform = self._locate(points, descriptors)
+            if transform is None:
+                return False
+
+        self._composite(image, transform)
+        height, width = image.shape[:2]
+        centre = _corners((width, height), transform).mean(axis=0)
+        self.frames.append({
+            "name": name,
+            "digest": digest,
+            "size": [width, height],
+            "transform": transform[:2].tolist(),
+            "centre": centre.tolist()
+        })
+        return True
+
+    def _candidates(self):
+        """Placed frames, nearest first to where the last placed frame landed"""
+        centres = np.array([frame['centre'] for frame in self.frames])
+        distances = np.hypot(*(centres - centres[-1]).T)
+        return np.argsort(distances, kind='stable')
+
+    def _locate(self, points, descriptors):
+        """Transform of a new frame from matches against its neighbours
+
+        The nearest neighbours are tried first; only when they fail are
+        further frames searched, a neighbourhood at a time.
+        """
+        order = self._candidates()
+        step = self.state['neighbours']
+        for start in range(0, len(order), step):
+            source, target = [], []
+            for index in order[start:start + step]:
+                frame = self.frames[index]
+                features = self.store.get(frame['digest'], frame['size'])
+                pairs = match_points(descriptors, features['descriptors'])
+                if len(pairs) < MIN_INLIERS:
+                    continue
+                to_mosaic = _affine(frame['transform'])
+                source.append(points[pairs[:, 0]])
+                target.append(features['points'][pairs[:, 1]] @ to_mosaic[:2, :2].T + to_mosaic[:2, 2])
+            if not source:
+                continue
+            matrix, inliers = cv2.estimateAffinePartial2D(
+                np.concatenate(source), np.concatenate(target), method=cv2.RANSAC,
+                ransacReprojThreshold=RANSAC_THRESHOLD)
+            if matrix is not None and int(inliers.sum()) >= MIN_INLIERS:
+                return _affine(matrix)
+        return None
+
+    def _canvas_path(self):
+        return os.path.join(self.directory, CANVAS_NAME)
+
+    def _canvas(self, mode='r'):
+        try:
+            return np.load(self._canvas_path(), mmap_mode=mode)
+        except FileNotFoundError:
+            return None
+
+    def _canvas_shape(self):
+        canvas = self._canvas()
+        return (0, 0) if canvas is None else canvas.shape[:2]
+
+    def _grow(self, x0, y0, x1, y1, margin):
+        """Grow the canvas so it covers mosaic box (x0, y0)-(x1, y1)
+
+        The canvas grows on every side that needs it by margin or by
+        CANVAS_GROWTH of its current length, whichever is more. Growth is
+        geometric, so a flight heading steadily outwards copies the canvas
+        a logarithmic number of times rather than once per batch.
+        """
+        ox, oy = self.state['origin']
+        height, width = self._canvas_shape()
+        if height and x0 >= ox and y0 >= oy and x1 <= ox + width and y1 <= oy + height:
+            return
+        if not height:
+            nx0, ny0, nx1, ny1 = x0, y0, x1, y1
+        else:
+            margin_x = max(margin, int(width * CANVAS_GROWTH))
+            margin_y = max(margin, int(height * CANVAS_GROWTH))
+            nx0 = min(ox, x0 - margin_x) if x0 < ox else ox
+            ny0 = min(oy, y0 - margin_y) if y0 < oy else oy
+            nx1 = max(ox + width, x1 + margin_x) if x1 > ox + width else ox + width
+            ny1 = max(oy + height, y1 + margin_y) if y1 > oy + height else oy + height
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.npy')
+        os.close(fd)
+        grown = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(ny1 - ny0, nx1 - nx0, 3))
+        if height:
+            old = self._canvas()
+            grown[oy - ny0:oy - ny0 + height, ox - nx0:ox - nx0 + width] = old
+            del old
+        grown.flush()
+        del grown
+        os.replace(tmp_path, self._canvas_path())
+        self.state['origin'] = [nx0, ny0]
+
+    def _composite(self, image, transform):
+        """Warp a frame into its footprint on the canvas, on top of earlier frames"""
+        height, width = image.shape[:2]
+        corners = _corners((width, height), transform)
+        x0, y0 = np.floor(corners.min(axis=0)).astype(int).tolist()
+        x1, y1 = np.ceil(corners.max(axis=0)).astype(int).tolist()
+        self._grow(x0, y0, x1, y1, margin=max(width, height))
+
+        # Warp into the footprint only, never the whole canvas
+        shift = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]], np.float64)
+        matrix = (shift @ transform)[:2]
+        size = (x1 - x0, y1 - y0)
+        warped = cv2.warpAffine(image, matrix, size, flags=cv2.INTER_LINEAR)
+        coverage = cv2.warpAffine(np.full((height, width), 255, np.uint8), matrix, size, flags=cv2.INTER_NEAREST)
+        # Drop the interpolated edge, which blends in the black outside the frame
+        coverage = cv2.erode(coverage, np.ones((3, 3), np.uint8))
+
+        ox, oy = self.state['origin']
+        canvas = self._canvas('r+')
+        roi = canvas[y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+        np.copyto(roi, warped, where=coverage[..., None] != 0)
+        canvas.flush()
+        del canvas
+
+    def _load_state(self):
+        with open(os.path.join(self.directory, STATE_NAME)) as f:
+            self.state = json.load(f)
+
+    def _save_state(self):
+        _write_state(self.directory, self.state)
+
+
+def open_session(directory, **options):
+    """The session in directory, created with options if there is none"""
+    if os.path.exists(os.path.join(directory, STATE_NAME)):
+        return MosaicSession(directory)
+    return MosaicSession.create(directory, **options)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Add frames to an incremental mosaic session")
+    parser.add_argument('session', help="session directory, created if it does not exist")
+    parser.add_argument('frames', nargs='+', help="frame images or directories of frames, in flight order")
+    parser.add_argument('-o', '--output', help="also write the mosaic to this image path")
+    parser.add_argument('--work-megapix', type=float, default=DEFAULT_WORK_MEGAPIX,
+                        help="working resolution of new sessions, 0 for full resolution")
+    parser.add_argument('--neighbours', type=int, default=DEFAULT_NEIGHBOURS,
+                        help="placed frames a new frame is matched against at a time")
+    args = parser.parse_args(argv)
+
+    sources = []
+    for path in args.frames:
+        sources.extend(list_frames(path) if os.path.isdir(path) else [path])
+    session = open_session(args.session, work_megapix=args.work_megapix, neighbours=args.neighbours)
+
+    def report(done, total):
+        print(f"frame {done}/{total}")
+
+    added, skipped = session.add_frames(sources, progress=report)
+    summary = session.summary()
+    print(f"Added {len(added)} frames, skipped {len(skipped)}; "
+          f"{summary['frames']} frames on a {summary['width']}x{summary['height']} canvas")
+    if args.output:
+        mosaic = session.mosaic()
+        if mosaic is not None:
+            cv2.imwrite(args.output, mosaic)
+            print(f"Saved mosaic to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
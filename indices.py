@@ -0,0 +1,263 @@
+"""Vegetation indices over RGB and multispectral rasters
+
+Every index is a whole-array NumPy expression on float32 bands scaled to
+[0, 1]; integer bands are divided by their dtype's maximum, so an 8-bit
+RGB mosaic and a 16-bit NIR band can be combined. Indices are evaluated
+tile by tile, so a mosaic never needs more than one tile of float32
+intermediates, and tiles can be consumed as a stream.
+
+Pixels where every band is zero (the black border of a stitched mosaic)
+are invalid: their value is 0 and they are left out of zone statistics.
+"""
+import cv2
+import numpy as np
+
+from parallel import bounded_map
+from tiling import DEFAULT_TILE_SIZE, iter_tiles
+
+DEFAULT_ZONE_SIZE = 256
+
+
+def _scaled(band):
+    """Band as float32 in [0, 1]"""
+    band = np.asarray(band)
+    if np.issubdtype(band.dtype, np.integer):
+        return band.astype(np.float32) * np.float32(1.0 / np.iinfo(band.dtype).max)
+    return band.astype(np.float32, copy=False)
+
+
+def _ratio(numerator, denominator):
+    """numerator / denominator, 0 where the denominator is 0"""
+    out = np.zeros_like(numerator)
+    np.divide(numerator, denominator, out=out, where=denominator != 0)
+    return out
+
+
+def _total(bands):
+    total = bands['red'] + bands['green']
+    total += bands['blue']
+    return total
+
+
+def exg(bands):
+    """Excess green, 2g - r - b on chromatic coordinates (g = G / (R + G + B))"""
+    # Chromatic coordinates share a denominator, so divide once
+    out = bands['green'] * 2
+    out -= bands['red']
+    out -= bands['blue']
+    return _ratio(out, _total(bands))
+
+
+def exgr(bands):
+    """Excess green minus excess red (1.4r - g), on chromatic coordinates"""
+    # (2g - r - b) - (1.4r - g) = 3g - 2.4r - b
+    out = bands['green'] * 3
+    out -= bands['red'] * np.float32(2.4)
+    out -= bands['blue']
+    return _ratio(out, _total(bands))
+
+
+def vari(bands):
+    """Visible atmospherically resistant index, (G - R) / (G + R - B)"""
+    red, green, blue = bands['red'], bands['green'], bands['blue']
+    return _ratio(green - red, green + red - blue)
+
+
+def gli(bands):
+    """Green leaf index, (2G - R - B) / (2G + R + B)"""
+    red, green, blue = bands['red'], bands['green'], bands['blue']
+    twice_green = green * 2
+    rest = red + blue
+    return _ratio(twice_green - rest, twice_green + rest)
+
+
+def ndvi(bands):
+    """Normalized difference vegetation index, (NIR - R) / (NIR + R)"""
+    return _ratio(bands['nir'] - bands['red'], bands['nir'] + bands['red'])
+
+
+def ndre(bands):
+    """Normalized difference red edge, (NIR - RE) / (NIR + RE)"""
+    return _ratio(bands['nir'] - bands['rededge'], bands['nir'] + bands['rededge'])
+
+
+# name: (function, extra bands required beyond RGB, display range)
+INDICES = {
+    'exg': (exg, (), (-0.5, 1.0)),
+    'exgr': (exgr, (), (-1.0, 1.0)),
+    'vari': (vari, (), (-1.0, 1.0)),
+    'gli': (gli, (), (-1.0, 1.0)),
+    'ndvi': (ndvi, ('nir',), (-1.0, 1.0)),
+    'ndre': (ndre, ('nir', 'rededge'), (-1.0, 1.0)),
+}
+
+
+def required_bands(name):
+    return INDICES[name][1]
+
+
+def index_tile(name, tile, extra=None):
+    """Index values and valid mask of one tile; safe in a worker process"""
+    tile = np.asarray(tile)
+    extra = extra or {}
+    bands = {'blue': _scaled(tile[..., 0]), 'green': _scaled(tile[..., 1]), 'red': _scaled(tile[..., 2])}
+    for band, values in extra.items():
+        bands[band] = _scaled(values)
+    valid = (tile[..., 0] | tile[..., 1] | tile[..., 2]) != 0
+    for values in extra.values():
+        valid |= np.asarray(values) != 0
+    values = INDICES[name][0](bands)
+    values[~valid] = 0
+    return values, valid
+
+
+def index_tiles(name, image, extra=None, tile_size=DEFAULT_TILE_SIZE, workers=1, backend='thread'):
+    """Yield (core, values, valid) for every tile of the index, in raster order
+
+    image is a BGR array (possibly memory-mapped); extra maps band names
+    such as 'nir' and 'rededge' to single-band arrays of the same size.
+    Raises ValueError for an unknown index or a missing or mismatched band.
+    """
+    if name not in INDICES:
+        raise ValueError(f"Unknown index: {name}")
+    extra = extra or {}
+    missing = [band for band in required_bands(name) if band not in extra]
+    if missing:
+        raise ValueError(f"Index {name} needs the {', '.join(missing)} band")
+    height, width = image.shape[:2]
+    for band, values in extra.items():
+        if values.shape[:2] != (height, width):
+            raise ValueError(f"The {band} band is {values.shape[1]}x{values.shape[0]}, expected {width}x{height}")
+
+    def tasks():
+        for x0, y0, x1, y1 in iter_tiles(height, width, tile_size):
+            yield name, image[y0:y1, x0:x1], {band: values[y0:y1, x0:x1] for band, values in extra.items()}
+
+    cores = iter_tiles(height, width, tile_size)
+    for core, (values, valid) in zip(cores, bounded_map(index_tile, tasks(), workers, backend)):
+        yield core, values, valid
+
+
+class ZoneStats:
+    """Per-zone count, mean, std, min and max over a grid of square zones
+
+    Tiles are folded in as they stream past, so the raster itself is never
+    needed. Tile edges must fall on zone edges (tile size a multiple of
+    the zone size).
+    """
+
+    def __init__(self, height, width, zone_size=DEFAULT_ZONE_SIZE):
+        self.zone_size = zone_size
+        self.height, self.width = height, width
+        self.rows, self.cols = -(-height // zone_size), -(-width // zone_size)
+        shape = (self.rows, self.cols)
+        self.count = np.zeros(shape, np.int64)
+        self.total = np.zeros(shape, np.float64)
+        self.squares = np.zeros(shape, np.float64)
+        self.low = np.full(shape, np.inf, np.float32)
+        self.high = np.full(shape, -np.inf, np.float32)
+
+    def add(self, core, values, valid):
+        x0, y0, x1, y1 = core
+        zone = self.zone_size
+        if x0 % zone or y0 % zone:
+            raise ValueError("Tiles must start on zone edges")
+        # Pad the tile to whole zones and fold each zone into its own axes
+        rows, cols = -(-(y1 - y0) // zone), -(-(x1 - x0) // zone)
+        pad = ((0, rows * zone - (y1 - y0)), (0, cols * zone - (x1 - x0)))
+        valid = np.pad(valid, pad).reshape(rows, zone, cols, zone)
+        values = np.pad(values, pad).reshape(rows, zone, cols, zone)
+        zones = (slice(y0 // zone, y0 // zone + rows), slice(x0 // zone, x0 // zone + cols))
+
+        kept = np.where(valid, values, np.float32(0))
+        self.count[zones] += valid.sum(axis=(1, 3))
+        self.total[zones] += kept.sum(axis=(1, 3), dtype=np.float64)
+        self.squares[zones] += (kept * kept).sum(axis=(1, 3), dtype=np.float64)
+        np.minimum(self.low[zones], np.where(valid, values, np.inf).min(axis=(1, 3)), out=self.low[zones])
+        np.maximum(self.high[zones], np.where(valid, values, -np.inf).max(axis=(1, 3)), out=self.high[zones])
+
+    def summary(self):
+        """Statistics over every valid pixel"""
+        count = int(self.count.sum())
+        if not count:
+            return {"count": 0, "mean": None, "std": None, "min": None, "max": None}
+        mean = self.total.sum() / count
+        return {
+            "count": count,
+            "mean": float(mean),
+            "std": float(np.sqrt(max(self.squares.sum() / count - mean * mean, 0))),
+            "min": float(self.low.min()),
+            "max": float(self.high.max()),
+        }
+
+    def zones(self):
+        """Statistics of every zone holding at least one valid pixel"""
+        results = []
+        zone = self.zone_size
+        for row, col in zip(*np.nonzero(self.count)):
+            count = int(self.count[row, col])
+            mean = self.total[row, col] / count
+            x, y = int(col) * zone, int(row) * zone
+            results.append({
+                "x": x,
+                "y": y,
+                "w": min(zone, self.width - x),
+                "h": min(zone, self.height - y),
+                "count": count,
+                "mean": float(mean),
+                "std": float(np.sqrt(max(self.squares[row, col] / count - mean * mean, 0))),
+                "min": float(self.low[row, col]),
+                "max": float(self.high[row, col]),
+            })
+        return results
+
+
+def _colour_lut():
+    """Red through yellow to green, as a 256-entry BGR lookup table"""
+    ramp = np.linspace(0, 1, 256, dtype=np.float32)
+    red = np.clip(2 - 2 * ramp, 0, 1) * 255
+    green = np.clip(2 * ramp, 0, 1) * 200 + np.clip(1 - 2 * np.abs(ramp - 0.5), 0, 1) * 55
+    lut = np.zeros((256, 1, 3), np.uint8)
+    lut[:, 0, 1] = green
+    lut[:, 0, 2] = red
+    return lut
+
+
+COLOUR_LUT = _colour_lut()
+
+
+def colourize(values, valid, value_range):
+    """Index values mapped onto the colour ramp, invalid pixels black"""
+    low, high = value_range
+    scaled = (values - np.float32(low)) * np.float32(255.0 / (high - low))
+    levels = np.clip(scaled, 0, 255).astype(np.uint8)
+    coloured = cv2.applyColorMap(levels, COLOUR_LUT)
+    coloured[~valid] = 0
+    return coloured
+
+
+def index_raster(name, image, extra=None, tile_size=DEFAULT_TILE_SIZE, zone_size=DEFAULT_ZONE_SIZE,
+                 workers=1, backend='thread', values_out=None, values_only=False):
+    """Colourized index raster and zone statistics in one streaming pass
+
+    Returns (raster, zone_stats). tile_size is rounded up to a multiple
+    of zone_size so zones never straddle tiles. values_out, an image-sized
+    float32 array (a memmap, say), also receives the index values, NaN
+    where pixels are not valid. With values_only, only values_out is
+    filled and (None, None) is returned.
+    """
+    tile_size = -(-tile_size // zone_size) * zone_size
+    height, width = image.shape[:2]
+    stats = raster = None
+    if not values_only:
+        stats = ZoneStats(height, width, zone_size)
+        raster = np.empty((height, width, 3), np.uint8)
+    value_range = INDICES[name][2] if name in INDICES else None
+    for core, values, valid in index_tiles(name, image, extra, tile_size, workers, backend):
+        x0, y0, x1, y1 = core
+        if not values_only:
+            stats.add(core, values, valid)
+            raster[y0:y1, x0:x1] = colourize(values, valid, value_range)
+        if values_out is not None:
+            values_out[y0:y1, x0:x1] = np.where(valid, values, np.nan)
+    return raster, stats
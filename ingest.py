@@ -0,0 +1,140 @@
+"""Upload ingestion that never holds a whole upload in memory
+
+Uploads are copied to disk in fixed-size chunks and hashed on the way,
+so the content digest used by the result cache costs no extra pass.
+Frames are decoded one at a time, optionally at 1/2, 1/4 or 1/8 size
+straight from the JPEG DCT via IMREAD_REDUCED_COLOR_*, and a spooled
+file is deleted as soon as it has been decoded.
+"""
+import hashlib
+import os
+import tempfile
+
+import cv2
+
+import metrics
+
+CHUNK_SIZE = 1024 * 1024
+
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+class Upload:
+    """An upload spooled to disk, with its SHA-256 digest and size"""
+
+    def __init__(self, path, digest, size, filename=None):
+        self.path = path
+        self.digest = digest
+        self.size = size
+        self.filename = filename
+
+    def decode(self, reduce=1, flags=None):
+        """Decode the image and delete the spooled file; None if undecodable"""
+        try:
+            return decode_path(self.path, reduce, flags)
+        finally:
+            self.discard()
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.discard()
+
+
+def spool_upload(file, directory, name=None, chunk_size=CHUNK_SIZE):
+    """Copy an uploaded file to disk chunk by chunk, hashing as it goes
+
+    file is a werkzeug FileStorage or any object with a readable stream.
+    The copy is written to directory under name, or under a fresh
+    temporary name keeping the upload's extension.
+    """
+    stream = getattr(file, 'stream', file)
+    filename = getattr(file, 'filename', None)
+    if name is None:
+        suffix = os.path.splitext(filename or '')[1]
+        fd, path = tempfile.mkstemp(dir=directory, suffix=suffix)
+        out = os.fdopen(fd, 'wb')
+    else:
+        path = os.path.join(directory, name)
+        out = open(path, 'wb')
+
+    hasher = hashlib.sha256()
+    size = 0
+    with out:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    return Upload(path, hasher.hexdigest(), size, filename)
+
+
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    """Hex SHA-256 of a file on disk, read chunk by chunk"""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def parse_reduce(value):
+    """Validated decode reduction factor: 1, 2, 4 or 8; raises ValueError"""
+    try:
+        reduce = int(value or 1)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid reduce factor: {value}")
+    if reduce not in REDUCED_FLAGS:
+        raise ValueError("reduce must be 1, 2, 4 or 8")
+    return reduce
+
+
+def decode_path(path, reduce=1, flags=None):
+    """Decode an image file, at 1/reduce scale for colour images
+
+    flags overrides the colour decode, e.g. cv2.IMREAD_ANYDEPTH for a
+    single-band 16-bit raster.
+    """
+    if flags is None:
+        flags = REDUCED_FLAGS[reduce]
+    with metrics.timed('decode'):
+        image = cv2.imread(path, flags)
+    metrics.observe_image(image)
+    return image
+
+
+def image_size(path):
+    """(width, height) read from the file header only, or None"""
+    # Pillow parses headers lazily, without decoding any pixels
+    from PIL import Image
+    try:
+        with Image.open(path) as image:
+            return image.size
+    except (OSError, ValueError):
+        return None
+
+
+def reduce_for_megapix(path, megapix):
+    """Largest decode reduction that still leaves at least megapix megapixels"""
+    size = image_size(path) if megapix else None
+    if size is None:
+        return 1
+    width, height = size
+    for reduce in (8, 4, 2):
+        if (width // reduce) * (height // reduce) >= megapix * 1e6:
+            return reduce
+    return 1
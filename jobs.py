@@ -0,0 +1,261 @@
+"""Persistent background jobs for work that outlives an HTTP request
+
+Jobs are rows in a local SQLite database, so a queued or half-finished
+job survives a restart of the web worker that accepted it. A JobRunner
+claims jobs one at a time per slot and runs them in a process pool; while
+a job runs its lease is renewed, and a job whose lease lapses (its worker
+died) is claimed again, up to MAX_ATTEMPTS times.
+
+The queue is bounded: submit() raises QueueFull once max_pending jobs are
+queued or running, so an overloaded server can answer 429 straight away.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+DEFAULT_MAX_PENDING = 16
+DEFAULT_LEASE = 60.0
+MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    progress TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    lease REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+"""
+
+
+class QueueFull(Exception):
+    """Raised when the queue already holds max_pending unfinished jobs"""
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+class JobQueue:
+    """SQLite-backed job table; safe to share between threads and processes
+
+    Every call opens its own connection, so one JobQueue can be used from
+    request threads, runner threads and pool processes alike.
+    """
+
+    def __init__(self, path, max_pending=DEFAULT_MAX_PENDING, lease=DEFAULT_LEASE):
+        self.path = path
+        self.max_pending = max_pending
+        self.lease = lease
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(_SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return _Connection(db)
+
+    def pending(self):
+        """Number of queued and running jobs"""
+        with self._connect() as db:
+            return db.execute('SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)', (QUEUED, RUNNING)).fetchone()[0]
+
+    def is_full(self):
+        return self.pending() >= self.max_pending
+
+    def submit(self, kind, params, job_id=None):
+        """Queue a job and return its id, or raise QueueFull"""
+        job_id = job_id or new_job_id()
+        now = time.time()
+        with self._connect() as db:
+            # IMMEDIATE takes the write lock, so the count and insert are atomic
+            db.execute('BEGIN IMMEDIATE')
+            pending = db.execute('SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)', (QUEUED, RUNNING)).fetchone()[0]
+            if pending >= self.max_pending:
+                db.execute('ROLLBACK')
+                raise QueueFull(f"Job queue is full ({pending} jobs pending)")
+            db.execute('INSERT INTO jobs (id, kind, status, params, created, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                       (job_id, kind, QUEUED, json.dumps(params), now, now))
+            db.execute('COMMIT')
+        return job_id
+
+    def claim(self):
+        """Mark the oldest runnable job running and return (id, kind, params)
+
+        Runnable jobs are queued ones and running ones whose lease lapsed.
+        Returns None when there is nothing to run.
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            # Jobs that crashed their worker too often are given up on
+            db.execute('UPDATE jobs SET status = ?, error = ?, lease = NULL, updated = ? '
+                       'WHERE attempts >= ? AND (status = ? OR (status = ? AND lease < ?))',
+                       (FAILED, "Job worker stopped repeatedly", now, MAX_ATTEMPTS, QUEUED, RUNNING, now))
+            row = db.execute('SELECT id, kind, params FROM jobs WHERE status = ? OR (status = ? AND lease < ?) '
+                             'ORDER BY created LIMIT 1', (QUEUED, RUNNING, now)).fetchone()
+            if row is not None:
+                db.execute('UPDATE jobs SET status = ?, attempts = attempts + 1, lease = ?, updated = ? WHERE id = ?',
+                           (RUNNING, now + self.lease, now, row['id']))
+            db.execute('COMMIT')
+        if row is None:
+            return None
+        return row['id'], row['kind'], json.loads(row['params'])
+
+    def renew(self, job_id):
+        """Extend the lease of a running job"""
+        now = time.time()
+        with self._connect() as db:
+            db.execute('UPDATE jobs SET lease = ? WHERE id = ? AND status = ?', (now + self.lease, job_id, RUNNING))
+
+    def report(self, job_id, **progress):
+        """Record progress of a running job, visible to pollers"""
+        with self._connect() as db:
+            db.execute('UPDATE jobs SET progress = ?, updated = ? WHERE id = ?',
+                       (json.dumps(progress), time.time(), job_id))
+
+    def finish(self, job_id, result):
+        self._close(job_id, DONE, result=json.dumps(result))
+
+    def fail(self, job_id, error):
+        self._close(job_id, FAILED, error=str(error))
+
+    def release(self, job_id):
+        """Put a running job back in the queue, e.g. after its worker died"""
+        self._close(job_id, QUEUED)
+
+    def _close(self, job_id, status, result=None, error=None):
+        with self._connect() as db:
+            db.execute('UPDATE jobs SET status = ?, result = ?, error = ?, lease = NULL, updated = ? WHERE id = ?',
+                       (status, result, error, time.time(), job_id))
+
+    def get(self, job_id):
+        """Job as a dict for the status endpoint, or None"""
+        with self._connect() as db:
+            row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            position = None
+            if row['status'] == QUEUED:
+                position = db.execute('SELECT COUNT(*) FROM jobs WHERE status = ? AND created < ?',
+                                      (QUEUED, row['created'])).fetchone()[0]
+        return {
+            "id": row['id'],
+            "kind": row['kind'],
+            "status": row['status'],
+            "queue_position": position,
+            "progress": json.loads(row['progress']) if row['progress'] else None,
+            "result": json.loads(row['result']) if row['result'] else None,
+            "error": row['error'],
+            "attempts": row['attempts'],
+            "created": row['created'],
+            "updated": row['updated'],
+        }
+
+
+class _Connection:
+    """sqlite3 connection closed on exit; sqlite3's own only ends transactions"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, *exc):
+        self.db.close()
+
+
+def _run_job(path, handler, job_id, params):
+    """Entry point in the pool process; handler gets params and a progress callback"""
+    queue = JobQueue(path)
+
+    def progress(**fields):
+        queue.report(job_id, **fields)
+
+    return handler(job_id, params, progress)
+
+
+class JobRunner:
+    """Threads feeding queued jobs to a process pool
+
+    handlers maps a job kind to a module-level function
+    handler(job_id, params, progress) returning a JSON-serialisable result.
+    """
+
+    def __init__(self, queue, handlers, workers=1, poll_interval=0.5):
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._pool = None
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+
+    def start(self):
+        """Start one daemon thread per pool slot; safe to call twice
+
+        A process forked from one that started the runner starts its own:
+        threads and pool processes do not survive the fork.
+        """
+        with self._lock:
+            if self._threads and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._threads = []
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._loop, name=f'job-runner-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _loop(self):
+        while True:
+            job = self.queue.claim()
+            if job is None:
+                time.sleep(self.poll_interval)
+                continue
+            self._run(*job)
+
+    def _run(self, job_id, kind, params):
+        handler = self.handlers.get(kind)
+        if handler is None:
+            self.queue.fail(job_id, f"Unknown job kind: {kind}")
+            return
+        with self._lock:
+            pool = self._pool
+        try:
+            future = pool.submit(_run_job, self.queue.path, handler, job_id, params)
+            while True:
+                try:
+                    result = future.result(timeout=self.queue.lease / 3)
+                    break
+                except TimeoutError:
+                    self.queue.renew(job_id)
+        except BrokenProcessPool:
+            # The pool process died mid-job; start a fresh pool and retry later
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            self.queue.release(job_id)
+            return
+        except Exception as e:
+            self.queue.fail(job_id, e)
+            return
+        self.queue.finish(job_id, result)
@@ -0,0 +1,139 @@
+"""Histograms of request and stage timings, exposed in Prometheus text format
+
+Histograms keep cumulative bucket counts, a sum and a count per label
+set, behind one lock, so observing a value costs a bisect and three
+additions. render() writes every histogram in the Prometheus text
+exposition format for /metrics.
+
+timed(stage) times a block or a function into STAGE_SECONDS. Timers
+nest per thread and each records its exclusive time: a stage that
+triggers another (a mask computing its grayscale on first use, a
+stitch decoding frames) is not charged for the inner one, so stage
+totals add up. Tile workers on threads record into the same histograms;
+process workers keep their own, which /metrics does not see.
+
+Every server process keeps its own histograms too, and a scrape reaches
+whichever gunicorn worker accepts it. render() labels each series with
+the pid of the process that served it, so series of different workers
+never mix: sum over pid in the query, or scrape each worker directly.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ContextDecorator
+
+# Upper bounds in seconds, from a single small tile to a long stitch
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Upper bounds in bytes, from a thumbnail to a whole flight
+SIZE_BUCKETS = tuple(1024 * 4 ** n for n in range(12))
+# Upper bounds in megapixels, from a preview to a stitched field
+PIXEL_BUCKETS = (0.1, 0.5, 1, 2, 5, 12, 25, 50, 100, 200, 400)
+
+
+class Histogram:
+    """Cumulative buckets, sum and count of observations per label set"""
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        """(label values, cumulative bucket counts, sum, count) per label set"""
+        with self._lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count)
+                      in sorted(self._series.items())]
+        for labels, counts, total, count in series:
+            cumulative, running = [], 0
+            for value in counts:
+                running += value
+                cumulative.append(running)
+            yield labels, cumulative, total, count
+
+    def render(self, constant=()):
+        """The histogram in text format, with constant (name, value) labels on every series"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bounds = [_number(bound) for bound in self.buckets] + ['+Inf']
+        fixed = [f'{name}="{_escape(value)}"' for name, value in constant]
+        for label_values, cumulative, total, count in self.samples():
+            pairs = fixed + [f'{name}="{_escape(value)}"' for name, value in zip(self.labels, label_values)]
+            for bound, value in zip(bounds, cumulative):
+                bucket_labels = ','.join(pairs + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {value}")
+            suffix = f"{{{','.join(pairs)}}}" if pairs else ''
+            lines.append(f"{self.name}_sum{suffix} {_number(total)}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_SECONDS = Histogram('uav_request_seconds', "Request latency by endpoint and status",
+                            TIME_BUCKETS, ('endpoint', 'status'))
+REQUEST_BYTES = Histogram('uav_request_bytes', "Request body size by endpoint", SIZE_BUCKETS, ('endpoint',))
+IMAGE_MEGAPIXELS = Histogram('uav_image_megapixels', "Size of decoded images", PIXEL_BUCKETS)
+STAGE_SECONDS = Histogram('uav_stage_seconds', "Exclusive time spent in each processing stage",
+                          TIME_BUCKETS, ('stage',))
+
+HISTOGRAMS = [REQUEST_SECONDS, REQUEST_BYTES, IMAGE_MEGAPIXELS, STAGE_SECONDS]
+
+_local = threading.local()
+
+
+class timed(ContextDecorator):
+    """Record the exclusive time of a block, or of every call, under stage"""
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        # Each open timer keeps its start and the time spent in timers nested in it
+        stack.append([time.perf_counter(), 0.0])
+        return self
+
+    def __exit__(self, *exc):
+        start, inner = _local.stack.pop()
+        elapsed = time.perf_counter() - start
+        if _local.stack:
+            _local.stack[-1][1] += elapsed
+        STAGE_SECONDS.observe(elapsed - inner, self.stage)
+        return False
+
+
+def observe_image(image):
+    """Record the size of a decoded image"""
+    if image is not None:
+        IMAGE_MEGAPIXELS.observe(image.shape[0] * image.shape[1] / 1e6)
+
+
+def render():
+    """Every histogram in the Prometheus text exposition format, labelled with this process's pid"""
+    constant = [('pid', os.getpid())]
+    return '\n'.join(histogram.render(constant) for histogram in HISTOGRAMS) + '\n'
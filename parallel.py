@@ -0,0 +1,42 @@
+"""Thread and process pools for running tiles and stitch groups concurrently
+
+OpenCV releases the GIL inside its kernels, so the thread backend scales
+across cores without copying tiles between processes. The process backend
+suits Python-heavy work and isolates crashes, at the cost of pickling each
+task's arguments.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+BACKENDS = ('thread', 'process')
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def bounded_map(fn, tasks, workers=1, backend='thread', inflight=None):
+    """Yield fn(*task) for each task, in order, using a pool of workers
+
+    At most inflight tasks (twice the worker count by default) are queued
+    at once, so tasks carrying tile data are not all materialised up
+    front. With one worker the tasks run inline.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    if workers <= 1:
+        for task in tasks:
+            yield fn(*task)
+        return
+
+    inflight = inflight or 2 * workers
+    pool_class = ThreadPoolExecutor if backend == 'thread' else ProcessPoolExecutor
+    with pool_class(max_workers=workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(fn, *task))
+            if len(pending) >= inflight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,85 @@
+"""Sampling profiler that keeps the stacks of slow requests
+
+One daemon thread wakes every interval while a request is being
+profiled and records the Python stack of every other thread. Samples
+are kept per request as folded stacks ("thread;module:function;... N"),
+the format flamegraph.pl, speedscope and inferno read, and written out
+only for requests that took longer than the threshold, so fast requests
+cost a dictionary per sample and no disk.
+
+Every thread is sampled, so tile workers show up under their own names;
+requests running at the same time share samples. OpenCV releases the
+GIL, so time inside a cv2 call shows as the Python line that made it.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+DEFAULT_INTERVAL = 0.005
+
+
+def folded_stack(frame, thread_name):
+    """A frame's stack, outermost call first, as one folded line"""
+    calls = []
+    while frame is not None:
+        code = frame.f_code
+        calls.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    calls.append(thread_name)
+    return ';'.join(reversed(calls))
+
+
+class SamplingProfiler:
+    """Samples every thread's stack into each profile that is open"""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._profiles = {}
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Open a profile and return its token"""
+        token = object()
+        with self._lock:
+            self._profiles[token] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return token
+
+    def stop(self, token):
+        """Close a profile and return its folded stacks and sample counts"""
+        with self._lock:
+            return self._profiles.pop(token, Counter())
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self._lock:
+                idle = not self._profiles
+                if idle:
+                    self._wake.clear()
+            if idle:
+                # Sleep until a request is profiled again
+                self._wake.wait()
+                continue
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = [folded_stack(frame, names.get(ident, str(ident)))
+                      for ident, frame in sys._current_frames().items() if ident != me]
+            with self._lock:
+                for profile in self._profiles.values():
+                    profile.update(stacks)
+            time.sleep(self.interval)
+
+
+def write_folded(path, samples):
+    """Write folded stacks, one "stack count" line each, heaviest first"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
@@ -0,0 +1,157 @@
+"""Multi-resolution tile pyramid of a mosaic, for viewers that fetch tiles
+
+Level z is the mosaic downscaled by 2 ** (max_zoom - z): max_zoom is full
+resolution and level 0 fits in a single tile. Tiles are written in the
+XYZ layout, <directory>/<z>/<x>/<y><ext>, with x counting columns and y
+rows from the top-left corner, which is what Leaflet (with CRS.Simple)
+and OpenLayers expect for a plain pixel image. Edge tiles are padded to
+the full tile size and tiles with no mosaic pixels are not written, so a
+viewer gets 404 for the black border around a flight.
+
+Usage:
+    python pyramid.py stitchedOutputProcessed.png -o tiles/ [--format png]
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+import cv2
+import numpy as np
+
+import metrics
+from encoding import FORMATS, encode_image, extension, parse_encoding
+from parallel import BACKENDS, bounded_map
+
+DEFAULT_TILE_SIZE = 256
+DEFAULT_FORMAT = 'jpeg'
+METADATA_NAME = 'tiles.json'
+
+
+def max_zoom(height, width, tile_size=DEFAULT_TILE_SIZE):
+    """Smallest zoom at which tiles cover the image at full resolution"""
+    zoom = 0
+    while max(height, width) > tile_size << zoom:
+        zoom += 1
+    return zoom
+
+
+def iter_levels(image, zoom):
+    """Yield (z, level) from full resolution at zoom down to level 0"""
+    level = image
+    for z in range(zoom, -1, -1):
+        yield z, level
+        if z:
+            height, width = level.shape[:2]
+            size = (max(1, (width + 1) // 2), max(1, (height + 1) // 2))
+            level = cv2.resize(level, size, interpolation=cv2.INTER_AREA)
+
+
+def tile_path(directory, z, x, y, ext):
+    return os.path.join(directory, str(z), str(x), f"{y}{ext}")
+
+
+def _write_tile(path, tile, fmt, level):
+    """Encode one tile and write it; safe in a worker process"""
+    with open(path, 'wb') as f:
+        f.write(encode_image(tile, fmt, level))
+
+
+def _level_tiles(root, z, level, tile_size, fmt, quality):
+    """(path, tile, format, level) for every tile of a level holding pixels"""
+    height, width = level.shape[:2]
+    ext = extension(fmt)
+    for x in range(-(-width // tile_size)):
+        os.makedirs(os.path.join(root, str(z), str(x)), exist_ok=True)
+        for y in range(-(-height // tile_size)):
+            tile = level[y * tile_size:(y + 1) * tile_size, x * tile_size:(x + 1) * tile_size]
+            if not tile.any():
+                continue
+            if tile.shape[:2] != (tile_size, tile_size):
+                pad = [(0, tile_size - tile.shape[0]), (0, tile_size - tile.shape[1])]
+                tile = np.pad(tile, pad + [(0, 0)] * (tile.ndim - 2))
+            yield tile_path(root, z, x, y, ext), tile, fmt, quality
+
+
+def read_metadata(directory):
+    """Metadata of the pyramid in directory, or None when there is none"""
+    try:
+        with open(os.path.join(directory, METADATA_NAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+@metrics.timed('tiles')
+def build_pyramid(image, directory, tile_size=DEFAULT_TILE_SIZE, fmt=DEFAULT_FORMAT, level=None,
+                  workers=1, backend='thread'):
+    """Write the tile pyramid of image to directory and return its metadata
+
+    The pyramid is built in a temporary sibling directory and renamed into
+    place, so readers never see half a pyramid. When directory already
+    holds a pyramid it is kept as it is.
+    """
+    existing = read_metadata(directory)
+    if existing is not None:
+        return existing
+
+    fmt, level = parse_encoding(fmt, level)
+    height, width = image.shape[:2]
+    zoom = max_zoom(height, width, tile_size)
+    metadata = {
+        "width": width,
+        "height": height,
+        "tile_size": tile_size,
+        "min_zoom": 0,
+        "max_zoom": zoom,
+        "format": fmt,
+        "extension": extension(fmt),
+    }
+
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    root = tempfile.mkdtemp(dir=parent, prefix='.pyramid-')
+    try:
+        def tasks():
+            for z, scaled in iter_levels(image, zoom):
+                yield from _level_tiles(root, z, scaled, tile_size, fmt, level)
+
+        for _ in bounded_map(_write_tile, tasks(), workers, backend):
+            pass
+        with open(os.path.join(root, METADATA_NAME), 'w') as f:
+            json.dump(metadata, f)
+        try:
+            os.rename(root, directory)
+        except OSError:
+            # Another request built the same pyramid first
+            shutil.rmtree(root, ignore_errors=True)
+            return read_metadata(directory) or metadata
+    except BaseException:
+        shutil.rmtree(root, ignore_errors=True)
+        raise
+    return metadata
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write an XYZ tile pyramid of a mosaic")
+    parser.add_argument('image', help="mosaic to tile")
+    parser.add_argument('-o', '--output', default='tiles', help="directory the pyramid is written to")
+    parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE, help="tile size in pixels")
+    parser.add_argument('--format', choices=sorted(FORMATS), default=DEFAULT_FORMAT, help="tile image format")
+    parser.add_argument('--workers', type=int, default=1, help="tiles encoded concurrently")
+    parser.add_argument('--backend', choices=BACKENDS, default='thread', help="worker pool type")
+    args = parser.parse_args(argv)
+
+    image = cv2.imread(args.image, cv2.IMREAD_COLOR)
+    if image is None:
+        print(f"Could not read {args.image}")
+        return 1
+    metadata = build_pyramid(image, args.output, args.tile_size, args.format,
+                             workers=args.workers, backend=args.backend)
+    print(f"Wrote zoom levels 0-{metadata['max_zoom']} of {args.image} to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,202 @@
+"""Result images on disk, named by content and written off the request path
+
+Every result is saved as <name>-<sha256 of its bytes><ext> in one
+directory, so concurrent requests in any worker never overwrite each
+other's files and a repeated result is stored once. The bytes saved are
+the ones the response sends: the image is encoded once.
+
+save() hands the bytes to a background writer thread and returns at
+once; until the file is on disk, get() serves the bytes from memory, so
+a /results link works immediately. Pending bytes are bounded, and a
+save that would exceed the bound writes synchronously instead. Files are
+written to a temporary name and renamed, so readers in other processes
+never see half a file.
+
+The writer also deletes files older than the TTL, by modification time,
+which saving the same result again refreshes, and sweeps the other
+directories it is given (tile pyramids, job images, sessions and the
+like) with the same TTL.
+"""
+import atexit
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+import metrics
+from cache import digest
+from encoding import extension
+
+DEFAULT_TTL = 24 * 3600
+DEFAULT_MAX_PENDING_BYTES = 256 * 1024 * 1024
+# Seconds between retention sweeps of the directory
+CLEANUP_INTERVAL = 300
+
+logger = logging.getLogger(__name__)
+
+
+def _modified(entry):
+    # A directory counts as changed when anything directly in it was
+    mtime = entry.stat().st_mtime
+    if entry.is_dir(follow_symlinks=False):
+        with os.scandir(entry.path) as children:
+            for child in children:
+                mtime = max(mtime, child.stat(follow_symlinks=False).st_mtime)
+    return mtime
+
+
+def expire(directory, cutoff, recursive=False):
+    """Delete what in directory was last modified before cutoff; returns how many were deleted
+
+    Every file or subdirectory of directory is deleted whole, aged by its
+    newest direct change; with recursive, every file in the tree is aged
+    and deleted on its own and emptied subdirectories go with them.
+    """
+    removed = 0
+    if recursive:
+        for root, _, files in os.walk(directory, topdown=False):
+            for name in files:
+                try:
+                    path = os.path.join(root, name)
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+            if root != directory:
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    # Not empty, or already gone
+                    pass
+        return removed
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if _modified(entry) >= cutoff:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+            removed += 1
+        except FileNotFoundError:
+            # Another worker's sweep got there first
+            pass
+    return removed
+
+
+class ResultStore:
+    """Content-addressed result files under directory, written in the background
+
+    expiring lists (directory, recursive) pairs swept with the results;
+    see expire().
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_TTL, max_pending_bytes=DEFAULT_MAX_PENDING_BYTES,
+                 cleanup_interval=CLEANUP_INTERVAL, expiring=()):
+        self.directory = directory
+        self.expiring = list(expiring)
+        self.ttl = ttl
+        self.max_pending_bytes = max_pending_bytes
+        self.cleanup_interval = cleanup_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_bytes = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._last_cleanup = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, result_id):
+        return os.path.join(self.directory, result_id)
+
+    def save(self, name, data, fmt):
+        """Store encoded result bytes and return (result_id, path)"""
+        result_id = f"{name}-{digest(data)}{extension(fmt)}"
+        path = self.path(result_id)
+        with self._lock:
+            if result_id in self._pending:
+                return result_id, path
+            queued = self._pending_bytes + len(data) <= self.max_pending_bytes
+            if queued:
+                self._pending[result_id] = (data, fmt)
+                self._pending_bytes += len(data)
+                self._start()
+        if queued:
+            self._queue.put(result_id)
+        else:
+            # The writer is behind; write this one on the request thread
+            self._write(path, data)
+        return result_id, path
+
+    def get(self, result_id):
+        """(data, fmt) of a result not yet on disk, or None"""
+        with self._lock:
+            return self._pending.get(result_id)
+
+    def flush(self):
+        """Wait until every pending result is on disk"""
+        self._queue.join()
+
+    def cleanup(self, now=None):
+        """Delete results and expiring entries older than the TTL; returns how many were deleted"""
+        if not self.ttl:
+            return 0
+        cutoff = (now or time.time()) - self.ttl
+        removed = expire(self.directory, cutoff)
+        for directory, recursive in self.expiring:
+            removed += expire(directory, cutoff, recursive)
+        return removed
+
+    def _start(self):
+        # Started on first use, so a server that forks workers starts one per worker
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='result-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            try:
+                result_id = self._queue.get(timeout=self.cleanup_interval)
+            except queue.Empty:
+                result_id = None
+            if result_id is not None:
+                with self._lock:
+                    data, _ = self._pending[result_id]
+                try:
+                    self._write(self.path(result_id), data)
+                except OSError:
+                    logger.exception("Could not write result %s", result_id)
+                finally:
+                    with self._lock:
+                        del self._pending[result_id]
+                        self._pending_bytes -= len(data)
+                    self._queue.task_done()
+            if time.monotonic() - self._last_cleanup >= self.cleanup_interval:
+                self._last_cleanup = time.monotonic()
+                try:
+                    self.cleanup()
+                except OSError:
+                    logger.exception("Could not sweep expired results")
+
+    @metrics.timed('write')
+    def _write(self, path, data):
+        # Saving a result again only refreshes its age
+        try:
+            os.utime(path)
+            return
+        except FileNotFoundError:
+            pass
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
@@ -0,0 +1,106 @@
+"""Coarse-to-fine contour extraction: screen a downsampled image, trace windows
+
+A screen is a cheap mask computed on the image shrunk by factor with
+INTER_AREA (which reads every pixel once), marking where the full mask
+could be set: red hue for disease spots, green canopy for trees, any
+non-black pixel for objects. The screen is dilated by margin screen
+pixels plus twice the mask radius (how far a mask component can spread
+from the pixels the screen found, and the band along window edges that
+is not trusted), the dilated regions are boxed and the boxes merged
+until none overlap. The full-resolution pipeline
+then runs only on those windows.
+
+A component is taken from a window only when it lies farther than the
+mask radius from every window edge that is not an image edge, so its
+mask there is exactly the full-frame mask, and it is reported once
+however many windows hold it. The result therefore equals the
+full-frame result whenever the dilated screen covers every component;
+a larger factor is faster and a larger margin recovers components the
+screen only grazed. When the windows cover more than max_fraction of
+the image, screening cannot pay off and the whole image is traced.
+"""
+import math
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+import metrics
+from parallel import BACKENDS
+from tiling import DEFAULT_OVERLAP, DEFAULT_TILE_SIZE, find_contours_tiled
+
+FACTORS = (2, 4, 8)
+DEFAULT_FACTOR = 4
+DEFAULT_MARGIN = 1
+DEFAULT_MAX_FRACTION = 0.5
+
+Screen = namedtuple('Screen', ['factor', 'margin', 'max_fraction'])
+Screen.__new__.__defaults__ = (DEFAULT_FACTOR, DEFAULT_MARGIN, DEFAULT_MAX_FRACTION)
+
+
+@metrics.timed('screen')
+def candidate_windows(image, screen_fn, radius, screen):
+    """Boxes (x0, y0, x1, y1) of the image that may hold mask components"""
+    height, width = image.shape[:2]
+    size = (math.ceil(width / screen.factor), math.ceil(height / screen.factor))
+    small = cv2.resize(np.asarray(image), size, interpolation=cv2.INTER_AREA)
+    candidates = np.ascontiguousarray(screen_fn(small))
+
+    # Grow by the margin, the mask's spread and the untrusted band inside window edges
+    grow = screen.margin + math.ceil((2 * radius + 2) / screen.factor)
+    if grow > 0:
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2 * grow + 1, 2 * grow + 1))
+        candidates = cv2.dilate(candidates, kernel)
+
+    # Overlapping boxes are merged until the count stops changing
+    count = None
+    while True:
+        found, _, stats, _ = cv2.connectedComponentsWithStats(candidates, connectivity=8)
+        boxes = stats[1:, :4]
+        if found - 1 == count:
+            break
+        count = found - 1
+        candidates = np.zeros_like(candidates)
+        for x, y, w, h in boxes:
+            candidates[y:y + h, x:x + w] = 255
+
+    factor = screen.factor
+    return [(x * factor, y * factor, min(width, (x + w) * factor), min(height, (y + h) * factor))
+            for x, y, w, h in boxes]
+
+
+def find_contours_screened(image, mask_fn, screen_fn, radius=0, screen=Screen(), tile_size=DEFAULT_TILE_SIZE,
+                           overlap=DEFAULT_OVERLAP, workers=1, backend='thread', min_area=None):
+    """Outer contours of mask_fn(image), traced only where screen_fn finds candidates
+
+    screen_fn maps the downsampled BGR image to a uint8 mask. Contours are
+    in the order find_contours_tiled would give them; see the module
+    docstring for when they are the same contours.
+    """
+    if screen.factor not in FACTORS:
+        raise ValueError(f"Screen factor must be one of {', '.join(map(str, FACTORS))}")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    height, width = image.shape[:2]
+    windows = candidate_windows(image, screen_fn, radius, screen)
+    covered = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in windows)
+    if covered > screen.max_fraction * height * width:
+        return find_contours_tiled(image, mask_fn, radius, tile_size, overlap, workers, backend, min_area)
+
+    found = {}
+    for x0, y0, x1, y1 in windows:
+        # Pixels this close to a window edge inside the image see a different neighbourhood
+        left = x0 + radius + 1 if x0 > 0 else 0
+        top = y0 + radius + 1 if y0 > 0 else 0
+        right = x1 - radius - 1 if x1 < width else width
+        bottom = y1 - radius - 1 if y1 < height else height
+        for contour in find_contours_tiled(image[y0:y1, x0:x1], mask_fn, radius, tile_size, overlap, workers,
+                                           backend, min_area):
+            contour += (x0, y0)
+            x, y, w, h = cv2.boundingRect(contour)
+            if x < left or y < top or x + w > right or y + h > bottom:
+                continue
+            first = (int(contour[0, 0, 1]), int(contour[0, 0, 0]))
+            found.setdefault(first, contour)
+    # cv2.findContours lists outer contours by first point, last in raster order first
+    return [found[first] for first in sorted(found, reverse=True)]
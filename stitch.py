@@ -1,77 +1,430 @@
-import numpy as np
-import cv2
+"""Hierarchical, out-of-core stitching of nadir UAV frames
+
+Frames are stitched in bounded-size groups, each sub-mosaic is spilled to
+disk, and the sub-mosaics are merged level by level until one mosaic is
+left. Only one group of frames is ever held in memory, so peak memory
+depends on the group size and working resolution rather than on the
+number of frames in the flight.
+
+Frame groups are stitched by cv2.Stitcher, which matches every pair of
+frames, or, with the 'all' and 'neighbours' pairings, by OpenCV's detail
+pipeline fed from the feature cache. 'neighbours' builds one graph of
+each frame's nearest neighbours by GPS or flight order over the whole
+flight, groups frames along it, so frames on adjacent flight lines share
+a group, and matches each frame only with its neighbours.
+
+Usage:
+    python stitch.py images_nadir_RGB -o stitchedOutputProcessed.png
+"""
+import argparse
 import glob
-import imutils
+import math
+import os
+import tempfile
+from collections import deque
+
+import cv2
+import numpy as np
+
+from crop import crop_to_valid, valid_mask
+from features import (DEFAULT_DETECTOR, DEFAULT_NEIGHBOURS, DETECTORS, FeatureStore, detect_features,
+                      gps_positions, image_features, neighbour_mask)
+import metrics
+from ingest import decode_path, file_digest, reduce_for_megapix
+from parallel import BACKENDS, bounded_map
+
+FRAME_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+DEFAULT_GROUP_SIZE = 8
+DEFAULT_WORK_MEGAPIX = 4.0
+DEFAULT_MAX_MOSAIC_MEGAPIX = 60.0
+
+STITCH_MODES = {
+    'panorama': cv2.Stitcher_PANORAMA,
+    'scans': cv2.Stitcher_SCANS,
+}
+
+# 'stitcher' hands groups to cv2.Stitcher; the others run the detail pipeline
+PAIRINGS = ('stitcher', 'all', 'neighbours')
+
+# Matcher confidence and the pair confidence needed to join the mosaic, as in cv2.Stitcher
+MATCH_CONFIDENCE = 0.3
+PAIR_CONFIDENCE = 1.0
+
+
+class StitchError(Exception):
+    """Raised when frames cannot be combined into a single mosaic"""
+
+
+def list_frames(directory):
+    """Sorted image paths in a flight directory"""
+    paths = glob.glob(os.path.join(directory, '*'))
+    return sorted(p for p in paths if p.lower().endswith(FRAME_EXTENSIONS))
+
+
+def resize_to_megapix(image, megapix):
+    """Downscale an image to at most megapix megapixels"""
+    if not megapix:
+        return image
+    height, width = image.shape[:2]
+    scale = math.sqrt(megapix * 1e6 / (height * width))
+    if scale >= 1:
+        return image
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def load_frame(source, megapix=None):
+    """Load a frame from a path, a spilled .npy sub-mosaic or an array
+
+    Image files much larger than megapix are decoded at a reduced scale
+    first, so a full-resolution frame is never held in memory.
+    """
+    if isinstance(source, np.ndarray):
+        image = source
+    elif source.endswith('.npy'):
+        image = np.load(source)
+    else:
+        image = decode_path(source, reduce_for_megapix(source, megapix))
+    if image is None:
+        return None
+    return resize_to_megapix(image, megapix)
+
+
+def stitch_group(images, mode='panorama'):
+    """Stitch one group of images, returning None when OpenCV gives up"""
+    if len(images) == 1:
+        return images[0]
+    stitcher = cv2.Stitcher_create(STITCH_MODES[mode])
+    # Keep feature detection off the black border of earlier sub-mosaics
+    masks = [valid_mask(image) for image in images]
+    # In scans mode its affine solver can assert on degenerate matches instead of failing
+    try:
+        status, mosaic = stitcher.stitch(images, masks)
+    except cv2.error:
+        return None
+    if status != cv2.Stitcher_OK:
+        return None
+    return mosaic
+
+
+def _detail_stages(mode):
+    """Matcher, camera estimator, bundle adjuster and warp type for a mode"""
+    if mode == 'scans':
+        return (cv2.detail_AffineBestOf2NearestMatcher(False, False, MATCH_CONFIDENCE),
+                cv2.detail_AffineBasedEstimator(), cv2.detail_BundleAdjusterAffinePartial(), 'affine')
+    return (cv2.detail_BestOf2NearestMatcher(False, MATCH_CONFIDENCE),
+            cv2.detail_HomographyBasedEstimator(), cv2.detail_BundleAdjusterRay(), 'spherical')
+
+
+def stitch_matched(images, features, pairs, mode='panorama'):
+    """Stitch one group through OpenCV's detail pipeline, matching only some pairs
+
+    features are the cv2.detail.ImageFeatures of the images and pairs a
+    symmetric uint8 matrix marking the pairs to match. Frames left out of
+    the largest connected set of matches are dropped, as cv2.Stitcher
+    does. Returns None when fewer than two frames connect.
+    """
+    matcher, estimator, adjuster, warp_type = _detail_stages(mode)
+    matches = matcher.apply2(features, cv2.UMat(np.ascontiguousarray(pairs, np.uint8)))
+    matcher.collectGarbage()
+    keep = np.ravel(cv2.detail.leaveBiggestComponent(features, matches, PAIR_CONFIDENCE)).tolist()
+    if len(keep) < 2:
+        return None
+    if len(keep) < len(images):
+        for index, frame in enumerate(keep):
+            features[frame].img_idx = index
+        return stitch_matched([images[i] for i in keep], [features[i] for i in keep],
+                              pairs[np.ix_(keep, keep)], mode)
+
+    ok, cameras = estimator.apply(features, matches, None)
+    if not ok:
+        return None
+    for camera in cameras:
+        camera.R = camera.R.astype(np.float32)
+    adjuster.setConfThresh(PAIR_CONFIDENCE)
+    # As in stitch_group, the affine solver can assert instead of failing
+    try:
+        ok, cameras = adjuster.apply(features, matches, cameras)
+    except cv2.error:
+        return None
+    if not ok:
+        return None
+    if mode == 'panorama':
+        rotations = cv2.detail.waveCorrect([np.copy(camera.R) for camera in cameras], cv2.detail.WAVE_CORRECT_HORIZ)
+        for camera, rotation in zip(cameras, rotations):
+            camera.R = rotation
+
+    focals = sorted(camera.focal for camera in cameras)
+    warper = cv2.PyRotationWarper(warp_type, focals[len(focals) // 2])
+    corners, warped, coverage = [], [], []
+    for image, camera in zip(images, cameras):
+        K = camera.K().astype(np.float32)
+        corner, frame = warper.warp(image, K, camera.R, cv2.INTER_LINEAR, cv2.BORDER_REFLECT)
+        _, mask = warper.warp(valid_mask(image), K, camera.R, cv2.INTER_NEAREST, cv2.BORDER_CONSTANT)
+        corners.append(corner)
+        warped.append(frame)
+        coverage.append(mask)
 
-image_paths = glob.glob('unstitchedImages/*.JPG')
-images = []
+    # Voronoi seams give every mosaic pixel to one frame before blending.
+    # Seam finders and blenders built by their own constructors crash the
+    # Python bindings; the createDefault factories do not
+    seam_finder = cv2.detail.SeamFinder_createDefault(cv2.detail.SeamFinder_VORONOI_SEAM)
+    seams = seam_finder.find([cv2.UMat(frame.astype(np.float32)) for frame in warped],
+                             corners, [cv2.UMat(mask) for mask in coverage])
+    blender = cv2.detail.Blender_createDefault(cv2.detail.Blender_MULTI_BAND)
+    blender.prepare(cv2.detail.resultRoi(corners=corners, sizes=[(f.shape[1], f.shape[0]) for f in warped]))
+    for frame, seam, corner in zip(warped, seams, corners):
+        blender.feed(cv2.UMat(frame.astype(np.int16)), seam, corner)
+    mosaic, _ = blender.blend(None, None)
+    return cv2.convertScaleAbs(mosaic)
 
 
-for image in image_paths:
-    img = cv2.imread(image)
-    images.append(img)
-    cv2.imshow("Image", img)
-    cv2.waitKey(0)
+def _match_inputs(sources, images, kept, detector, feature_cache, pairs=None, digests=None):
+    """Features of a group's frames and the pairs to match among them
 
+    kept are the positions in the group of the frames that decoded, and
+    pairs and digests cover the whole group. Features come from the
+    cache in feature_cache, when one is given, keyed by digests or else
+    by hashing each frame file. Without pairs every pair is matched.
+    """
+    store = FeatureStore(feature_cache, detector) if feature_cache else None
+    features = []
+    for index, (source, image) in enumerate(zip(sources, images)):
+        if store is not None:
+            digest = digests[kept[index]] if digests else file_digest(source)
+            frame = store.features(digest, image, valid_mask(image))
+        else:
+            frame = detect_features(image, detector, mask=valid_mask(image))
+        features.append(image_features(index, (image.shape[1], image.shape[0]), frame, detector))
+    if pairs is None:
+        pairs = np.ones((len(images), len(images)), np.uint8)
+    else:
+        pairs = pairs[np.ix_(kept, kept)]
+    return features, pairs
 
-imageStitcher = cv2.Stitcher_create()
 
-error, stitched_img = imageStitcher.stitch(images)
+def _stitch_or_split(images, mode, matched=None):
+    """Stitch a group, falling back to merging neighbours one at a time"""
+    if matched is not None:
+        mosaic = stitch_matched(images, *matched, mode)
+    else:
+        mosaic = stitch_group(images, mode)
+    if mosaic is not None:
+        return [mosaic]
 
-if not error:
+    mosaics = []
+    current = images[0]
+    for image in images[1:]:
+        merged = stitch_group([current, image], mode)
+        if merged is None:
+            mosaics.append(current)
+            current = image
+        else:
+            current = merged
+    mosaics.append(current)
+    return mosaics
 
-    cv2.imwrite("stitchedOutput.png", stitched_img)
-    cv2.imshow("Stitched Img", stitched_img)
-    cv2.waitKey(0)
 
+def _groups(items, size, overlap):
+    """Consecutive groups of items, neighbouring groups sharing overlap items"""
+    step = size - overlap
+    return [items[i:i + size] for i in range(0, max(len(items) - overlap, 1), step)]
 
 
+def _neighbour_groups(graph, size):
+    """Groups of at most size frame indices, grown breadth-first over a neighbour graph
 
-    stitched_img = cv2.copyMakeBorder(stitched_img, 10, 10, 10, 10, cv2.BORDER_CONSTANT, (0,0,0))
+    Each group starts from a frame of the latest group that still has
+    ungrouped neighbours, when no grouped frame has any from the first
+    ungrouped one. A group shares its seed and up to half its size of the
+    seed's grouped neighbours with the groups before it, so sub-mosaics
+    overlap enough to be merged at the next level.
+    """
+    graph = np.asarray(graph, bool)
+    grouped = np.zeros(len(graph), bool)
+    groups = []
+    while not grouped.all():
+        seed = next((frame for group in reversed(groups) for frame in reversed(group)
+                     if (graph[frame] & ~grouped).any()), None)
+        if seed is None:
+            seed = int(np.flatnonzero(~grouped)[0])
+            grouped[seed] = True
+            members = [seed]
+        else:
+            shared = np.flatnonzero(graph[seed] & grouped)[:size // 2 - 1]
+            members = [seed] + [int(frame) for frame in shared]
+        queue = deque([seed])
+        while queue and len(members) < size:
+            for frame in np.flatnonzero(graph[queue.popleft()] & ~grouped)[:size - len(members)]:
+                grouped[frame] = True
+                members.append(int(frame))
+                queue.append(frame)
+        groups.append(members)
+    return groups
 
-    gray = cv2.cvtColor(stitched_img, cv2.COLOR_BGR2GRAY)
-    thresh_img = cv2.threshold(gray, 0, 255 , cv2.THRESH_BINARY)[1]
 
-    cv2.imshow("Threshold Image", thresh_img)
-    cv2.waitKey(0)
+def _stitch_group_task(group, megapix, mode, max_mosaic_megapix, spill_prefix, matching=None):
+    """Load, stitch and spill one group; safe to run in a worker process
 
-    contours = cv2.findContours(thresh_img.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    matching holds the detector, feature_cache, pairs and digests of the
+    group for the detail pipeline (see _match_inputs); spilled
+    sub-mosaics are not frame files, so groups of them always go to
+    cv2.Stitcher.
+    """
+    kept, images = [], []
+    for index, source in enumerate(group):
+        image = load_frame(source, megapix)
+        if image is not None:
+            kept.append(index)
+            images.append(image)
+    sources = [group[index] for index in kept]
+    matched = None
+    if matching and len(images) > 1 and all(isinstance(source, str) and not source.endswith('.npy')
+                                            for source in sources):
+        matched = _match_inputs(sources, images, kept, **matching)
+    paths = []
+    if images:
+        for part, mosaic in enumerate(_stitch_or_split(images, mode, matched)):
+            mosaic = resize_to_megapix(mosaic, max_mosaic_megapix)
+            path = f'{spill_prefix}_{part}.npy'
+            np.save(path, mosaic)
+            paths.append(path)
+    return paths
 
-    contours = imutils.grab_contours(contours)
-    areaOI = max(contours, key=cv2.contourArea)
 
-    mask = np.zeros(thresh_img.shape, dtype="uint8")
-    x, y, w, h = cv2.boundingRect(areaOI)
-    cv2.rectangle(mask, (x,y), (x + w, y + h), 255, -1)
+@metrics.timed('stitch')
+def stitch_frames(sources, group_size=DEFAULT_GROUP_SIZE, work_megapix=DEFAULT_WORK_MEGAPIX,
+                  max_mosaic_megapix=DEFAULT_MAX_MOSAIC_MEGAPIX, mode='panorama',
+                  workdir=None, progress=None, workers=1, backend='thread', pairing='stitcher',
+                  neighbours=DEFAULT_NEIGHBOURS, detector=DEFAULT_DETECTOR, feature_cache=None, digests=None):
+    """Stitch frames into one mosaic by a tree reduction over bounded groups
 
-    minRectangle = mask.copy()
-    sub = mask.copy()
+    sources is an ordered list of image paths or arrays; frames should be in
+    flight order so that neighbouring frames overlap. Each group of
+    group_size frames is stitched at work_megapix, and consecutive groups
+    share one frame so their sub-mosaics can be merged at the next level.
+    Sub-mosaics are capped at max_mosaic_megapix and spilled to workdir.
+    progress, if given, is called as progress(level, done, total) after
+    every group. Groups of the same level are stitched by workers threads
+    or processes, so peak memory grows with workers times group_size.
 
-    while cv2.countNonZero(sub) > 0:
-        minRectangle = cv2.erode(minRectangle, None)
-        sub = cv2.subtract(minRectangle, thresh_img)
+    pairing picks how frame groups are matched: 'stitcher' leaves it to
+    cv2.Stitcher and 'all' matches every pair in the detail pipeline.
+    'neighbours' finds each frame's neighbours nearest by GPS or flight
+    order across the whole flight and grows the first level's groups
+    along them instead of taking consecutive sources, so frames on
+    adjacent flight lines are grouped and matched together; only
+    neighbours are matched, so a group can be much larger than
+    group_size would be for the other pairings. detector features ('orb'
+    or 'sift') are cached under feature_cache when it is given, keyed by
+    digests, the SHA-256 of each source file, or by hashing the files.
+    """
+    if group_size < 2:
+        raise ValueError("group_size must be at least 2")
+    if mode not in STITCH_MODES:
+        raise ValueError(f"Unknown stitch mode: {mode}")
+    if pairing not in PAIRINGS:
+        raise ValueError(f"Unknown pairing: {pairing}")
+    if detector not in DETECTORS:
+        raise ValueError(f"Unknown feature detector: {detector}")
+    if len(sources) < 2:
+        raise StitchError("At least 2 images required for stitching")
 
+    # The first level groups frame indices: consecutive ones, or along the neighbour graph
+    positions = None
+    if pairing == 'neighbours':
+        positions = gps_positions(sources)
+        if positions is None:
+            positions = np.arange(len(sources), dtype=np.float64)
+        first_groups = _neighbour_groups(neighbour_mask(len(sources), neighbours, positions), group_size)
+    else:
+        first_groups = _groups(list(range(len(sources))), group_size, 1)
 
-    contours = cv2.findContours(minRectangle.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    def matching(members):
+        # Within a group each frame is matched with its neighbours among the group
+        if pairing == 'stitcher':
+            return None
+        pairs = None if positions is None else neighbour_mask(len(members), neighbours, positions[members])
+        return dict(detector=detector, feature_cache=feature_cache, pairs=pairs,
+                    digests=[digests[i] for i in members] if digests else None)
 
-    contours = imutils.grab_contours(contours)
-    areaOI = max(contours, key=cv2.contourArea)
+    with tempfile.TemporaryDirectory(dir=workdir) as spill_dir:
+        level = 0
+        paths = list(sources)
+        while True:
+            megapix = work_megapix if level == 0 else None
+            if level == 0:
+                groups = [[sources[i] for i in members] for members in first_groups]
+                matchings = [matching(members) for members in first_groups]
+            else:
+                groups = _groups(paths, group_size, 0)
+                matchings = [None] * len(groups)
+            tasks = [(group, megapix, mode, max_mosaic_megapix, os.path.join(spill_dir, f'level{level}_{index}'),
+                      group_matching)
+                     for index, (group, group_matching) in enumerate(zip(groups, matchings))]
+            outputs = []
+            for index, paths_out in enumerate(bounded_map(_stitch_group_task, tasks, workers, backend)):
+                outputs.extend(paths_out)
+                if progress:
+                    progress(level, index + 1, len(groups))
 
-    cv2.imshow("minRectangle Image", minRectangle)
-    cv2.waitKey(0)
+            if not outputs:
+                raise StitchError("None of the images could be decoded")
+            if len(outputs) == 1:
+                return np.load(outputs[0])
+            if len(outputs) >= len(paths):
+                raise StitchError("Images could not be stitched. Not enough keypoints detected.")
+            paths = outputs
+            level += 1
 
-    x, y, w, h = cv2.boundingRect(areaOI)
 
-    stitched_img = stitched_img[y:y + h, x:x + w]
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stitch a directory of UAV frames into one mosaic")
+    parser.add_argument('directory', help="directory holding the flight frames")
+    parser.add_argument('-o', '--output', default='stitchedOutputProcessed.png', help="output image path")
+    parser.add_argument('--group-size', type=int, default=DEFAULT_GROUP_SIZE,
+                        help="frames stitched together in one group")
+    parser.add_argument('--work-megapix', type=float, default=DEFAULT_WORK_MEGAPIX,
+                        help="working resolution of each frame, 0 for full resolution")
+    parser.add_argument('--max-mosaic-megapix', type=float, default=DEFAULT_MAX_MOSAIC_MEGAPIX,
+                        help="cap on the size of intermediate and final mosaics, 0 for no cap")
+    parser.add_argument('--mode', choices=sorted(STITCH_MODES), default='panorama',
+                        help="OpenCV stitcher mode; 'scans' suits flat nadir imagery")
+    parser.add_argument('--pairing', choices=PAIRINGS, default='stitcher',
+                        help="'neighbours' matches each frame only with its nearest frames by GPS or order")
+    parser.add_argument('--neighbours', type=int, default=DEFAULT_NEIGHBOURS,
+                        help="frames each frame is matched with when pairing by neighbours")
+    parser.add_argument('--detector', choices=DETECTORS, default=DEFAULT_DETECTOR,
+                        help="features of the 'all' and 'neighbours' pairings")
+    parser.add_argument('--feature-cache', help="directory caching features by frame hash")
+    parser.add_argument('--workers', type=int, default=1, help="groups stitched concurrently")
+    parser.add_argument('--backend', choices=BACKENDS, default='thread', help="worker pool type")
+    parser.add_argument('--no-crop', action='store_true', help="keep the black border around the mosaic")
+    args = parser.parse_args(argv)
 
-    cv2.imwrite("stitchedOutputProcessed.png", stitched_img)
+    frames = list_frames(args.directory)
+    print(f"Stitching {len(frames)} frames from {args.directory}")
 
-    cv2.imshow("Stitched Image Processed", stitched_img)
+    def report(level, done, total):
+        print(f"level {level}: group {done}/{total}")
 
-    cv2.waitKey(0)
+    try:
+        mosaic = stitch_frames(frames, group_size=args.group_size, work_megapix=args.work_megapix,
+                               max_mosaic_megapix=args.max_mosaic_megapix, mode=args.mode,
+                               progress=report, workers=args.workers, backend=args.backend,
+                               pairing=args.pairing, neighbours=args.neighbours, detector=args.detector,
+                               feature_cache=args.feature_cache)
+    except StitchError as e:
+        print(e)
+        return 1
 
+    if not args.no_crop:
+        mosaic = crop_to_valid(mosaic)
+    cv2.imwrite(args.output, mosaic)
+    print(f"Saved {mosaic.shape[1]}x{mosaic.shape[0]} mosaic to {args.output}")
+    return 0
 
 
-else:
-    print("Images could not be stitched!")
-    print("Likely not enough keypoints being detected!")
\ No newline at end of file
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,71 @@
+"""Tiled contours against cv2.findContours on the whole mask
+
+find_contours_tiled() promises the contours, in the order, that
+findContours(RETR_EXTERNAL, CHAIN_APPROX_SIMPLE) finds on the whole
+mask. The synthetic masks put speckle, rings around nested blobs and
+strands across tile seams; tile sizes that do not divide the mask leave
+ragged edge tiles.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import cv2
+import pytest
+
+from benchmarks.synthetic import noisy_mask, synthetic_field
+from detectors import DETECTORS, _StageMask, detect, detect_many
+from tiling import find_contours_tiled
+
+
+def _as_mask(window):
+    return window
+
+
+def reference(mask):
+    return list(cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0])
+
+
+def assert_same(expected, found):
+    assert len(found) == len(expected)
+    assert [cv2.boundingRect(cnt) for cnt in found] == [cv2.boundingRect(cnt) for cnt in expected]
+    for a, b in zip(expected, found):
+        assert (a == b).all()
+
+
+@pytest.mark.parametrize('density', [0.05, 0.15, 0.3])
+@pytest.mark.parametrize('tile_size', [128, 200, 1024])
+def test_noisy_mask(density, tile_size):
+    mask = noisy_mask(600, 700, density, seed=int(density * 100))
+    assert_same(reference(mask), find_contours_tiled(mask, _as_mask, 0, tile_size))
+
+
+@pytest.mark.parametrize('name', ['trees', 'diseases', 'objects'])
+def test_min_area(name):
+    # Contours left out by their box are the ones the detector's area test drops
+    detector = DETECTORS[name]
+    mask = noisy_mask(600, 700, 0.15)
+    expected = [cnt for cnt in reference(mask) if detector.keep(cnt)]
+    found = find_contours_tiled(mask, _as_mask, 0, 160, min_area=detector.min_area)
+    assert_same(expected, [cnt for cnt in found if detector.keep(cnt)])
+
+
+def test_thread_workers():
+    mask = noisy_mask(600, 700, 0.15, seed=3)
+    assert_same(reference(mask), find_contours_tiled(mask, _as_mask, 0, 128, workers=4))
+
+
+@pytest.mark.parametrize('name', ['trees', 'areas', 'diseases'])
+def test_detector_mask(name):
+    # Masks computed per padded tile match the mask of the whole field
+    mask_fn = _StageMask(name)
+    field = synthetic_field(500, 640, seed=1)
+    expected = reference(mask_fn(field).copy())
+    assert_same(expected, find_contours_tiled(field, mask_fn, DETECTORS[name].radius, 192))
+
+
+def test_detect_many():
+    # Masks traced together in one tile pass match each detector traced on its own
+    field = synthetic_field(500, 640, seed=2)
+    found = detect_many(list(DETECTORS), field, 192, workers=2)
+    for name in DETECTORS:
+        assert_same(detect(name, field, 192), found[name])
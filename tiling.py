@@ -0,0 +1,636 @@
+"""Tile-by-tile contour extraction for mosaics too large to process whole
+
+The mosaic is split into a grid of core tiles. Each core is widened by an
+overlap to form a trusted region, and the trusted region by the filter
+radius of the mask pipeline so that blurs and thresholds see the same
+neighbourhood they would on the whole image. Only the trusted part of each
+mask is kept, so every intermediate is tile-sized.
+
+A component that lies strictly inside a trusted region is final and is
+reported by the tile whose core holds its first point. A component that
+touches the edge of its trusted region is cut by a seam; its pieces are
+merged and re-extracted from a window grown until the whole component
+fits.
+
+cv2.RETR_EXTERNAL drops components sitting in a hole of another one, and
+that hole may be closed several tiles away. Background regions are
+therefore labelled per core tile and joined across seams with a
+union-find, and a component is kept only when the background just left of
+its first point is connected to the image border.
+
+Components are labelled with cv2.connectedComponentsWithStats and kept
+as NumPy arrays of first points and boxes, so masks with hundreds of
+thousands of specks stay cheap. Callers that only want contours above an
+area pass min_area: a contour is no larger than its box, so components
+with small boxes are dropped in one vectorized step and only the rest are
+traced. A component larger than the tiles still needs a window as large
+as itself.
+
+find_contours_many() runs several masks computed together per tile,
+such as detectors sharing intermediates, through the same pass: every
+mask of a tile is scanned before the next tile, each joined on its own.
+"""
+import cv2
+import numpy as np
+
+import buffers
+import metrics
+from parallel import bounded_map
+
+DEFAULT_TILE_SIZE = 1024
+DEFAULT_OVERLAP = 64
+
+# Background label of pixels outside the image, always outer background
+_OUTSIDE = -1
+
+# Where a candidate finds the background left of its first point
+_LEFT_OUTSIDE, _LEFT_LOCAL, _LEFT_NEIGHBOUR = 0, 1, 2
+
+
+def _clamp(rect, height, width):
+    x0, y0, x1, y1 = rect
+    return (max(x0, 0), max(y0, 0), min(x1, width), min(y1, height))
+
+
+def _expand(rect, margin, height, width):
+    x0, y0, x1, y1 = rect
+    return _clamp((x0 - margin, y0 - margin, x1 + margin, y1 + margin), height, width)
+
+
+def _union(a, b):
+    if a is None:
+        return b
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _intersects(a, b, margin=0):
+    return (a[0] - margin < b[2] and b[0] - margin < a[2]
+            and a[1] - margin < b[3] and b[1] - margin < a[3])
+
+
+def _contains(outer, inner):
+    return (inner[0] >= outer[0] and inner[1] >= outer[1]
+            and inner[2] <= outer[2] and inner[3] <= outer[3])
+
+
+def _is_cut(boxes, region, height, width):
+    """Whether boxes touch an edge of region that is not the image edge
+
+    Works on one box and region or on arrays of them.
+    """
+    x0, y0, x1, y1 = region
+    return (((boxes[..., 0] <= x0) & (x0 > 0)) | ((boxes[..., 1] <= y0) & (y0 > 0))
+            | ((boxes[..., 2] >= x1) & (x1 < width)) | ((boxes[..., 3] >= y1) & (y1 < height)))
+
+
+def iter_tiles(height, width, tile_size=DEFAULT_TILE_SIZE):
+    """Core tiles covering an image, as (x0, y0, x1, y1) in raster order"""
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            yield (x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height))
+
+
+def _padded(image, region, radius):
+    """Window of image around region with radius pixels of context"""
+    height, width = image.shape[:2]
+    padded = _expand(region, radius, height, width)
+    return image[padded[1]:padded[3], padded[0]:padded[2]], padded
+
+
+def _window_mask(window, padded, mask_fn, region):
+    """mask_fn over a padded window, cropped back to region"""
+    mask = mask_fn(np.asarray(window))
+    x0, y0, x1, y1 = region
+    return mask[y0 - padded[1]:y1 - padded[1], x0 - padded[0]:x1 - padded[0]]
+
+
+def _region_mask(image, mask_fn, radius, region, chunk=DEFAULT_TILE_SIZE):
+    """mask_fn evaluated over region, with radius pixels of context
+
+    Regions larger than chunk are evaluated chunk by chunk, so only the
+    mask itself is region-sized.
+    """
+    x0, y0, x1, y1 = region
+    if x1 - x0 <= chunk and y1 - y0 <= chunk:
+        window, padded = _padded(image, region, radius)
+        return _window_mask(window, padded, mask_fn, region)
+    mask = np.empty((y1 - y0, x1 - x0), dtype=np.uint8)
+    for cx0, cy0, cx1, cy1 in iter_tiles(y1 - y0, x1 - x0, chunk):
+        part = (x0 + cx0, y0 + cy0, x0 + cx1, y0 + cy1)
+        window, padded = _padded(image, part, radius)
+        mask[cy0:cy1, cx0:cx1] = _window_mask(window, padded, mask_fn, part)
+    return mask
+
+
+@buffers.pooled
+def _core_masks(window, padded, core, masks_fn):
+    """masks_fn over a padded window, each mask cropped back to core
+
+    The crops are copied out of the worker's buffers, which the worker
+    reuses for its next tile while these are still being assembled.
+    """
+    x0, y0, x1, y1 = core
+    masks = masks_fn(np.asarray(window))
+    return [mask[y0 - padded[1]:y1 - padded[1], x0 - padded[0]:x1 - padded[0]].copy() for mask in masks]
+
+
+def map_tiles(fn, image, radius=0, tile_size=DEFAULT_TILE_SIZE, workers=1, backend='thread', args=()):
+    """Yield (core, fn(window, padded, core, *args)) for every core tile
+
+    window is the core widened by radius pixels of context and clipped to
+    the image; padded is its rectangle. Results come in raster order while
+    fn runs on the worker pool, so fn must be module-level for processes.
+    """
+    height, width = image.shape[:2]
+
+    def tile_tasks():
+        for core in iter_tiles(height, width, tile_size):
+            window, padded = _padded(image, core, radius)
+            yield (window, padded, core) + tuple(args)
+
+    cores = iter_tiles(height, width, tile_size)
+    yield from zip(cores, bounded_map(fn, tile_tasks(), workers, backend))
+
+
+def masks_tiled(image, masks_fn, radius=0, tile_size=DEFAULT_TILE_SIZE, workers=1, backend='thread'):
+    """Image-sized masks assembled from masks_fn over padded core tiles
+
+    masks_fn maps a BGR window to a list of binary masks and must only look
+    at pixels within radius of each output pixel, so the result equals
+    masks_fn(image). Lets several mask pipelines share work per tile.
+    """
+    height, width = image.shape[:2]
+    masks = None
+    tiles = map_tiles(_core_masks, image, radius, tile_size, workers, backend, (masks_fn,))
+    for (x0, y0, x1, y1), tile_masks in tiles:
+        if masks is None:
+            masks = [np.empty((height, width), dtype=np.uint8) for _ in tile_masks]
+        for mask, tile_mask in zip(masks, tile_masks):
+            mask[y0:y1, x0:x1] = tile_mask
+    return masks or []
+
+
+def _local_background(core_mask):
+    """4-connected background labels of a core, 0 on foreground"""
+    pool = buffers.current()
+    background = cv2.compare(core_mask, 0, cv2.CMP_EQ, dst=pool.get('background', core_mask.shape))
+    labels = pool.get('background-labels', core_mask.shape, np.int32)
+    return cv2.connectedComponents(background, labels, connectivity=4, ltype=cv2.CV_32S)
+
+
+def _components(mask, origin):
+    """Labels and boxes of the 8-connected components of a mask
+
+    Component i has label i + 1. Components nested in holes are labelled
+    too; the background pass decides which ones findContours would report.
+    Boxes are (x0, y0, x1, y1) in image coordinates.
+    """
+    labels = buffers.current().get('labels', mask.shape, np.int32)
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(mask, labels, connectivity=8, ltype=cv2.CV_32S)
+    low = stats[1:, :2].astype(np.int64) + origin
+    return labels, np.concatenate([low, low + stats[1:, 2:4]], axis=1)
+
+
+def could_exceed(boxes, min_area):
+    """Which boxes can hold an outer contour enclosing more than min_area
+
+    Contour vertices are pixel centres, so a contour spans at most one
+    pixel less than its box each way.
+    """
+    if min_area is None:
+        return np.ones(len(boxes), dtype=bool)
+    return (boxes[:, 2] - boxes[:, 0] - 1) * (boxes[:, 3] - boxes[:, 1] - 1) > min_area
+
+
+def _first_points(labels, boxes, index, origin, chunk=1024):
+    """Raster-first pixel of the components at index, in image coordinates
+
+    The first pixel lies on the top row of a box. Components are taken in
+    order of box width so each chunk gathers row segments of similar
+    length rather than whole rows.
+    """
+    ox, oy = origin
+    firsts = np.empty((len(index), 2), dtype=np.int64)
+    widths = boxes[index, 2] - boxes[index, 0]
+    order = np.argsort(widths, kind='stable')
+    last_column = labels.shape[1] - 1
+    for start in range(0, len(order), chunk):
+        part = order[start:start + chunk]
+        lefts, tops = boxes[index[part], 0] - ox, boxes[index[part], 1] - oy
+        columns = np.minimum(lefts[:, None] + np.arange(widths[part].max()), last_column)
+        hits = labels[tops[:, None], columns] == (index[part] + 1)[:, None]
+        firsts[part, 0] = hits.argmax(axis=1) + lefts + ox
+        firsts[part, 1] = tops + oy
+    return firsts
+
+
+def _trace(labels, boxes, index, firsts, origin):
+    """Outer contours of the components at index, as findContours gives them
+
+    Only those components are drawn into a mask, which is traced once;
+    removing other components leaves a border unchanged. A component in a
+    hole of another one is traced on its own.
+    """
+    if not len(index):
+        return []
+    ox, oy = origin
+    lookup = np.zeros(len(boxes) + 1, dtype=np.uint8)
+    lookup[index + 1] = 255
+    x0, y0 = boxes[index, :2].min(axis=0).tolist()
+    x1, y1 = boxes[index, 2:].max(axis=0).tolist()
+    spanned = labels[y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+    mask = np.take(lookup, spanned, out=buffers.current().get('traced', spanned.shape))
+    found, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+    # Each contour starts at its component's first point
+    outer = {tuple(cnt[0, 0].tolist()): cnt for cnt in found}
+    contours = []
+    for i, first in zip(index.tolist(), map(tuple, firsts.tolist())):
+        if first not in outer:
+            bx0, by0, bx1, by1 = boxes[i].tolist()
+            component = (labels[by0 - oy:by1 - oy, bx0 - ox:bx1 - ox] == i + 1).view(np.uint8)
+            outer[first] = cv2.findContours(component, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                            offset=(bx0, by0))[0][0]
+        contours.append(outer[first])
+    return contours
+
+
+class _Background:
+    """Background regions of the whole mask, labelled tile by tile
+
+    Labels are 4-connected, matching how findContours separates holes, and
+    are joined across tile seams with a union-find. A region is outer when
+    it reaches the image border.
+    """
+
+    def __init__(self, height, width):
+        self.height, self.width = height, width
+        self.parent = []
+        self.outer = set()
+        self.offsets = {}
+
+    def _find(self, label):
+        parent = self.parent
+        root = label
+        while parent[root] != root:
+            root = parent[root]
+        while parent[label] != root:
+            parent[label], label = root, parent[label]
+        return root
+
+    def _join(self, a, b):
+        pairs = np.unique(np.stack([a, b], axis=1)[(a >= 0) & (b >= 0)], axis=0)
+        for left, right in pairs.tolist():
+            left, right = self._find(left), self._find(right)
+            if left != right:
+                self.parent[right] = left
+                if right in self.outer:
+                    self.outer.add(left)
+
+    def register(self, core, count):
+        """Reserve global labels for the count local labels of a core"""
+        if core not in self.offsets:
+            self.offsets[core] = len(self.parent)
+            self.parent.extend(range(len(self.parent), len(self.parent) + count - 1))
+
+    def to_global(self, core, local):
+        """Map local labels of a registered core to global ones, -1 on foreground"""
+        local = np.asarray(local, dtype=np.int64)
+        return np.where(local > 0, local + (self.offsets[core] - 1), -1)
+
+    def add(self, core, edges, left_column, above_row):
+        """Join a core, given its global edge labels, to its left and upper neighbours"""
+        x0, y0, x1, y1 = core
+        first_column, first_row, last_column, last_row = edges
+        if left_column is not None:
+            self._join(left_column, first_column)
+        if above_row is not None:
+            self._join(above_row, first_row)
+        edges = []
+        if x0 == 0:
+            edges.append(first_column)
+        if y0 == 0:
+            edges.append(first_row)
+        if x1 == self.width:
+            edges.append(last_column)
+        if y1 == self.height:
+            edges.append(last_row)
+        for label in np.unique(np.concatenate(edges)).tolist() if edges else []:
+            if label >= 0:
+                self.outer.add(self._find(label))
+
+    def is_outer(self, labels):
+        """Boolean array marking labels whose region reaches the image border"""
+        unique = np.unique(labels)
+        outer = [label for label in unique.tolist() if label == _OUTSIDE or self._find(label) in self.outer]
+        return np.isin(labels, outer)
+
+
+@buffers.pooled
+@metrics.timed('contours')
+def _scan_tile(window, padded, region, core, mask_fn, height, width, min_area):
+    """Label and trace one tile; safe to run in a worker thread or process
+
+    Returns the number of local background labels, the local labels along
+    the core's edges, the contours owned by the core, and for every
+    component whose first point is in the core and that is cut or could
+    exceed min_area: that first point, where to find the background left
+    of it (kind and value) and whether the component is cut. Last come the
+    boxes of the cut pieces to re-extract.
+    """
+    return _scan_mask(_window_mask(window, padded, mask_fn, region), region, core, height, width, min_area)
+
+
+@buffers.pooled
+@metrics.timed('contours')
+def _scan_tile_many(window, padded, region, core, masks_fn, height, width, min_areas):
+    """_scan_tile for every mask of masks_fn, computed together over one window"""
+    x0, y0, x1, y1 = region
+    masks = masks_fn(np.asarray(window))
+    return [_scan_mask(mask[y0 - padded[1]:y1 - padded[1], x0 - padded[0]:x1 - padded[0]], region, core,
+                       height, width, min_area)
+            for mask, min_area in zip(masks, min_areas)]
+
+
+def _scan_mask(mask, region, core, height, width, min_area):
+    """Label and trace the core of a trusted region's mask; see _scan_tile"""
+    x0, y0, x1, y1 = core
+    core_mask = mask[y0 - region[1]:y1 - region[1], x0 - region[0]:x1 - region[0]]
+    count, local = _local_background(core_mask)
+    edges = (local[:, 0].copy(), local[0].copy(), local[:, -1].copy(), local[-1].copy())
+
+    labels, boxes = _components(mask, region[:2])
+    cut = _is_cut(boxes, region, height, width)
+    # Small uncut components are dropped before anything is done per component;
+    # a first point lies on the top row of its box, so rows are checked first
+    tops = boxes[:, 1]
+    index = np.flatnonzero((cut | could_exceed(boxes, min_area)) & (tops >= y0) & (tops < y1))
+    firsts = _first_points(labels, boxes, index, region[:2])
+    owned = (firsts[:, 0] >= x0) & (firsts[:, 0] < x1)
+    index, firsts = index[owned], firsts[owned]
+    xs, ys = firsts[:, 0], firsts[:, 1]
+
+    # A cut piece holding its component's first point is where the seam
+    # pass will find that component, so it gets a background label too
+    kinds = np.where(xs == 0, _LEFT_OUTSIDE, np.where(xs > x0, _LEFT_LOCAL, _LEFT_NEIGHBOUR))
+    values = np.where(kinds == _LEFT_LOCAL, local[ys - y0, np.maximum(xs - 1 - x0, 0)], ys - y0)
+    owned_cut = cut[index]
+    candidates = _trace(labels, boxes, index[~owned_cut], firsts[~owned_cut], region[:2])
+
+    # A cut component owned by this core always has a piece reaching into
+    # it; pieces lying wholly in the overlap belong to a neighbour's core
+    touches_core = (boxes[:, 0] < x1) & (boxes[:, 2] > x0) & (boxes[:, 1] < y1) & (boxes[:, 3] > y0)
+    return count, edges, candidates, firsts, kinds, values, owned_cut, boxes[cut & touches_core]
+
+
+class _Grid:
+    """Geometry of the tile grid shared by the tile and seam passes"""
+
+    def __init__(self, height, width, tile_size, overlap):
+        self.height, self.width = height, width
+        self.tile_size, self.overlap = tile_size, overlap
+
+    def trusted(self, core):
+        return _expand(core, self.overlap, self.height, self.width)
+
+    def owner(self, point):
+        x0 = (int(point[0]) // self.tile_size) * self.tile_size
+        y0 = (int(point[1]) // self.tile_size) * self.tile_size
+        return (x0, y0, min(x0 + self.tile_size, self.width), min(y0 + self.tile_size, self.height))
+
+    def reported_by_tile(self, firsts, boxes):
+        """Which components the tile pass already decided on"""
+        size, margin = self.tile_size, self.overlap
+        cx0 = (firsts[:, 0] // size) * size
+        cy0 = (firsts[:, 1] // size) * size
+        region = (np.maximum(cx0 - margin, 0), np.maximum(cy0 - margin, 0),
+                  np.minimum(cx0 + size + margin, self.width), np.minimum(cy0 + size + margin, self.height))
+        inside = ((boxes[:, 0] >= region[0]) & (boxes[:, 1] >= region[1])
+                  & (boxes[:, 2] <= region[2]) & (boxes[:, 3] <= region[3]))
+        return inside & ~_is_cut(boxes, region, self.height, self.width)
+
+
+def _merge_pieces(pieces, cell):
+    """Group cut pieces whose boxes touch or overlap into seed windows"""
+    parent = list(range(len(pieces)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # Bucket pieces on a coarse grid so only nearby boxes are compared
+    buckets = {}
+    for i, piece in enumerate(pieces):
+        for cx in range((piece[0] - 1) // cell, piece[2] // cell + 1):
+            for cy in range((piece[1] - 1) // cell, piece[3] // cell + 1):
+                bucket = buckets.setdefault((cx, cy), [])
+                for j in bucket:
+                    if _intersects(pieces[j], piece, margin=1):
+                        parent[find(j)] = find(i)
+                bucket.append(i)
+
+    seeds = {}
+    for i, piece in enumerate(pieces):
+        root = find(i)
+        seeds[root] = _union(seeds.get(root), piece)
+    return list(seeds.values())
+
+
+@buffers.pooled
+@metrics.timed('contours')
+def _resolve_seed(image, mask_fn, radius, grid, seed, min_area):
+    """Re-extract the components under a seed, growing the window until none is cut
+
+    Only components under the seed itself drive the growth, so a window in
+    a dense speckle field does not creep outwards one neighbour at a time.
+    Returns the final window, the complete components inside it that the
+    tile pass left undecided and that could exceed min_area as (contours,
+    first points), and the boxes of the components the window still cuts.
+    """
+    height, width = grid.height, grid.width
+    # One pixel of margin so a component that fills the seed is not cut
+    region = _expand(seed, 1, height, width)
+    while True:
+        labels, boxes = _components(_region_mask(image, mask_fn, radius, region), region[:2])
+        cut = _is_cut(boxes, region, height, width)
+        under_seed = ((boxes[:, 0] < seed[2]) & (seed[0] < boxes[:, 2])
+                      & (boxes[:, 1] < seed[3]) & (seed[1] < boxes[:, 3]))
+        growing = boxes[cut & under_seed]
+        if not len(growing):
+            index = np.flatnonzero(~cut & could_exceed(boxes, min_area))
+            firsts = _first_points(labels, boxes, index, region[:2])
+            undecided = ~grid.reported_by_tile(firsts, boxes[index])
+            index, firsts = index[undecided], firsts[undecided]
+            return region, (_trace(labels, boxes, index, firsts, region[:2]), firsts), boxes[cut].tolist()
+        # Grow by half the visible extent so a long component costs a few passes
+        gx0, gy0 = growing[:, 0].min(), growing[:, 1].min()
+        gx1, gy1 = growing[:, 2].max(), growing[:, 3].max()
+        mx = max(grid.overlap, int(gx1 - gx0) // 2)
+        my = max(grid.overlap, int(gy1 - gy0) // 2)
+        region = _union(region, _clamp((int(gx0) - mx, int(gy0) - my, int(gx1) + mx, int(gy1) + my), height, width))
+
+
+class _Resolved:
+    """Windows already re-extracted, bucketed by tile for quick lookup"""
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.buckets = {}
+
+    def _cells(self, rect):
+        size = self.grid.tile_size
+        for cy in range(rect[1] // size, (rect[3] - 1) // size + 1):
+            for cx in range(rect[0] // size, (rect[2] - 1) // size + 1):
+                yield cx, cy
+
+    def add(self, region, cut):
+        for cell in self._cells(region):
+            self.buckets.setdefault(cell, []).append((region, cut))
+
+    def covers(self, seed):
+        """Whether an earlier window already holds every component under seed"""
+        height, width = self.grid.height, self.grid.width
+        for region, cut in self.buckets.get(next(self._cells(seed)), []):
+            if (_contains(region, seed) and not _is_cut(np.array(seed), region, height, width)
+                    and not any(_intersects(seed, bbox) for bbox in cut)):
+                return True
+        return False
+
+
+class _Joined:
+    """Contours of one mask, joined across seams from its tile scans in raster order"""
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.background = _Background(grid.height, grid.width)
+        self.contours, self.firsts, self.labels, self.pieces = [], [], [], []
+        self.cut_labels = {}
+        self.above_rows, self.left_column = {}, None
+
+    def add(self, core, scan):
+        """Join the scan of one core tile to the cores before it"""
+        count, edges, tile_contours, tile_firsts, kinds, values, owned_cut, tile_pieces = scan
+        background = self.background
+        x0 = core[0]
+        if x0 == 0:
+            self.left_column = None
+        background.register(core, count)
+        edges = tuple(background.to_global(core, edge) for edge in edges)
+        background.add(core, edges, self.left_column, self.above_rows.get(x0))
+
+        tile_labels = np.full(len(kinds), _OUTSIDE, dtype=np.int64)
+        local = kinds == _LEFT_LOCAL
+        tile_labels[local] = background.to_global(core, values[local])
+        neighbour = kinds == _LEFT_NEIGHBOUR
+        if neighbour.any():
+            tile_labels[neighbour] = self.left_column[values[neighbour]]
+
+        self.contours.extend(tile_contours)
+        self.firsts.append(tile_firsts[~owned_cut])
+        self.labels.append(tile_labels[~owned_cut])
+        self.cut_labels.update(zip(map(tuple, tile_firsts[owned_cut].tolist()), tile_labels[owned_cut].tolist()))
+        self.pieces.extend(tile_pieces.tolist())
+
+        self.above_rows[x0] = edges[3]
+        self.left_column = edges[2]
+
+    def finish(self, image, mask_fn, radius, min_area):
+        """Rebuild the components cut by seams and return the outer contours in findContours order"""
+        grid, contours, firsts, labels = self.grid, self.contours, self.firsts, self.labels
+        # Components cut by a seam are rebuilt from a window around their pieces
+        seen, resolved = set(), _Resolved(grid)
+        for seed in _merge_pieces(self.pieces, max(grid.overlap, 32)):
+            if resolved.covers(seed):
+                continue
+            region, (window_contours, window_firsts), cut = _resolve_seed(image, mask_fn, radius, grid, seed,
+                                                                          min_area)
+            resolved.add(region, cut)
+            for i in range(len(window_contours)):
+                key = tuple(window_firsts[i].tolist())
+                if key not in seen:
+                    seen.add(key)
+                    contours.append(window_contours[i])
+                    firsts.append(window_firsts[i:i + 1])
+                    # The owner tile saw this component cut and labelled its first point
+                    labels.append(np.array([self.cut_labels[key]], dtype=np.int64))
+
+        firsts = np.concatenate(firsts) if firsts else np.empty((0, 2), np.int64)
+        labels = np.concatenate(labels) if labels else np.empty(0, np.int64)
+        outer = self.background.is_outer(labels)
+        # findContours lists contours in reverse raster order of their first point
+        order = np.lexsort((firsts[:, 0], firsts[:, 1]))[::-1]
+        return [contours[i] for i in order[outer[order]].tolist()]
+
+
+class _Nth:
+    """mask_fn picking one mask of a masks_fn"""
+
+    def __init__(self, masks_fn, index):
+        self.masks_fn = masks_fn
+        self.index = index
+
+    def __call__(self, window):
+        return self.masks_fn(window)[self.index]
+
+
+def find_contours_tiled(image, mask_fn, radius=0, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP,
+                        workers=1, backend='thread', min_area=None):
+    """Outer contours of mask_fn(image), computed tile by tile
+
+    mask_fn maps a BGR window to a binary mask of the same size and must
+    only look at pixels within radius of each output pixel. image may be
+    any array supporting slicing, such as a memory-mapped .npy mosaic.
+    Tiles are scanned by workers threads or processes (see parallel.py);
+    mask_fn must be a module-level function for the process backend.
+    Returns the same contours, in the same order, as running
+    cv2.findContours(mask_fn(image), RETR_EXTERNAL, CHAIN_APPROX_SIMPLE).
+    With min_area, contours whose box is too small to enclose more than
+    min_area are left out without being traced; callers still apply their
+    exact area test to the rest.
+    """
+    height, width = image.shape[:2]
+    grid = _Grid(height, width, tile_size, overlap)
+
+    def tile_tasks():
+        for core in iter_tiles(height, width, tile_size):
+            region = grid.trusted(core)
+            window, padded = _padded(image, region, radius)
+            yield window, padded, region, core, mask_fn, height, width, min_area
+
+    joined = _Joined(grid)
+    cores = iter_tiles(height, width, tile_size)
+    # Scans run concurrently; seams are joined here, in raster order
+    for core, scan in zip(cores, bounded_map(_scan_tile, tile_tasks(), workers, backend)):
+        joined.add(core, scan)
+    return joined.finish(image, mask_fn, radius, min_area)
+
+
+def find_contours_many(image, masks_fn, min_areas, radius=0, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP,
+                       workers=1, backend='thread'):
+    """find_contours_tiled for every mask of masks_fn, in one pass over the tiles
+
+    masks_fn maps a BGR window to a list of binary masks, one per entry
+    of min_areas, and must only look at pixels within radius of each
+    output pixel. The masks of a tile are computed together and each is
+    traced before the next tile, so memory stays tile-sized however many
+    masks there are. Returns one contour list per mask, each as
+    find_contours_tiled would return it.
+    """
+    min_areas = list(min_areas)
+    height, width = image.shape[:2]
+    grid = _Grid(height, width, tile_size, overlap)
+
+    def tile_tasks():
+        for core in iter_tiles(height, width, tile_size):
+            region = grid.trusted(core)
+            window, padded = _padded(image, region, radius)
+            yield window, padded, region, core, masks_fn, height, width, min_areas
+
+    joined = [_Joined(grid) for _ in min_areas]
+    cores = iter_tiles(height, width, tile_size)
+    for core, scans in zip(cores, bounded_map(_scan_tile_many, tile_tasks(), workers, backend)):
+        for mask_contours, scan in zip(joined, scans):
+            mask_contours.add(core, scan)
+    return [mask_contours.finish(image, _Nth(masks_fn, index), radius, min_area)
+            for index, (mask_contours, min_area) in enumerate(zip(joined, min_areas))]
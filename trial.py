@@ -1,6 +1,8 @@
 import cv2
 import numpy as np
 
+from zonal import zonal_stats
+
 def detect_crops_and_trees(image):
     # Convert the image to grayscale
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -80,17 +82,13 @@ def detect_disease(image):
 
 
 
-# Process each cropped image (assuming crop_tree_boxes contains the bounding boxes)
-for box in crop_tree_boxes:
-    x, y, w, h = box
-    cropped_image = stitched_image[y:y+h, x:x+w]  # Crop the image to the bounding box
-    diseases, result_image = detect_disease(cropped_image)
-    # Further processing or analysis
-    # Print or store the detected diseases for each cropped image
-    print("Detected diseases for cropped image at ({},{}): {}".format(x, y, len(diseases)))
-
-    # Display the result image (for visualization)
-    # cv2.imshow('Disease Detection Result', result_image)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
-cv2.imwrite('detected_diseases.jpg', result_image)
\ No newline at end of file
+# Disease statistics for every box in one labelling pass, instead of
+# cropping the image and re-running detect_disease once per box
+zones = [np.array([[x, y], [x + w - 1, y], [x + w - 1, y + h - 1], [x, y + h - 1]], np.int32).reshape(-1, 1, 2)
+         for x, y, w, h in crop_tree_boxes]
+for zone in zonal_stats(stitched_image, zones):
+    print("Detected diseases for cropped image at ({},{}): {} spots, {:.1%} of pixels".format(
+        zone['x'], zone['y'], zone['disease_spots'], zone['disease_fraction']))
+
+diseases, result_image = detect_disease(stitched_image)
+cv2.imwrite('detected_diseases.jpg', result_image)
@@ -0,0 +1,205 @@
+"""Per-zone statistics over plots or detected areas in one pass
+
+Zones are polygons: the outer contours of the detected areas by default,
+or plot outlines supplied by the caller. They are rasterized into a
+label image once per tile, and every measure is reduced per label with
+np.bincount, so thousands of zones cost one pass over the mosaic instead
+of one crop and re-analysis per zone. Each pixel carries one label, so
+overlapping zones never count a pixel twice; a later zone wins. Zones
+and disease spots that are detected rather than given are traced
+together in a single detect_many() pass before the statistics pass.
+
+Usage:
+    python zonal.py stitchedOutputProcessed.png -o zones.csv [--zones plots.json]
+"""
+import argparse
+import csv
+import json
+
+import cv2
+import numpy as np
+
+import buffers
+from detectors import DETECTORS, Stages, detect_many, disease_mask, green_mask
+from indices import INDICES, index_tile
+from parallel import BACKENDS
+from tiling import DEFAULT_TILE_SIZE, map_tiles
+
+DEFAULT_INDICES = ('exg',)
+
+
+@buffers.pooled
+def _zone_tile(window, padded, core, index_names):
+    """Disease and green masks and index values of one core tile"""
+    x0, y0, x1, y1 = core
+    crop = (slice(y0 - padded[1], y1 - padded[1]), slice(x0 - padded[0], x1 - padded[0]))
+    stages = Stages(np.asarray(window))
+    diseased = disease_mask(stages)[crop] != 0
+    green = green_mask(stages)[crop] != 0
+    tile = np.asarray(window)[crop]
+    values = [index_tile(name, tile)[0] for name in index_names]
+    return diseased, green, values
+
+
+def _coordinate(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and abs(value) < 2 ** 31
+
+
+def polygons_from_json(data):
+    """Zone polygons from a JSON list of [[x, y], ...] point lists
+
+    Raises ValueError naming the first zone that is not a list of
+    at least three [x, y] points.
+    """
+    if not isinstance(data, list):
+        raise ValueError("zones must be a JSON list of [[x, y], ...] polygons")
+    polygons = []
+    for index, points in enumerate(data):
+        if (not isinstance(points, list) or len(points) < 3
+                or not all(isinstance(point, list) and len(point) == 2 and all(map(_coordinate, point))
+                           for point in points)):
+            raise ValueError(f"zone {index} must be a list of at least three [x, y] points")
+        polygons.append(np.asarray(points, dtype=np.int32).reshape(-1, 1, 2))
+    return polygons
+
+
+def _centroids(contours):
+    """Integer centroid of each contour, falling back to its first point"""
+    points = np.empty((len(contours), 2), np.int64)
+    for i, contour in enumerate(contours):
+        moments = cv2.moments(contour)
+        if moments['m00']:
+            points[i] = (int(moments['m10'] / moments['m00']), int(moments['m01'] / moments['m00']))
+        else:
+            points[i] = contour[0, 0]
+    return points
+
+
+def zonal_stats(image, zones=None, index_names=DEFAULT_INDICES, spots=None,
+                tile_size=DEFAULT_TILE_SIZE, overlap=None, workers=1, backend='thread'):
+    """Statistics of every zone of image, as a list of dicts
+
+    zones defaults to the contours of the 'areas' detector and spots, the
+    disease spots counted per zone by their centroid, to the 'diseases'
+    detector. Each zone reports its bounding box, pixel count, diseased
+    and green pixel fractions, disease spot count and the mean of every
+    index in index_names over its pixels.
+    """
+    unknown = [name for name in index_names if name not in INDICES]
+    if unknown:
+        raise ValueError(f"Unknown index: {', '.join(unknown)}")
+    options = dict(tile_size=tile_size, workers=workers, backend=backend)
+    if overlap is not None:
+        options['overlap'] = overlap
+    # Areas and diseases share one tile pass and its intermediates
+    found = detect_many([name for name, given in (('areas', zones), ('diseases', spots)) if given is None],
+                        image, **options)
+    if zones is None:
+        zones = found['areas']
+    if spots is None:
+        spots = found['diseases']
+
+    count = len(zones)
+    boxes = np.array([cv2.boundingRect(zone) for zone in zones], dtype=np.int64).reshape(-1, 4)
+    spot_points = _centroids(spots)
+    # Label 0 is the background; zone i has label i + 1
+    pixels = np.zeros(count + 1, np.int64)
+    diseased = np.zeros(count + 1, np.float64)
+    green = np.zeros(count + 1, np.float64)
+    sums = np.zeros((len(index_names), count + 1), np.float64)
+    spot_counts = np.zeros(count + 1, np.int64)
+
+    radius = DETECTORS['diseases'].radius
+    for core, (tile_diseased, tile_green, values) in map_tiles(
+            _zone_tile, image, radius, tile_size, workers, backend, (tuple(index_names),)):
+        x0, y0, x1, y1 = core
+        hit = np.flatnonzero((boxes[:, 0] < x1) & (boxes[:, 0] + boxes[:, 2] > x0)
+                             & (boxes[:, 1] < y1) & (boxes[:, 1] + boxes[:, 3] > y0))
+        if not len(hit):
+            continue
+        labels = np.zeros((y1 - y0, x1 - x0), np.int32)
+        for i in hit.tolist():
+            cv2.drawContours(labels, zones, i, i + 1, cv2.FILLED, offset=(-x0, -y0))
+
+        flat = labels.ravel()
+        pixels += np.bincount(flat, minlength=count + 1)
+        diseased += np.bincount(flat, weights=tile_diseased.ravel(), minlength=count + 1)
+        green += np.bincount(flat, weights=tile_green.ravel(), minlength=count + 1)
+        for row, tile_values in enumerate(values):
+            sums[row] += np.bincount(flat, weights=tile_values.ravel(), minlength=count + 1)
+
+        inside = ((spot_points[:, 0] >= x0) & (spot_points[:, 0] < x1)
+                  & (spot_points[:, 1] >= y0) & (spot_points[:, 1] < y1))
+        points = spot_points[inside]
+        spot_counts += np.bincount(labels[points[:, 1] - y0, points[:, 0] - x0], minlength=count + 1)
+
+    covered = np.maximum(pixels, 1)
+    results = []
+    for i in range(count):
+        x, y, w, h = boxes[i].tolist()
+        zone = {
+            "zone": i + 1,
+            "x": x,
+            "y": y,
+            "w": w,
+            "h": h,
+            "pixels": int(pixels[i + 1]),
+            "disease_fraction": float(diseased[i + 1] / covered[i + 1]),
+            "green_cover": float(green[i + 1] / covered[i + 1]),
+            "disease_spots": int(spot_counts[i + 1]),
+        }
+        for row, name in enumerate(index_names):
+            zone[f"mean_{name}"] = float(sums[row, i + 1] / covered[i + 1])
+        results.append(zone)
+    return results
+
+
+def write_results(results, path):
+    """Write zone statistics as CSV, or JSON when path ends in .json"""
+    if path.lower().endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        return
+    with open(path, 'w', newline='') as f:
+        if not results:
+            return
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-zone disease, green cover and index statistics")
+    parser.add_argument('image', help="mosaic or image to analyse")
+    parser.add_argument('-o', '--output', default='zones.csv', help="output .csv or .json path")
+    parser.add_argument('--zones', help="JSON list of zone polygons; detected areas by default")
+    parser.add_argument('--indices', default=','.join(DEFAULT_INDICES),
+                        help=f"comma-separated indices to average ({', '.join(INDICES)})")
+    parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE, help="tile size in pixels")
+    parser.add_argument('--workers', type=int, default=1, help="tiles processed concurrently")
+    parser.add_argument('--backend', choices=BACKENDS, default='thread', help="worker pool type")
+    args = parser.parse_args(argv)
+
+    image = cv2.imread(args.image, cv2.IMREAD_COLOR)
+    if image is None:
+        print(f"Could not read {args.image}")
+        return 1
+    zones = None
+    if args.zones:
+        with open(args.zones) as f:
+            zones = polygons_from_json(json.load(f))
+    index_names = [name.strip() for name in args.indices.split(',') if name.strip()]
+
+    try:
+        results = zonal_stats(image, zones, index_names, tile_size=args.tile_size,
+                              workers=args.workers, backend=args.backend)
+    except ValueError as e:
+        print(e)
+        return 1
+    write_results(results, args.output)
+    print(f"Wrote statistics of {len(results)} zones to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())